@@ -0,0 +1,597 @@
+#! /usr/bin/python3
+
+# Author: Patrick Denis Browne
+# e-mail: pdbr@plen.ku.dk
+# Licensed under the terms of the GNU General Public License v3.0
+
+# Answers the read count and depth queries of nr_contig_depth_vs_length.py
+# for every region of a region file in one streaming pass over a
+# coordinate sorted BAM file, instead of starting samtools pipelines for
+# every region. The results are the same as those of the pipelines:
+# - the number of reads is the number of distinct read names among the
+#   alignments overlapping any region of a line, of any flag, as
+#   `samtools view bam regions | cut -f 1 | sort | uniq | grep -c ''`
+#   counts them.
+# - the depths of a (trimmed) region are the non-zero depths at every
+#   position covered by the alignments overlapping the region, as
+#   `samtools view -h bam region | samtools depth -` reports them. As in
+#   samtools depth, unmapped, secondary, QC failed and duplicate
+#   alignments are not counted, nor are deletions and skipped reference
+#   (D and N) in the CIGAR. Note that this includes positions outside the
+#   region that are covered by an alignment overlapping it.
+# The per-base depths of a BAM file can also be written once to a depth
+# store (see buildDepthStore), which answers depth queries for any regions
+# from memory-mapped arrays. Those depths are of the positions of the
+# regions themselves, without the flanking positions above. The store is
+# kept next to the BAM file, or in the cache directory if that is not
+# writable (see depthStorePath).
+
+import hashlib
+import json
+import math
+import os
+import re
+import struct
+from array import array
+
+import numpy as np
+
+import bam_reader
+import instrument
+
+# unmapped, secondary, QC fail, duplicate; not counted by samtools depth
+DEPTH_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+DEPTH_STORE_MAGIC = b'HTSDEPTH'
+DEPTH_STORE_VERSION = 1
+
+def parseRegion(region):
+    '''
+    Splits a samtools region string, 'name:start-stop' (1-based and
+    inclusive), into its name, start and stop.
+    '''
+    cName, dStart, dStop = re.search(r'^([^:]+):(\d+)-(\d+)$', region).groups()
+    return cName, int(dStart), int(dStop)
+
+class hashedNameSet:
+    '''
+    Counts distinct read names exactly, keeping only the 64-bit hash of
+    each name rather than the name itself. Two distinct names would have
+    to collide for the count to be off, which for n names happens with a
+    probability of about n**2 / 2**65 (3e-6 for ten million names).
+    '''
+    def __init__(self):
+        self.hashes = set()
+
+    def add(self, name):
+        self.hashes.add(hash(name))
+
+    def count(self):
+        return len(self.hashes)
+
+class hyperLogLog:
+    '''
+    Estimates the number of distinct read names in 2**precision bytes,
+    however many there are (Flajolet et al. 2007, with the linear counting
+    correction for small counts). The relative standard error is
+    1.04 / sqrt(2**precision): 0.8% with the default precision of 14, so
+    about 95% of estimates are within 1.6% of the true count. Names are
+    hashed with Python's hash(), which is salted per process, so estimates
+    can differ slightly between runs.
+    Until more than sparseLimit distinct names have been seen, their
+    hashes are kept and counted exactly, as by hashedNameSet, which takes
+    less memory than the registers; these are only allocated then, so
+    the many regions with few reads each stay small.
+    '''
+    def __init__(self, precision=14, sparseLimit=128):
+        assert 4 <= precision <= 18, "The precision must be between 4 and 18"
+        self.precision = precision
+        self.sparseLimit = sparseLimit
+        self.hashes = set()
+        self.registers = None
+        self.__shift = 64 - precision
+        self.__mask = (1 << self.__shift) - 1
+
+    def add(self, name):
+        if self.registers is None:
+            self.hashes.add(hash(name))
+            if len(self.hashes) > self.sparseLimit:
+                self.registers = bytearray(1 << self.precision)
+                for h in self.hashes:
+                    self.__addHash(h)
+                self.hashes = None
+            return
+        self.__addHash(hash(name))
+
+    def __addHash(self, h):
+        h &= 0xffffffffffffffff
+        i = h >> self.__shift
+        rank = self.__shift - (h & self.__mask).bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def count(self):
+        if self.registers is None:
+            return len(self.hashes)
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        registers = np.frombuffer(self.registers, dtype=np.uint8)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+def nameCounter(approximate=False):
+    '''
+    A distinct read name counter: a hyperLogLog if approximate, otherwise
+    a hashedNameSet.
+    '''
+    if approximate:
+        return hyperLogLog()
+    return hashedNameSet()
+
+class depthAccumulator:
+    '''
+    Streaming statistics over depth values in bounded memory. counts[d]
+    is the number of positions with depth d. The array only grows as far
+    as the largest depth seen, and never beyond maxDepth; deeper positions
+    are tallied by depth in the overflow dictionary, which stays small, so
+    the statistics are exact.
+    '''
+    def __init__(self, maxDepth=65536):
+        self.maxDepth = maxDepth
+        self.counts = np.zeros(1, dtype=np.int64)
+        self.overflow = {}
+        self.total = 0
+        self.n = 0
+
+    def add(self, depths, chunkSize=1 << 20):
+        # Integer arrays are used as they are, so that the uint16 or uint32
+        # views of a depthStore are not copied and widened as a whole;
+        # np.bincount only widens one chunk of chunkSize depths at a time
+        depths = np.asarray(depths)
+        if depths.dtype.kind not in 'iu':
+            depths = depths.astype(np.int64)
+        for start in range(0, len(depths), chunkSize):
+            self.__addChunk(depths[start:start + chunkSize])
+
+    def __addChunk(self, depths):
+        self.total += int(depths.sum(dtype=np.int64))
+        self.n += len(depths)
+        deep = depths >= self.maxDepth
+        if deep.any():
+            values, numbers = np.unique(depths[deep], return_counts=True)
+            for value, number in zip(values.tolist(), numbers.tolist()):
+                self.overflow[value] = self.overflow.get(value, 0) + number
+            depths = depths[~deep]
+        binned = np.bincount(depths)
+        if len(binned) > len(self.counts):
+            binned[:len(self.counts)] += self.counts
+            self.counts = binned
+        else:
+            self.counts[:len(binned)] += binned
+
+    def addZeros(self, n):
+        if n > 0:
+            self.counts[0] += n
+            self.n += n
+
+    def mean(self, numPositions=None):
+        '''
+        The sum of the depths divided by numPositions, or by the number of
+        values if it isn't given.
+        '''
+        if numPositions is None:
+            numPositions = self.n
+        return float(self.total) / numPositions
+
+    def __value(self, rank, cumulative, deepValues, deepCumulative):
+        # The value at 0-based rank in the sorted depths
+        if rank < cumulative[-1]:
+            return int(np.searchsorted(cumulative, rank, side='right'))
+        i = int(np.searchsorted(deepCumulative, rank - cumulative[-1], side='right'))
+        return deepValues[i]
+
+    def percentile(self, q):
+        '''
+        The q-th percentile (0 to 100) of the depths, interpolated
+        linearly between ranks as numpy.percentile does by default.
+        '''
+        assert self.n > 0, "No depths to take a percentile of"
+        cumulative = np.cumsum(self.counts)
+        deepValues = sorted(self.overflow)
+        deepCumulative = np.cumsum([self.overflow[v] for v in deepValues])
+        rank = (self.n - 1) * (q / 100.0)
+        lower = int(np.floor(rank))
+        upper = min(lower + 1, self.n - 1)
+        lowValue = self.__value(lower, cumulative, deepValues, deepCumulative)
+        highValue = self.__value(upper, cumulative, deepValues, deepCumulative)
+        # Interpolated from the nearer end, as numpy does
+        fraction = rank - lower
+        if fraction >= 0.5:
+            return highValue - (highValue - lowValue) * (1 - fraction)
+        return lowValue + (highValue - lowValue) * fraction
+
+    def median(self):
+        return self.percentile(50)
+
+    def breadth(self, threshold):
+        '''
+        The fraction of the depth values that are at least threshold.
+        '''
+        if self.n == 0:
+            return 0.0
+        covered = int(self.counts[threshold:].sum()) if threshold < len(self.counts) else 0
+        covered += sum([number for value, number in self.overflow.items() if value >= threshold])
+        return float(covered) / self.n
+
+class regionQuery:
+    '''
+    The queries for one line of the region file: the distinct reads over
+    all its regions, and the depths over each of its regions after
+    trimming 'trim' positions off both ends (as in bamDepth).
+
+    After the BAM has been scanned:
+    names: the number of distinct read names overlapping the regions,
+           which is approximate if approximate is True. While the BAM is
+           being scanned it is a nameCounter, which is replaced by its
+           count as soon as the scan has moved past all the contigs of
+           the regions (see finishNames)
+    depths: a depthAccumulator of the depths that samtools depth would
+            report for the trimmed regions
+    numPositions: the total length of the trimmed regions
+    With collectDepths=False only the reads are counted; the trimmed
+    regions are still worked out, e.g. for a depthStore.
+    '''
+    def __init__(self, line, trim=0, approximate=False, collectDepths=True):
+        self.line = line.rstrip('\n')
+        self.regions = [parseRegion(region) for region in self.line.split(' ')]
+        self.depthRegions = []
+        self.numPositions = 0
+        for cName, dStart, dStop in self.regions:
+            assert dStart <= dStop, "The start wasn't before the stop\n%s" % (self.line)
+            dStart += trim
+            dStop -= trim
+            assert dStart <= dStop, "The trimming was too much\n%s" % (self.line)
+            self.depthRegions.append((cName, dStart, dStop))
+            self.numPositions += 1 + dStop - dStart
+        assert self.numPositions > 0, "Depth cannot be calculated for this region (zero or negative length)\n%s" % (self.line)
+        self.names = nameCounter(approximate)
+        self.regionsLeft = 0
+        self.blockStarts = [array('q') for region in self.depthRegions]
+        self.blockEnds = [array('q') for region in self.depthRegions]
+        self.depths = depthAccumulator()
+        self.collectDepths = collectDepths
+        self.finished = [not collectDepths for region in self.depthRegions]
+
+    def finishNames(self):
+        '''
+        Replaces the name counter by its count, so that the names (or the
+        registers) are not held any longer than they are needed.
+        '''
+        if self.names.__class__ is not int:
+            self.names = self.names.count()
+
+    def numReads(self):
+        self.finishNames()
+        return self.names
+
+    def finishDepth(self, k):
+        '''
+        Turns the aligned blocks collected for trimmed region k into
+        depths, with a difference array over the positions they span, and
+        adds them to the accumulated depths. As in bamDepth, a region
+        without any depth adds a single zero.
+        '''
+        starts = np.frombuffer(self.blockStarts[k], dtype=np.int64)
+        ends = np.frombuffer(self.blockEnds[k], dtype=np.int64)
+        if len(starts) == 0:
+            depths = np.zeros(1, dtype=np.int64)
+        else:
+            lo = starts.min()
+            size = ends.max() - lo + 1
+            diff = np.bincount(starts - lo, minlength=size) - \
+                    np.bincount(ends - lo, minlength=size)
+            depths = np.cumsum(diff[:-1])
+            depths = depths[depths > 0]
+            if len(depths) == 0:
+                depths = np.zeros(1, dtype=np.int64)
+        self.depths.add(depths)
+        self.finished[k] = True
+        self.blockStarts[k] = None
+        self.blockEnds[k] = None
+
+def alignedBlocks(record, pos, lReadName, nCigarOp):
+    '''
+    Returns the end (0-based, exclusive) of the reference span of a BAM
+    record and the list of (start, end) reference blocks covered by its
+    aligned bases (M, = and X operations). Like samtools, an alignment
+    without reference-consuming operations spans one position.
+    '''
+    blocks = []
+    ref = pos
+    if nCigarOp:
+        for op in struct.unpack_from('<%iI' % (nCigarOp), record, 32 + lReadName):
+            opType = op & 0xf
+            if opType == 0 or opType == 7 or opType == 8:
+                blocks.append((ref, ref + (op >> 4)))
+                ref += op >> 4
+            elif opType == 2 or opType == 3:
+                ref += op >> 4
+    if ref == pos:
+        ref = pos + 1
+    return ref, blocks
+
+def scanBam(bamPath, queries):
+    '''
+    Answers all the regionQuery objects in queries with a single pass
+    over bamPath, which must be sorted by coordinate. The depths of the
+    regions of a contig are worked out as soon as the scan has moved past
+    that contig, so only the blocks of one contig are held at a time, and
+    the reads of a query are counted once the scan has moved past the
+    contigs of all its regions.
+    '''
+    metrics = instrument.metrics
+    with open(bamPath, 'rb') as fileh:
+        position, size = instrument.fileProgress(fileh)
+        reader = bam_reader.bgzf_reader(fileh)
+        text, references = bam_reader.readBamHeader(reader)
+        refIds = dict([(name, i) for i, (name, length) in enumerate(references)])
+        # For every reference ID: (start, end, query, k) of the regions to
+        # count reads in (k is None) and of the trimmed regions to collect
+        # depths for (k is the index of the trimmed region), 0-based
+        # half-open.
+        targets = [[] for ref in references]
+        for query in queries:
+            for cName, dStart, dStop in query.regions:
+                if cName in refIds:
+                    targets[refIds[cName]].append((dStart - 1, dStop, query, None))
+                    query.regionsLeft += 1
+            for k in range(len(query.depthRegions)):
+                cName, dStart, dStop = query.depthRegions[k]
+                if cName in refIds and query.collectDepths:
+                    targets[refIds[cName]].append((dStart - 1, dStop, query, k))
+        finished = set()
+        currentRef = None
+        for record in metrics.track(reader.records(), 'BAM records',
+                'reading BAM records', size, position):
+            refID, pos, lReadName, mapq, bin_, nCigarOp, flag = \
+                    bam_reader.recordCore(record)[:7]
+            if refID != currentRef:
+                if currentRef is not None:
+                    finishTargets(targets[currentRef])
+                    finished.add(currentRef)
+                if refID in finished:
+                    raise ValueError('%s is not sorted by coordinate' % (bamPath))
+                currentRef = refID
+            if refID < 0 or pos < 0 or not targets[refID]:
+                continue
+            end, blocks = alignedBlocks(record, pos, lReadName, nCigarOp)
+            for tStart, tEnd, query, k in targets[refID]:
+                if pos >= tEnd or end <= tStart:
+                    continue
+                if k is None:
+                    query.names.add(bam_reader.recordQname(record))
+                elif flag & DEPTH_SKIP_FLAGS == 0:
+                    for bStart, bEnd in blocks:
+                        query.blockStarts[k].append(bStart)
+                        query.blockEnds[k].append(bEnd)
+        for refID in range(len(references)):
+            if refID not in finished:
+                finishTargets(targets[refID])
+    for query in queries:
+        for k in range(len(query.finished)):
+            if not query.finished[k]:
+                query.finishDepth(k)
+        query.finishNames()
+    return queries
+
+def finishTargets(contigTargets):
+    '''
+    Finishes the depths of the trimmed regions on a contig that has been
+    scanned, and the read counts of the queries with no regions left to
+    scan.
+    '''
+    for tStart, tEnd, query, k in contigTargets:
+        if k is not None:
+            query.finishDepth(k)
+        else:
+            query.regionsLeft -= 1
+            if query.regionsLeft == 0:
+                query.finishNames()
+
+def depthStats(query, thresholds=(), percentiles=()):
+    '''
+    Returns the number of positions, the average depth and the median
+    depth of a scanned regionQuery, as bamDepth does, followed by the
+    breadth of coverage at each of the thresholds and the depth at each of
+    the percentiles (see depthSummary).
+    '''
+    return depthSummary(query.depths, query.numPositions, thresholds, percentiles)
+
+def depthSummary(depths, numPositions, thresholds=(), percentiles=()):
+    '''
+    Summarises a depthAccumulator of the depths reported over regions with
+    numPositions positions in total, as bamDepth always has: the average
+    is the sum of the depths over numPositions and the median is taken
+    after padding the depths with zeros up to numPositions. Returns a
+    tuple of numPositions, the average and median depths, the breadth of
+    coverage at each of the thresholds and the depth at each percentile.
+    '''
+    depths.addZeros(numPositions - depths.n)
+    stats = [numPositions, depths.mean(numPositions), depths.median()]
+    stats.extend([depths.breadth(threshold) for threshold in thresholds])
+    stats.extend([depths.percentile(q) for q in percentiles])
+    return tuple(stats)
+
+def contigDepths(length, starts, ends):
+    '''
+    The depth at every position of a contig of the given length, from the
+    0-based, half-open aligned blocks (starts[i], ends[i]) over it, as
+    uint16, or as uint32 if any depth is too high for uint16.
+    '''
+    starts = np.clip(np.frombuffer(starts, dtype=np.int64), 0, length)
+    ends = np.clip(np.frombuffer(ends, dtype=np.int64), 0, length)
+    diff = np.bincount(starts, minlength=length + 1) - np.bincount(ends, minlength=length + 1)
+    depths = np.cumsum(diff[:length])
+    if len(depths) and depths.max() > np.iinfo(np.uint16).max:
+        return depths.astype(np.uint32)
+    return depths.astype(np.uint16)
+
+def defaultDepthStoreDir():
+    cacheDir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cacheDir, 'hts', 'depth')
+
+def depthStorePath(bamPath, storeDir=None):
+    '''
+    Where the depth store of bamPath is kept: in storeDir if it is given,
+    otherwise next to the BAM file (bamPath + '.depth') if its directory
+    is writable, and in defaultDepthStoreDir() if it is not. A store kept
+    in another directory is named after the real path of the BAM file, so
+    that BAM files of the same name in different directories don't share
+    a store.
+    '''
+    if storeDir is None:
+        if os.access(os.path.dirname(os.path.abspath(bamPath)), os.W_OK):
+            return bamPath + '.depth'
+        storeDir = defaultDepthStoreDir()
+    realPath = os.path.realpath(bamPath)
+    digest = hashlib.sha1(realPath.encode()).hexdigest()[:16]
+    return os.path.join(storeDir, '%s.%s.depth' % (os.path.basename(realPath), digest))
+
+def buildDepthStore(bamPath, storePath=None):
+    '''
+    Writes the depth at every position of every reference of bamPath,
+    which must be sorted by coordinate, counted as samtools depth counts
+    it, to a depth store (by default at depthStorePath(bamPath)), creating
+    its directory if needed. The store holds one array per reference (see
+    contigDepths), aligned to 8 bytes, then a JSON index of the name,
+    length, type and offset of every array and of the size and
+    modification time of the BAM file, then the offset of the index and
+    DEPTH_STORE_MAGIC. The file is written under a temporary name and
+    renamed, so a store is never seen half written.
+    '''
+    if storePath is None:
+        storePath = depthStorePath(bamPath)
+    if os.path.dirname(storePath):
+        os.makedirs(os.path.dirname(storePath), exist_ok=True)
+    info = os.stat(bamPath)
+    index = {'version': DEPTH_STORE_VERSION, 'bam': [info.st_size, info.st_mtime_ns], 'contigs': []}
+    tmpPath = storePath + '.tmp'
+    with open(bamPath, 'rb') as fileh, open(tmpPath, 'wb') as outh:
+        reader = bam_reader.bgzf_reader(fileh)
+        text, references = bam_reader.readBamHeader(reader)
+        outh.write(DEPTH_STORE_MAGIC)
+
+        def writeContig(refID, starts, ends):
+            name, length = references[refID]
+            depths = contigDepths(length, starts, ends)
+            index['contigs'].append([name, length, depths.dtype.str, outh.tell()])
+            outh.write(depths.tobytes())
+            outh.write(b'\0' * (-outh.tell() % 8))
+
+        written = set()
+        currentRef = None
+        starts = array('q')
+        ends = array('q')
+        for record in instrument.metrics.track(reader.records(), 'BAM records',
+                'building the depth store'):
+            refID, pos, lReadName, mapq, bin_, nCigarOp, flag = \
+                    bam_reader.recordCore(record)[:7]
+            if refID != currentRef:
+                if currentRef is not None and currentRef >= 0:
+                    writeContig(currentRef, starts, ends)
+                    written.add(currentRef)
+                if refID in written:
+                    raise ValueError('%s is not sorted by coordinate' % (bamPath))
+                currentRef = refID
+                starts = array('q')
+                ends = array('q')
+            if refID < 0 or pos < 0 or flag & DEPTH_SKIP_FLAGS:
+                continue
+            end, blocks = alignedBlocks(record, pos, lReadName, nCigarOp)
+            for bStart, bEnd in blocks:
+                starts.append(bStart)
+                ends.append(bEnd)
+        if currentRef is not None and currentRef >= 0:
+            writeContig(currentRef, starts, ends)
+            written.add(currentRef)
+        for refID in range(len(references)):
+            if refID not in written:
+                writeContig(refID, array('q'), array('q'))
+        indexOffset = outh.tell()
+        outh.write(json.dumps(index).encode())
+        outh.write(struct.pack('<Q', indexOffset) + DEPTH_STORE_MAGIC)
+    os.replace(tmpPath, storePath)
+
+class depthStore:
+    '''
+    Read access to a depth store written by buildDepthStore. The file is
+    memory-mapped, and the depths of a contig are a NumPy view of it, so
+    only the pages of the regions queried are ever read.
+    source: the size and modification time of the BAM file it was built
+            from
+    '''
+    def __init__(self, storePath):
+        self.data = np.memmap(storePath, dtype=np.uint8, mode='r')
+        magicSize = len(DEPTH_STORE_MAGIC)
+        if bytes(self.data[:magicSize]) != DEPTH_STORE_MAGIC or \
+                bytes(self.data[-magicSize:]) != DEPTH_STORE_MAGIC:
+            raise ValueError('%s is not a depth store' % (storePath))
+        indexOffset = struct.unpack('<Q', bytes(self.data[-magicSize - 8:-magicSize]))[0]
+        index = json.loads(bytes(self.data[indexOffset:-magicSize - 8]).decode())
+        if index['version'] != DEPTH_STORE_VERSION:
+            raise ValueError('%s is a depth store of another version' % (storePath))
+        self.source = index['bam']
+        self.contigs = dict([(name, (length, np.dtype(dtype), offset))
+                for name, length, dtype, offset in index['contigs']])
+
+    def contigDepths(self, name):
+        length, dtype, offset = self.contigs[name]
+        return self.data[offset:offset + length * dtype.itemsize].view(dtype)
+
+    def regionDepths(self, cName, dStart, dStop):
+        '''
+        The depths of a region, 1-based and inclusive, as a view. Positions
+        beyond the end of the contig are left out.
+        '''
+        return self.contigDepths(cName)[dStart - 1:dStop]
+
+    def depthStats(self, query, thresholds=(), percentiles=()):
+        '''
+        The same statistics as depthStats, over the positions of the
+        trimmed regions of a regionQuery (which doesn't need to have been
+        scanned).
+        '''
+        depths = depthAccumulator()
+        for cName, dStart, dStop in query.depthRegions:
+            if cName in self.contigs:
+                depths.add(self.regionDepths(cName, dStart, dStop))
+        return depthSummary(depths, query.numPositions, thresholds, percentiles)
+
+_depthStores = {}
+
+def openDepthStore(bamPath, storeDir=None):
+    '''
+    Returns the depthStore of bamPath, kept in storeDir (see
+    depthStorePath), building it first if it doesn't exist or was built
+    from an older version of the BAM file. Stores are only opened once
+    per process.
+    '''
+    storePath = depthStorePath(bamPath, storeDir)
+    info = os.stat(bamPath)
+    source = [info.st_size, info.st_mtime_ns]
+    store = _depthStores.get(storePath)
+    if store is not None and store.source == source:
+        return store
+    store = None
+    if os.path.exists(storePath):
+        try:
+            store = depthStore(storePath)
+        except ValueError:
+            store = None
+    if store is None or store.source != source:
+        buildDepthStore(bamPath, storePath)
+        store = depthStore(storePath)
+    _depthStores[storePath] = store
+    return store
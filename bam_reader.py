@@ -0,0 +1,448 @@
+#! /usr/bin/python3
+
+# Author: Patrick Denis Browne
+# e-mail: pdbr@plen.ku.dk
+# Licensed under the terms of the GNU General Public License v3.0
+
+# Minimal BGZF and BAM decoding with only the standard library, so that
+# the scripts in this repository can read BAM files without first
+# converting them to SAM text with samtools. The format is described in
+# the SAM/BAM specification (https://samtools.github.io/hts-specs/).
+# Only what the scripts need is implemented: sequential reading of
+# records, reading the records that start in a region of a coordinate
+# sorted file with its .bai index, and turning a record back into a
+# SAM-format line. openInput opens the text inputs of the scripts, which
+# may be gzip (or bgzip) compressed.
+
+import collections
+import gzip
+import io
+import queue
+import struct
+import sys
+import threading
+import zlib
+
+GZIP_MAGIC = b'\x1f\x8b'
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BAM_MAGIC = b'BAM\x01'
+BAI_MAGIC = b'BAI\x01'
+# The bin of a .bai index that holds metadata instead of chunks
+BAI_PSEUDO_BIN = 37450
+CIGAR_OPS = 'MIDNSHP=X'
+SEQ_CODES = '=ACMGRSVTWYHKDBN'
+_SEQ_PAIRS = [a + b for a in SEQ_CODES for b in SEQ_CODES]
+_QUAL_TABLE = bytes((i + 33) & 0xff for i in range(256))
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq,
+# next_refID, next_pos, tlen; the fixed part of every record after its
+# block_size
+_CORE = struct.Struct('<iiBBHHHiiii')
+# struct format code and size of each numeric BAM tag type
+_TAG_FORMATS = {'c': ('b', 1), 'C': ('B', 1), 's': ('h', 2), 'S': ('H', 2),
+        'i': ('i', 4), 'I': ('I', 4), 'f': ('f', 4)}
+
+def readBgzfBlock(fileh):
+    '''
+    Reads one BGZF block from the binary file handle fileh and returns
+    its decompressed contents, or None at the end of the file. The empty
+    end-of-file marker block returns b''.
+    '''
+    header = fileh.read(12)
+    if len(header) == 0:
+        return(None)
+    if len(header) < 12 or header[:4] != BGZF_MAGIC:
+        raise ValueError('Not a BGZF compressed file (or it is truncated)')
+    xlen = struct.unpack_from('<H', header, 10)[0]
+    extra = fileh.read(xlen)
+    bsize = None
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack_from('<H', extra, i + 2)[0]
+        if extra[i:i + 2] == b'BC' and slen == 2:
+            bsize = struct.unpack_from('<H', extra, i + 4)[0]
+        i += 4 + slen
+    if bsize is None:
+        raise ValueError('BGZF block without a BC (block size) field')
+    rest = fileh.read(bsize + 1 - 12 - xlen)
+    data = zlib.decompress(rest[:-8], -15)
+    crc, isize = struct.unpack_from('<II', rest, len(rest) - 8)
+    if len(data) != isize or zlib.crc32(data) != crc:
+        raise ValueError('Corrupt BGZF block')
+    return(data)
+
+def openInput(filePath, text=True):
+    '''
+    Opens a file for reading, as text or, if text is False, as bytes. '-'
+    is stdin. Gzip compressed input is recognised by its magic number
+    rather than the file name, and decompressed.
+    '''
+    if filePath == '-':
+        fileh = sys.stdin.buffer
+        if fileh.peek(2)[:2] == GZIP_MAGIC:
+            fileh = gzip.GzipFile(fileobj=fileh)
+            if text:
+                return(io.TextIOWrapper(fileh))
+            return(fileh)
+        if text:
+            return(sys.stdin)
+        return(fileh)
+    with open(filePath, 'rb') as fileh:
+        magic = fileh.read(2)
+    if magic == GZIP_MAGIC:
+        return(gzip.open(filePath, 'rt' if text else 'rb'))
+    return(open(filePath, 'r' if text else 'rb'))
+
+def isBam(fileh):
+    '''
+    Tells if the binary, peekable file handle fileh (e.g. a file opened
+    with 'rb' or sys.stdin.buffer) holds BAM data, without consuming any
+    of it. Gzip or bgzip compressed SAM text returns False.
+    '''
+    head = fileh.peek(18)
+    if head[:4] != BGZF_MAGIC:
+        return(False)
+    xlen = struct.unpack_from('<H', head, 10)[0]
+    head = fileh.peek(12 + xlen + 64)
+    try:
+        data = zlib.decompressobj(-15).decompress(head[12 + xlen:])
+    except zlib.error:
+        return(False)
+    return(data[:4] == BAM_MAGIC)
+
+class bgzf_reader:
+    '''
+    Reads the decompressed contents of a BGZF file. Blocks are read and
+    inflated in a background thread (zlib releases the GIL while it
+    works), so decompression overlaps with whatever the caller does with
+    the data. At most queueSize chunks of blocksPerChunk blocks are
+    decompressed ahead of the caller. With background=False blocks are
+    only read when they are needed, which suits reading just the header.
+    '''
+    def __init__(self, fileh, blocksPerChunk=16, queueSize=8, background=True):
+        self.fileh = fileh
+        self.__blocksPerChunk = blocksPerChunk
+        self.__buffer = b''
+        self.__offset = 0
+        self.__done = False
+        if background:
+            self.__queue = queue.Queue(maxsize=queueSize)
+            self.__thread = threading.Thread(target=self.__inflate, daemon=True)
+            self.__thread.start()
+        else:
+            self.__queue = None
+
+    def __inflate(self):
+        try:
+            chunk = []
+            while True:
+                block = readBgzfBlock(self.fileh)
+                if block is None:
+                    break
+                chunk.append(block)
+                if len(chunk) == self.__blocksPerChunk:
+                    self.__queue.put(b''.join(chunk))
+                    chunk = []
+            if chunk:
+                self.__queue.put(b''.join(chunk))
+            self.__queue.put(None)
+        except BaseException as e:
+            self.__queue.put(e)
+
+    def __fill(self):
+        '''
+        Appends the next decompressed chunk to the buffer. Returns False
+        once the file is exhausted.
+        '''
+        if self.__done:
+            return(False)
+        if self.__queue is None:
+            chunk = readBgzfBlock(self.fileh)
+        else:
+            chunk = self.__queue.get()
+        if isinstance(chunk, BaseException):
+            self.__done = True
+            raise chunk
+        if chunk is None:
+            self.__done = True
+            return(False)
+        self.__buffer = self.__buffer[self.__offset:] + chunk
+        self.__offset = 0
+        return(True)
+
+    def read(self, n):
+        '''
+        Returns the next n bytes, or fewer at the end of the file.
+        '''
+        while len(self.__buffer) - self.__offset < n and self.__fill():
+            pass
+        data = self.__buffer[self.__offset:self.__offset + n]
+        self.__offset += len(data)
+        return(data)
+
+    def records(self):
+        '''
+        Yields BAM alignment records as bytes, without their leading
+        block_size field. The BAM header must already have been read.
+        '''
+        while True:
+            buf = self.__buffer
+            off = self.__offset
+            if len(buf) - off < 4:
+                if not self.__fill():
+                    if len(self.__buffer) - self.__offset:
+                        raise ValueError('Truncated BAM record')
+                    return
+                continue
+            end = off + 4 + struct.unpack_from('<i', buf, off)[0]
+            if end > len(buf):
+                if not self.__fill():
+                    raise ValueError('Truncated BAM record')
+                continue
+            self.__offset = end
+            yield(buf[off + 4:end])
+
+    def close(self):
+        self.__done = True
+        self.fileh.close()
+
+def readBamHeader(reader):
+    '''
+    Reads the header from the start of a bgzf_reader. Returns the SAM
+    header text and a list of (reference name, reference length) tuples
+    in the order of the reference IDs used by the records.
+    '''
+    if reader.read(4) != BAM_MAGIC:
+        raise ValueError('Not a BAM file')
+    lText = struct.unpack('<i', reader.read(4))[0]
+    text = reader.read(lText).rstrip(b'\0').decode()
+    nRef = struct.unpack('<i', reader.read(4))[0]
+    references = []
+    for i in range(nRef):
+        lName = struct.unpack('<i', reader.read(4))[0]
+        name = reader.read(lName).rstrip(b'\0').decode()
+        lRef = struct.unpack('<i', reader.read(4))[0]
+        references.append((name, lRef))
+    return(text, references)
+
+def recordCore(record):
+    '''
+    Returns the fixed fields of a BAM record as a tuple: refID, pos
+    (0-based), l_read_name, mapq, bin, n_cigar_op, flag, l_seq,
+    next_refID, next_pos, tlen.
+    '''
+    return(_CORE.unpack_from(record, 0))
+
+def readBai(baiPath):
+    '''
+    Reads a .bai index. Returns a list with, for each reference ID, a
+    tuple of a dict of its bins (bin number: list of (begin, end) chunks,
+    as virtual file offsets) and its linear index (a list of the smallest
+    virtual offset of the records overlapping each 16 kb window).
+    '''
+    with open(baiPath, 'rb') as fileh:
+        data = fileh.read()
+    if data[:4] != BAI_MAGIC:
+        raise ValueError('Not a BAI index: %s' % (baiPath))
+    nRef = struct.unpack_from('<i', data, 4)[0]
+    i = 8
+    index = []
+    for r in range(nRef):
+        nBin = struct.unpack_from('<i', data, i)[0]
+        i += 4
+        bins = {}
+        for b in range(nBin):
+            binNumber, nChunk = struct.unpack_from('<Ii', data, i)
+            i += 8
+            offsets = struct.unpack_from('<%iQ' % (2 * nChunk), data, i)
+            i += 16 * nChunk
+            if binNumber != BAI_PSEUDO_BIN:
+                bins[binNumber] = list(zip(offsets[0::2], offsets[1::2]))
+        nIntv = struct.unpack_from('<i', data, i)[0]
+        i += 4
+        linear = list(struct.unpack_from('<%iQ' % (nIntv), data, i))
+        i += 8 * nIntv
+        index.append((bins, linear))
+    return(index)
+
+def reg2bins(beg, end):
+    '''
+    The bins that may hold records overlapping [beg, end) (0-based), as
+    in the SAM/BAM specification.
+    '''
+    end -= 1
+    bins = [0]
+    for shift, first in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+    return(bins)
+
+def regionChunks(index, refID, beg, end):
+    '''
+    The sorted, merged (begin, end) virtual offset ranges of a BAM file
+    holding every record of reference refID overlapping [beg, end), from
+    its readBai index.
+    '''
+    bins, linear = index[refID]
+    minOffset = 0
+    if linear:
+        minOffset = linear[min(beg >> 14, len(linear) - 1)]
+    chunks = sorted([(cBeg, cEnd) for b in reg2bins(beg, end) for cBeg, cEnd in bins.get(b, [])
+            if cEnd > minOffset])
+    merged = []
+    for cBeg, cEnd in chunks:
+        if merged and cBeg <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], cEnd))
+        else:
+            merged.append((cBeg, cEnd))
+    return(merged)
+
+class indexed_bam:
+    '''
+    Random access to the records of a coordinate sorted BAM file (fileh,
+    opened 'rb') through its readBai index. The last cacheBlocks blocks
+    read are kept decompressed, as the chunks of neighbouring bins and
+    regions often share blocks.
+    '''
+    def __init__(self, fileh, index, cacheBlocks=64):
+        self.fileh = fileh
+        self.index = index
+        self.cacheBlocks = cacheBlocks
+        self.blocksRead = 0
+        self.bytesRead = 0
+        self.__blocks = collections.OrderedDict()
+    
+    def __block(self, blockStart):
+        '''
+        The decompressed block at file offset blockStart and the offset of
+        the next block; the data is None at the end of the file.
+        '''
+        cached = self.__blocks.get(blockStart)
+        if cached is not None:
+            self.__blocks.move_to_end(blockStart)
+            return(cached)
+        self.fileh.seek(blockStart)
+        data = readBgzfBlock(self.fileh)
+        cached = (data, self.fileh.tell())
+        self.blocksRead += 1
+        self.bytesRead += cached[1] - blockStart
+        self.__blocks[blockStart] = cached
+        if len(self.__blocks) > self.cacheBlocks:
+            self.__blocks.popitem(last=False)
+        return(cached)
+    
+    def recordsStartingIn(self, refID, beg, end):
+        '''
+        Yields, as records() does, the records on reference refID whose
+        0-based start is in [beg, end). Only the chunks that the index
+        gives for the region are read, block by block, and reading stops
+        at the first record starting at or after end, as everything after
+        it in the file starts later still.
+        '''
+        for cBeg, cEnd in regionChunks(self.index, refID, beg, end):
+            blockStart = cBeg >> 16
+            lastBlock = cEnd >> 16
+            buf = b''
+            skip = cBeg & 0xffff
+            while blockStart <= lastBlock:
+                block, nextBlock = self.__block(blockStart)
+                if block is None:
+                    break
+                if blockStart == lastBlock:
+                    block = block[:cEnd & 0xffff]
+                buf += block[skip:]
+                skip = 0
+                off = 0
+                while off + 4 <= len(buf):
+                    recEnd = off + 4 + struct.unpack_from('<i', buf, off)[0]
+                    if recEnd > len(buf):
+                        break
+                    recRefID, pos = struct.unpack_from('<ii', buf, off + 4)
+                    if recRefID != refID or pos >= end:
+                        return
+                    if pos >= beg:
+                        yield(buf[off + 4:recEnd])
+                    off = recEnd
+                buf = buf[off:]
+                blockStart = nextBlock
+
+def recordQname(record):
+    return(record[32:31 + record[8]])
+
+def cigarString(record, lReadName, nCigarOp):
+    '''
+    Returns the CIGAR of a BAM record as a SAM-format string, or '*'.
+    '''
+    if nCigarOp == 0:
+        return('*')
+    ops = struct.unpack_from('<%iI' % (nCigarOp), record, 32 + lReadName)
+    return(''.join(['%i%s' % (op >> 4, CIGAR_OPS[op & 0xf]) for op in ops]))
+
+def _formatTags(record, i):
+    tags = []
+    while i < len(record):
+        tag = record[i:i + 2].decode()
+        valType = chr(record[i + 2])
+        i += 3
+        if valType == 'A':
+            tags.append('%s:A:%s' % (tag, chr(record[i])))
+            i += 1
+        elif valType in _TAG_FORMATS:
+            fmt, size = _TAG_FORMATS[valType]
+            value = struct.unpack_from('<' + fmt, record, i)[0]
+            if valType == 'f':
+                tags.append('%s:f:%g' % (tag, value))
+            else:
+                tags.append('%s:i:%i' % (tag, value))
+            i += size
+        elif valType in 'ZH':
+            end = record.index(b'\0', i)
+            tags.append('%s:%s:%s' % (tag, valType, record[i:end].decode()))
+            i = end + 1
+        elif valType == 'B':
+            subType = chr(record[i])
+            count = struct.unpack_from('<i', record, i + 1)[0]
+            fmt, size = _TAG_FORMATS[subType]
+            values = struct.unpack_from('<%i%s' % (count, fmt), record, i + 5)
+            if subType == 'f':
+                values = ['%g' % (v) for v in values]
+            else:
+                values = [str(v) for v in values]
+            tags.append('%s:B:%s' % (tag, ','.join([subType] + values)))
+            i += 5 + count * size
+        else:
+            raise ValueError('Unknown BAM tag type %s' % (valType))
+    return(tags)
+
+def recordToSam(record, references):
+    '''
+    Formats a BAM record as a SAM-format line (without a newline).
+    references is the list returned by readBamHeader.
+    '''
+    refID, pos, lReadName, mapq, bin_, nCigarOp, flag, lSeq, nextRefID, \
+    nextPos, tlen = _CORE.unpack_from(record, 0)
+    i = 32 + lReadName + 4 * nCigarOp
+    seqBytes = (lSeq + 1) // 2
+    if lSeq == 0:
+        seq = '*'
+        qual = '*'
+    else:
+        seq = ''.join([_SEQ_PAIRS[b] for b in record[i:i + seqBytes]])[:lSeq]
+        qualBytes = record[i + seqBytes:i + seqBytes + lSeq]
+        if qualBytes[0] == 0xff:
+            qual = '*'
+        else:
+            qual = qualBytes.translate(_QUAL_TABLE).decode()
+    if refID < 0:
+        rname = '*'
+    else:
+        rname = references[refID][0]
+    if nextRefID < 0:
+        rnext = '*'
+    elif nextRefID == refID:
+        rnext = '='
+    else:
+        rnext = references[nextRefID][0]
+    cols = [recordQname(record).decode(), str(flag), rname, str(pos + 1),
+            str(mapq), cigarString(record, lReadName, nCigarOp), rnext,
+            str(nextPos + 1), str(tlen), seq, qual]
+    cols.extend(_formatTags(record, i + seqBytes + lSeq))
+    return('\t'.join(cols))
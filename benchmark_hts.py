@@ -0,0 +1,776 @@
+#! /usr/bin/python3
+
+# Author: Patrick Denis Browne
+# e-mail: pdbr@plen.ku.dk
+# Licensed under the terms of the GNU General Public License v3.0
+
+# Throughput benchmarks for the scripts in this repository. Inputs are
+# generated synthetically from a fixed seed so that numbers are
+# comparable between runs and between commits. For example:
+# $ python3 benchmark_hts.py --reads 200000
+# Superseded implementations are kept below, under the 'legacy_' prefix,
+# so that the current code can be compared against them directly.
+#
+# Besides these micro benchmarks, each of the three scripts is run end to
+# end on generated input of increasing size (--scales), reporting records
+# per second, the peak RSS of the script's process and how the run time
+# scales with the input. Results can be saved as a JSON baseline and
+# compared against one saved at another commit:
+# $ python3 benchmark_hts.py --save before.json
+# $ git checkout ... && python3 benchmark_hts.py --compare before.json
+# The digest of every script's output is part of the results, so that a
+# change in output is caught along with a change in speed.
+# --verify-batch checks the batch bridge tests of
+# count_reads_bridging_ends.py (--batch) against the scalar functions on
+# a generated library, pair by pair and on the whole output.
+
+import argparse
+import hashlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+import numpy as np
+
+import count_reads_bridging_ends as crbe
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# The size of the smallest input of each script benchmark, multiplied by
+# each of --scales: read groups, contigs of the all versus all report and
+# contigs with regions.
+BASE_SIZES = {'bridging': 20000, 'blast': 5000, 'regions': 100}
+
+class legacy_sam_entry:
+    '''
+    The eager record that sam_entry replaced. Every line is split, five
+    columns are converted to int and the columns are kept twice.
+    '''
+    def __init__(self, line):
+        if line.startswith('@'):
+            raise ValueError('Only headless SAM files are supported.')
+        line = line.rstrip('\n')
+        self.__cols = line.split('\t')
+        assert len(self.__cols) >= 11, "Line has too few fields for SAM format\n%s" % (line)
+        for i in [1, 3, 4, 7, 8]:
+            self.__cols[i] = int(self.__cols[i])
+        self.qname = self.__cols[0]
+        self.flag = self.__cols[1]
+        self.rname = self.__cols[2]
+        self.pos = self.__cols[3]
+        self.mapq = self.__cols[4]
+        self.cigar = self.__cols[5]
+        self.rnext = self.__cols[6]
+        self.pnext = self.__cols[7]
+        self.tlen = self.__cols[8]
+        self.seq = self.__cols[9]
+        self.qual = self.__cols[10]
+
+    def __str__(self):
+        return('\t'.join([str(col) for col in self.__cols]))
+
+class legacy_sam_per_read:
+    '''
+    The seek/readline based reader that sam_per_read replaced. It reads
+    every line twice and requires a seekable, uncompressed file.
+    '''
+    def __init__(self,filePath):
+        self.fileh = open(filePath,'r')
+        self.cursor_pos = self.fileh.tell()
+
+    def __iter__(self):
+        return(self)
+
+    def __next__(self):
+        currlines = [self.fileh.readline().rstrip('\n').split('\t')]
+        self.cursor_pos = self.fileh.tell()
+        if currlines == [['']]:
+            raise StopIteration
+        while self.fileh.readline().rstrip('\n').split('\t')[0] == currlines[0][0]:
+            self.fileh.seek(self.cursor_pos)
+            currlines.append(self.fileh.readline().rstrip('\n').split('\t'))
+            self.cursor_pos = self.fileh.tell()
+        self.fileh.seek(self.cursor_pos)
+        return(currlines)
+
+def writeNameSortedSam(outPath, numReads, seed=1, readLength=150):
+    '''
+    Writes a headless, name sorted SAM file of paired reads to outPath.
+    Each read has one to four alignments. Returns the number of lines
+    written.
+    '''
+    rng = random.Random(seed)
+    contigs = ['NODE_%i_length_%i_cov_10.0' % (i + 1, rng.randint(1000, 50000))
+            for i in range(50)]
+    seq = ''.join(rng.choice('ACGT') for i in range(readLength))
+    qual = 'I' * readLength
+    numLines = 0
+    with open(outPath, 'w') as outh:
+        for r in range(numReads):
+            qname = 'read%09i' % (r)
+            for a in range(rng.randint(1, 4)):
+                contig = rng.choice(contigs)
+                flag = rng.choice([0x1 | 0x40, 0x1 | 0x80, 0x1 | 0x40 | 0x10,
+                        0x1 | 0x80 | 0x10])
+                clip = rng.randint(0, 60)
+                if clip:
+                    cigarString = '%iS%iM' % (clip, readLength - clip)
+                else:
+                    cigarString = '%iM' % (readLength)
+                outh.write('\t'.join([qname, str(flag), contig,
+                        str(rng.randint(1, 1000)), '60', cigarString, '=',
+                        str(rng.randint(1, 1000)), '0', seq, qual]) + '\n')
+                numLines += 1
+    return(numLines)
+
+def randomCigar(rng, readLength):
+    '''
+    A CIGAR, as a list of (operation, length), of the kinds aligners
+    produce for a read: mostly full matches, then soft clips, deletions,
+    insertions and skipped reference.
+    '''
+    kind = rng.random()
+    if kind < 0.6:
+        return([('M', readLength)])
+    elif kind < 0.75:
+        clip = rng.randint(5, 40)
+        if rng.random() < 0.5:
+            return([('S', clip), ('M', readLength - clip)])
+        return([('M', readLength - clip), ('S', clip)])
+    elif kind < 0.85:
+        left = rng.randint(20, readLength - 20)
+        return([('M', left), ('D', rng.randint(1, 6)), ('M', readLength - left)])
+    elif kind < 0.95:
+        left = rng.randint(20, readLength - 20)
+        size = rng.randint(1, 4)
+        return([('M', left), ('I', size), ('M', readLength - left - size)])
+    left = rng.randint(20, readLength - 20)
+    return([('M', left), ('N', rng.randint(20, 200)), ('M', readLength - left)])
+
+def cigarText(cigarOps):
+    return(''.join(['%i%s' % (length, op) for op, length in cigarOps]))
+
+def refSpan(cigarOps):
+    return(sum([length for op, length in cigarOps if op in 'MDN=X']))
+
+def writeBridgingSam(outPath, numReads, seed=1, readLength=150, numContigs=200):
+    '''
+    Writes a name sorted SAM file with a header, for
+    count_reads_bridging_ends.py, of numReads read pairs on circular
+    contigs. Most pairs map normally, with realistic CIGARs, some are
+    multi-mappers with secondary alignments, some R1s are split across
+    the end and the start of their contig (with a supplementary
+    alignment) and some are unmapped. Returns the number of alignments.
+    '''
+    rng = random.Random(seed)
+    lengths = [rng.randint(1000, 50000) for i in range(numContigs)]
+    names = ['NODE_%i_length_%i_cov_10.0' % (i + 1, lengths[i]) for i in range(numContigs)]
+    seq = ''.join([rng.choice('ACGT') for i in range(readLength)])
+    qual = 'I' * readLength
+    numLines = 0
+    with open(outPath, 'w') as outh:
+        outh.write('@HD\tVN:1.6\tSO:queryname\n')
+        for i in range(numContigs):
+            outh.write('@SQ\tSN:%s\tLN:%i\n' % (names[i], lengths[i]))
+        for r in range(numReads):
+            qname = 'read%09i' % (r)
+            c = rng.randrange(numContigs)
+            length = lengths[c]
+            kind = rng.random()
+            alns = []
+            if kind < 0.03:
+                alns.append((0x1 | 0x4 | 0x8 | 0x40, '*', 0, '*'))
+                alns.append((0x1 | 0x4 | 0x8 | 0x80, '*', 0, '*'))
+            elif kind < 0.13:
+                # The R1 crosses the junction of the circular contig
+                cut = rng.randint(20, readLength - 20)
+                alns.append((0x1 | 0x40, names[c], length - cut + 1,
+                        '%iM%iS' % (cut, readLength - cut)))
+                alns.append((0x1 | 0x40 | 0x800, names[c], 1,
+                        '%iS%iM' % (cut, readLength - cut)))
+                alns.append((0x1 | 0x80 | 0x10, names[c], rng.randint(1, 400), '%iM' % (readLength)))
+            else:
+                insert = rng.randint(readLength, 500)
+                cigar1 = randomCigar(rng, readLength)
+                cigar2 = randomCigar(rng, readLength)
+                pos1 = rng.randint(1, max(1, length - insert))
+                pos2 = max(1, pos1 + insert - refSpan(cigar2))
+                alns.append((0x1 | 0x2 | 0x20 | 0x40, names[c], pos1, cigarText(cigar1)))
+                alns.append((0x1 | 0x2 | 0x10 | 0x80, names[c], pos2, cigarText(cigar2)))
+                if kind > 0.85:
+                    # A multi-mapper, with a secondary alignment elsewhere
+                    other = rng.randrange(numContigs)
+                    alns.append((0x1 | 0x100 | 0x40, names[other],
+                            rng.randint(1, max(1, lengths[other] - readLength)),
+                            '%iM' % (readLength)))
+            for flag, rname, pos, cigarString in alns:
+                outh.write('\t'.join([qname, str(flag), rname, str(pos),
+                        '0' if flag & 0x100 else '60', cigarString, '*', '0', '0',
+                        seq, qual]) + '\n')
+                numLines += 1
+    return(numLines)
+
+def writeBlastTable(outPath, numContigs, seed=1):
+    '''
+    Writes an all versus all blastn report, in the outfmt 6 columns that
+    unique_regions_from_blastn.py expects, for numContigs SPAdes-style
+    contigs. Every contig has a full self hit and up to eight hits to
+    other contigs, some forward and some reverse. Returns the number of
+    lines.
+    '''
+    rng = random.Random(seed)
+    lengths = [rng.randint(500, 20000) for i in range(numContigs)]
+    names = ['NODE_%i_length_%i_cov_5.0' % (i + 1, lengths[i]) for i in range(numContigs)]
+    numLines = 0
+    with open(outPath, 'w') as outh:
+        for q in range(numContigs):
+            qlen = lengths[q]
+            hits = [(q, 1, qlen, 1, qlen)]
+            for h in range(rng.randint(0, 8)):
+                s = rng.randrange(numContigs)
+                slen = lengths[s]
+                size = min(qlen, slen, rng.randint(50, 3000))
+                qstart = rng.randint(1, qlen - size + 1)
+                sstart = rng.randint(1, slen - size + 1)
+                if rng.random() < 0.5:
+                    hits.append((s, qstart, qstart + size - 1, sstart, sstart + size - 1))
+                else:
+                    hits.append((s, qstart, qstart + size - 1, sstart + size - 1, sstart))
+            for s, qstart, qend, sstart, send in hits:
+                size = qend - qstart + 1
+                mismatch = 0 if s == q else rng.randint(0, size // 20)
+                outh.write('\t'.join([names[q], names[s],
+                        '%.3f' % (100.0 * (size - mismatch) / size), str(size),
+                        str(mismatch), '0', str(qstart), str(qend), str(sstart),
+                        str(send), '%.2e' % (10 ** -rng.randint(10, 180)),
+                        '%.1f' % (1.8 * size), str(qlen), str(lengths[s]), '0']) + '\n')
+                numLines += 1
+    return(numLines)
+
+class bgzfWriter:
+    '''
+    Writes a BGZF compressed file. flush() ends the current block, so that
+    whatever is written next starts a new block at offset().
+    '''
+    MAX_BLOCK = 0xff00
+    EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+    def __init__(self, outPath):
+        self.outh = open(outPath, 'wb')
+        self.buffer = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.MAX_BLOCK:
+            data = b''.join(self.buffer)
+            while len(data) >= self.MAX_BLOCK:
+                self.__writeBlock(data[:self.MAX_BLOCK])
+                data = data[self.MAX_BLOCK:]
+            self.buffer = [data]
+            self.size = len(data)
+
+    def __writeBlock(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        self.outh.write(b'\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0')
+        self.outh.write(struct.pack('<H', len(deflated) + 25) + deflated)
+        self.outh.write(struct.pack('<II', zlib.crc32(data), len(data)))
+
+    def flush(self):
+        if self.size:
+            self.__writeBlock(b''.join(self.buffer))
+        self.buffer = []
+        self.size = 0
+
+    def offset(self):
+        return(self.outh.tell())
+
+    def close(self):
+        self.flush()
+        self.outh.write(self.EOF_BLOCK)
+        self.outh.close()
+
+def reg2bin(beg, end):
+    '''
+    The BAI bin of a 0-based, half-open interval, as in the SAM
+    specification.
+    '''
+    end -= 1
+    for shift, offset in [(14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)]:
+        if beg >> shift == end >> shift:
+            return(offset + (beg >> shift))
+    return(0)
+
+def writeSortedBam(outPath, references, records):
+    '''
+    Writes a coordinate sorted BAM file. references is a list of (name,
+    length) and records a list of (qname, flag, refID, 1-based pos,
+    CIGAR as a list of (operation, length)), sorted by reference and
+    position. The records of every reference start a new BGZF block, and
+    the file offsets of those blocks are saved alongside, in outPath +
+    '.offsets' (JSON), so that the samtools stand-in can seek to them.
+    '''
+    text = '@HD\tVN:1.6\tSO:coordinate\n' + ''.join(['@SQ\tSN:%s\tLN:%i\n' %
+            (name, length) for name, length in references])
+    writer = bgzfWriter(outPath)
+    header = [b'BAM\x01', struct.pack('<i', len(text)), text.encode(),
+            struct.pack('<i', len(references))]
+    for name, length in references:
+        header.append(struct.pack('<i', len(name) + 1) + name.encode() + b'\0')
+        header.append(struct.pack('<i', length))
+    writer.write(b''.join(header))
+    offsets = {}
+    for qname, flag, refID, pos, cigarOps in records:
+        if refID not in offsets:
+            writer.flush()
+            offsets[refID] = writer.offset()
+        lSeq = sum([length for op, length in cigarOps if op in 'MIS=X'])
+        cigar = struct.pack('<%iI' % (len(cigarOps)), *[length << 4 |
+                'MIDNSHP=X'.index(op) for op, length in cigarOps])
+        name = qname.encode() + b'\0'
+        core = struct.pack('<iiBBHHHiiii', refID, pos - 1, len(name), 60,
+                reg2bin(pos - 1, pos - 1 + max(1, refSpan(cigarOps))),
+                len(cigarOps), flag, lSeq, -1, -1, 0)
+        data = core + name + cigar + b'\x11' * ((lSeq + 1) // 2) + b'\xff' * lSeq
+        writer.write(struct.pack('<i', len(data)) + data)
+    writer.close()
+    with open(outPath + '.offsets', 'w') as outh:
+        json.dump(offsets, outh)
+
+def writeRegionInputs(outDir, numContigs, seed=1, readLength=100, coverage=20):
+    '''
+    Writes the inputs of nr_contig_depth_vs_length.py to outDir: the
+    coordinate sorted BAM files of a direct library and of an amplified
+    one (at twice the coverage) over numContigs contigs, and a unique
+    regions file in which some contigs have no unique region, and others
+    one or two. Returns the number of alignments in both BAM files.
+    '''
+    rng = random.Random(seed)
+    lengths = [rng.randint(1000, 5000) for i in range(numContigs)]
+    references = [('Contig_%05i_length_%i' % (i + 1, lengths[i]), lengths[i])
+            for i in range(numContigs)]
+    numRecords = 0
+    for bamName, depth in [('dir.sorted.aln.bam', coverage), ('amp.sorted.aln.bam', 2 * coverage)]:
+        records = []
+        for refID, (name, length) in enumerate(references):
+            for r in range(length * depth // readLength):
+                cigarOps = randomCigar(rng, readLength)
+                pos = rng.randint(1, max(1, length - refSpan(cigarOps) + 1))
+                flag = rng.choice([0, 0x10, 0, 0x10, 0x100, 0x400])
+                records.append(('r%i_%i' % (refID, r // 2), flag, refID, pos, cigarOps))
+        records.sort(key=lambda record: (record[2], record[3]))
+        writeSortedBam(os.path.join(outDir, bamName), references, records)
+        numRecords += len(records)
+    with open(os.path.join(outDir, 'nrRegions_min_1kb.txt'), 'w') as outh:
+        for name, length in references:
+            kind = rng.random()
+            if kind < 0.1:
+                outh.write('%s None\n' % (name))
+            elif kind < 0.5 and length > 2200:
+                cut = rng.randint(1000, length - 1100)
+                outh.write('%s:1-%i %s:%i-%i\n' % (name, cut, name, cut + 100, length))
+            else:
+                outh.write('%s:1-%i\n' % (name, length))
+    return(numRecords)
+
+# A stand-in for the two samtools commands that nr_contig_depth_vs_length.py
+# runs with --samtools: 'view [-h] bam regions...' and 'depth -'. It reads
+# the BAM files of writeRegionInputs with bam_reader, seeking to the
+# records of a region's contig with the .offsets file saved alongside. It
+# is only as fast as Python, so times of the --samtools path measure the
+# script and the stand-in together, not samtools.
+SAMTOOLS_STANDIN = '''#! %s
+import json, re, sys
+sys.path.insert(0, %r)
+import bam_coverage, bam_reader
+
+def view(args):
+    header = args[0] == '-h'
+    if header:
+        args = args[1:]
+    bamPath, regions = args[0], [bam_coverage.parseRegion(r) for r in args[1:]]
+    offsets = json.load(open(bamPath + '.offsets'))
+    fileh = open(bamPath, 'rb')
+    reader = bam_reader.bgzf_reader(fileh, background=False)
+    text, references = bam_reader.readBamHeader(reader)
+    if header:
+        sys.stdout.write(text)
+    refIds = dict([(name, i) for i, (name, length) in enumerate(references)])
+    for cName, start, stop in regions:
+        refID = refIds[cName]
+        if str(refID) not in offsets:
+            continue
+        fileh.seek(offsets[str(refID)])
+        reader = bam_reader.bgzf_reader(fileh, background=False)
+        for record in reader.records():
+            rID, pos, lReadName, mapq, bin_, nCigarOp = bam_reader.recordCore(record)[:6]
+            if rID != refID or pos >= stop:
+                break
+            end, blocks = bam_coverage.alignedBlocks(record, pos, lReadName, nCigarOp)
+            if end >= start:
+                sys.stdout.write(bam_reader.recordToSam(record, references) + '\\n')
+
+def depth(args):
+    depths = {}
+    for line in sys.stdin:
+        if line.startswith('@'):
+            continue
+        cols = line.split('\\t')
+        if int(cols[1]) & bam_coverage.DEPTH_SKIP_FLAGS:
+            continue
+        contig = depths.setdefault(cols[2], {})
+        ref = int(cols[3])
+        for length, op in re.findall(r'(\\d+)([MIDNSHP=X])', cols[5]):
+            if op in 'M=X':
+                for p in range(ref, ref + int(length)):
+                    contig[p] = contig.get(p, 0) + 1
+            if op in 'MDN=X':
+                ref += int(length)
+    for name, contig in depths.items():
+        for p in sorted(contig):
+            sys.stdout.write('%%s\\t%%i\\t%%i\\n' %% (name, p, contig[p]))
+
+{'view': view, 'depth': depth}[sys.argv[1]](sys.argv[2:])
+'''
+
+def installSamtoolsStandin(binDir):
+    path = os.path.join(binDir, 'samtools')
+    with open(path, 'w') as outh:
+        outh.write(SAMTOOLS_STANDIN % (sys.executable, REPO_DIR))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+# Runs a script (argv[2:]) as __main__ and, when it exits, writes the
+# peak RSS of the process to the file argv[1]. The rusage of a child
+# can't be used for this on Linux: its peak RSS includes that of the
+# process it was forked from, whereas VmHWM starts again at exec.
+RSS_WRAPPER = '''import atexit, runpy, sys
+rssPath = sys.argv[1]
+def writePeakRss():
+    with open('/proc/self/status') as fileh:
+        peak = [line.split()[1] for line in fileh if line.startswith('VmHWM:')]
+    with open(rssPath, 'w') as outh:
+        outh.write(peak[0] if peak else '0')
+atexit.register(writePeakRss)
+sys.argv = sys.argv[2:]
+sys.path.insert(0, %r)
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+def runScript(args, cwd=None, env=None):
+    '''
+    Runs one of the scripts (args are the script and its arguments) with
+    this Python. Returns the wall time in seconds, the peak RSS of the
+    script's process in kB (worker processes it starts are not included)
+    and the SHA-1 digest of its output.
+    '''
+    with tempfile.TemporaryFile() as outh, tempfile.NamedTemporaryFile('r') as rssh:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, '-c', RSS_WRAPPER % (REPO_DIR),
+                rssh.name] + args, stdout=outh, cwd=cwd, env=env)
+        proc.wait()
+        seconds = time.perf_counter() - start
+        if proc.returncode != 0:
+            raise RuntimeError('%s exited with status %i' % (' '.join(args), proc.returncode))
+        peakRss = int(rssh.read() or 0)
+        outh.seek(0)
+        digest = hashlib.sha1(outh.read()).hexdigest()
+    return(seconds, peakRss, digest)
+
+def benchScripts(name, scales, tmpdir, seed=1, jobs=1, samtoolsPath=False):
+    '''
+    Runs the benchmark of one script at each of the scales and returns a
+    list with the results at each size.
+    '''
+    results = []
+    env = dict(os.environ, PYTHONHASHSEED='0')
+    for scale in scales:
+        size = BASE_SIZES[name] * scale
+        workDir = os.path.join(tmpdir, '%s_%i' % (name, size))
+        os.mkdir(workDir)
+        if name == 'bridging':
+            inPath = os.path.join(workDir, 'namesorted.sam')
+            numRecords = writeBridgingSam(inPath, size, seed=seed)
+            args = [os.path.join(REPO_DIR, 'count_reads_bridging_ends.py'), inPath, '--jobs', str(jobs)]
+        elif name == 'blast':
+            inPath = os.path.join(workDir, 'AVAblastn.txt')
+            numRecords = writeBlastTable(inPath, size, seed=seed)
+            args = [os.path.join(REPO_DIR, 'unique_regions_from_blastn.py'), inPath, '--jobs', str(jobs)]
+        else:
+            numRecords = writeRegionInputs(workDir, size, seed=seed)
+            args = [os.path.join(REPO_DIR, 'nr_contig_depth_vs_length.py'), '--workers', str(jobs),
+                    '--no-cache']
+            if samtoolsPath:
+                binDir = os.path.join(workDir, 'bin')
+                os.mkdir(binDir)
+                installSamtoolsStandin(binDir)
+                env['PATH'] = binDir + os.pathsep + os.environ.get('PATH', '')
+                args.append('--samtools')
+        seconds, peakRss, digest = runScript(args, cwd=workDir, env=env)
+        results.append({'size': size, 'records': numRecords, 'seconds': seconds,
+                'records_per_second': numRecords / seconds, 'peak_rss_kb': peakRss,
+                'output_sha1': digest})
+        shutil.rmtree(workDir)
+    return(results)
+
+def scalingExponent(results):
+    '''
+    The exponent k of time ~ records**k between the smallest and the
+    largest input; 1 is linear scaling. None with a single size.
+    '''
+    if len(results) < 2:
+        return(None)
+    first, last = results[0], results[-1]
+    return(math.log(last['seconds'] / first['seconds']) /
+            math.log(float(last['records']) / first['records']))
+
+def compareBaseline(results, baseline, tolerance):
+    '''
+    Prints how the results compare with a baseline saved with --save, and
+    returns the number of regressions: benchmarks that became slower by
+    more than the tolerance (a fraction) or whose output changed.
+    '''
+    regressions = 0
+    print('Compared with %s' % (baseline['meta'].get('commit')))
+    for name, runs in results.items():
+        if name == 'micro':
+            continue
+        before = dict([(run['size'], run) for run in baseline['results'].get(name, [])])
+        for run in runs:
+            old = before.get(run['size'])
+            if old is None:
+                continue
+            speed = run['records_per_second'] / old['records_per_second']
+            flags = []
+            if speed < 1 - tolerance:
+                flags.append('SLOWER')
+            if run['output_sha1'] != old['output_sha1']:
+                flags.append('OUTPUT CHANGED')
+            regressions += len(flags)
+            print('  %-10s size=%-8i speed x%.2f  peak_rss x%.2f  %s' % (name,
+                    run['size'], speed, float(run['peak_rss_kb']) / old['peak_rss_kb'],
+                    ' '.join(flags)))
+    return(regressions)
+
+def gitCommit():
+    try:
+        return(subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=REPO_DIR, stderr=subprocess.DEVNULL, universal_newlines=True).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+
+def timeIt(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return(time.perf_counter() - start, result)
+
+def drain(iterable):
+    n = 0
+    for group in iterable:
+        n += 1
+    return(n)
+
+def benchReaders(samPath, numLines):
+    results = {}
+    for name, reader in [('legacy_sam_per_read', legacy_sam_per_read),
+            ('sam_per_read', crbe.sam_per_read)]:
+        seconds, groups = timeIt(drain, reader(samPath))
+        results[name] = {'seconds': seconds, 'groups': groups,
+                'lines_per_second': numLines / seconds}
+    return(results)
+
+def benchRecords(samPath, numLines):
+    '''
+    Measures the time to build one record per line, and the memory held
+    per record (including its line) when all of them are kept alive. The
+    flag, pos and rname of every record are read, as the bridge tests do.
+    '''
+    with open(samPath, 'r') as fileh:
+        lines = fileh.readlines()
+    results = {}
+    for name, record in [('legacy_sam_entry', legacy_sam_entry),
+            ('sam_entry', crbe.sam_entry)]:
+        start = time.perf_counter()
+        records = [record(line) for line in lines]
+        buildSeconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for rec in records:
+            rec.flag & 0x10 == 0 and rec.pos > 0 and rec.rname
+        accessSeconds = time.perf_counter() - start
+        del records
+        tracemalloc.start()
+        records = [record(line.encode().decode()) for line in lines]
+        for rec in records:
+            rec.flag & 0x10 == 0 and rec.pos > 0 and rec.rname
+        heldBytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del records
+        results[name] = {'us_per_record': 1e6 * buildSeconds / numLines,
+                'us_field_access': 1e6 * accessSeconds / numLines,
+                'bytes_per_record': heldBytes / numLines}
+    return(results)
+
+def scanOutput(scan, samPath):
+    crbe.setContigs(crbe.contig_table.contigTable(crbe.lenFromContigName))
+    out = io.StringIO()
+    start = time.perf_counter()
+    counts = scan(crbe.openAlignments(samPath), out)
+    seconds = time.perf_counter() - start
+    counts.report(out)
+    counts.reportPruning(out)
+    return(seconds, out.getvalue())
+
+def scalarResults(predicate, pairs):
+    '''
+    The results of a scalar bridge test on (a, b) pairs of sam_entry
+    objects, with None where it raises, as some of them do for pairs that
+    are never tested (see batchPairedReads).
+    '''
+    results = []
+    for a, b in pairs:
+        try:
+            results.append(predicate(a, b))
+        except (AttributeError, TypeError):
+            results.append(None)
+    return(results)
+
+def verifyBatch(samPath, numPairs, seed=1):
+    '''
+    Compares the batch bridge tests of count_reads_bridging_ends.py with
+    the scalar functions: each of them on numPairs pairs of alignments
+    of the SAM file at samPath (half from the same read group, half from
+    anywhere), and the whole output of scanReadGroupsBatch with that of
+    scanReadGroups. Returns a dict of results per test: the number of
+    pairs compared, how many of them the test was true for, how many the
+    scalar function raised for (not compared) and how many differed.
+    '''
+    rng = random.Random(seed)
+    groups = list(crbe.openAlignments(samPath))
+    alns = [a for alns in groups for a in alns]
+    cols = crbe.alignment_columns(groups)
+    ia = []
+    ib = []
+    for k in range(numPairs):
+        if k % 2:
+            g = rng.randrange(len(groups))
+            ia.append(cols.offsets[g] + rng.randrange(len(groups[g])))
+            ib.append(cols.offsets[g] + rng.randrange(len(groups[g])))
+        else:
+            ia.append(rng.randrange(len(alns)))
+            ib.append(rng.randrange(len(alns)))
+    ia = np.array(ia)
+    ib = np.array(ib)
+    pairs = [(alns[i], alns[j]) for i, j in zip(ia, ib)]
+    fa = cols.flag[ia]
+    fb = cols.flag[ib]
+    maxInsertSize = crbe.maxInsertSize
+    tests = [('sameReadForward', crbe.sameReadForward, crbe.batchSameReadForward(fa, fb)),
+            ('sameReadReverse', crbe.sameReadReverse, crbe.batchSameReadReverse(fa, fb)),
+            ('pairedReads', crbe.pairedReads, [[False, 'R1R2', 'R2R1'][kind]
+                    for kind in crbe.batchPairedReads(fa, fb)]),
+            ('singleReadSegmentBridges', crbe.singleReadSegmentBridges,
+                    crbe.batchSingleReadSegmentBridges(cols, ia, ib)),
+            ('pairedReadBridge', lambda a, b: crbe.pairedReadBridge(a, b, maxInsertSize),
+                    crbe.batchPairedReadBridge(cols, ia, ib, maxInsertSize))]
+    results = {}
+    for name, predicate, batch in tests:
+        scalar = scalarResults(predicate, pairs)
+        compared = [(bool(x), bool(y)) for x, y in zip(scalar, batch) if x is not None]
+        results[name] = {'pairs': len(compared), 'true': sum([x for x, y in compared]),
+                'raised': len(scalar) - len(compared),
+                'mismatches': sum([x != y for x, y in compared])}
+    scalarSeconds, scalarOut = scanOutput(crbe.scanReadGroups, samPath)
+    batchSeconds, batchOut = scanOutput(crbe.scanReadGroupsBatch, samPath)
+    results['whole output'] = {'scalar_seconds': scalarSeconds, 'batch_seconds': batchSeconds,
+            'mismatches': int(scalarOut != batchOut)}
+    return(results)
+
+def report(title, results):
+    print(title)
+    for name, res in results.items():
+        print('  %-26s' % (name) + '  '.join(['%s=%s' % (k, ('%.3f' % v) if
+                isinstance(v, float) else v) for k, v in res.items()]))
+
+if __name__ == '__main__':
+    benchmarks = ['micro', 'bridging', 'blast', 'regions']
+    parser = argparse.ArgumentParser(description='Benchmarks for the hts scripts')
+    parser.add_argument('--reads', type=int, default=100000,
+            help='Number of read groups in the synthetic SAM file of the micro benchmarks')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', nargs='+', choices=benchmarks, default=benchmarks,
+            help='Benchmarks to run (default: all)')
+    parser.add_argument('--scales', default='1,4',
+            help='Comma-separated multiples of the base input size of each script '
+            '(%s)' % (', '.join(['%s: %i' % item for item in sorted(BASE_SIZES.items())])))
+    parser.add_argument('--jobs', type=int, default=1,
+            help='Passed to the scripts as --jobs (or --workers)')
+    parser.add_argument('--samtools-path', action='store_true',
+            help='Run nr_contig_depth_vs_length.py with --samtools, using a local '
+            'stand-in for samtools')
+    parser.add_argument('--save', metavar='FILE', help='Save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+            help='Compare the results with a baseline saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+            help='Fraction by which a benchmark may be slower than the baseline '
+            'before it is reported as a regression')
+    parser.add_argument('--verify-batch', action='store_true',
+            help='Only check the batch bridge tests against the scalar ones on a '
+            'library of --reads read pairs')
+    args = parser.parse_args()
+    scales = [int(scale) for scale in args.scales.split(',')]
+
+    if args.verify_batch:
+        tmpdir = tempfile.mkdtemp()
+        samPath = os.path.join(tmpdir, 'namesorted.sam')
+        writeBridgingSam(samPath, args.reads, seed=args.seed)
+        results = verifyBatch(samPath, 2 * args.reads, seed=args.seed)
+        shutil.rmtree(tmpdir)
+        report('Batch against scalar bridge tests', results)
+        sys.exit(1 if sum([res['mismatches'] for res in results.values()]) else 0)
+
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    if 'micro' in args.only:
+        samPath = os.path.join(tmpdir, 'namesorted.sam')
+        numLines = writeNameSortedSam(samPath, args.reads, seed=args.seed)
+        print('%i SAM lines in %i read groups' % (numLines, args.reads), file=sys.stderr)
+        results['micro'] = {'readers': benchReaders(samPath, numLines),
+                'records': benchRecords(samPath, numLines)}
+        report('Name sorted SAM readers', results['micro']['readers'])
+        report('SAM records', results['micro']['records'])
+        os.remove(samPath)
+    for name in benchmarks[1:]:
+        if name not in args.only:
+            continue
+        runs = benchScripts(name, scales, tmpdir, seed=args.seed, jobs=args.jobs,
+                samtoolsPath=args.samtools_path)
+        results[name] = runs
+        exponent = scalingExponent(runs)
+        report('%s (time ~ records^%s)' % (name, 'n/a' if exponent is None else
+                '%.2f' % (exponent)), dict([('size=%i' % (run['size']),
+                dict([item for item in run.items() if item[0] != 'size']))
+                for run in runs]))
+    shutil.rmtree(tmpdir)
+
+    if args.save:
+        meta = {'commit': gitCommit(), 'python': platform.python_version(),
+                'seed': args.seed, 'scales': scales, 'jobs': args.jobs,
+                'samtools_path': args.samtools_path, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with open(args.save, 'w') as outh:
+            json.dump({'meta': meta, 'results': results}, outh, indent=1)
+    if args.compare:
+        with open(args.compare, 'r') as inh:
+            baseline = json.load(inh)
+        if compareBaseline(results, baseline, args.tolerance):
+            sys.exit(1)
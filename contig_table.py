@@ -0,0 +1,95 @@
+#! /usr/bin/python3
+
+# Author: Patrick Denis Browne
+# e-mail: pdbr@plen.ku.dk
+# Licensed under the terms of the GNU General Public License v3.0
+
+# A table of contig lengths shared by the scripts in this repository.
+# The lengths are loaded once, from the @SQ lines of a SAM header, the
+# references of a BAM file or a samtools faidx (.fai) index, instead of
+# being parsed out of SPAdes-style contig names for every comparison.
+# Each contig name is interned to an integer ID, so that hot loops can
+# compare and index by ints instead of strings.
+
+import bam_reader
+
+class contigTable:
+    '''
+    names[i] and lengths[i] are the name and length of the contig with
+    ID i. Contigs that are looked up without having been loaded are added
+    on the fly, with the length returned by lengthFromName (a function of
+    the contig name), or None if no such function was given.
+    '''
+    def __init__(self, lengthFromName=None):
+        self.names = []
+        self.lengths = []
+        self.ids = {}
+        self.lengthFromName = lengthFromName
+
+    def __len__(self):
+        return(len(self.names))
+
+    def add(self, name, length):
+        '''
+        Adds a contig and returns its ID. If the contig is already in the
+        table its ID is returned, and its length is only set if it was not
+        known yet.
+        '''
+        cid = self.ids.get(name)
+        if cid is None:
+            cid = len(self.names)
+            self.ids[name] = cid
+            self.names.append(name)
+            self.lengths.append(length)
+        elif self.lengths[cid] is None:
+            self.lengths[cid] = length
+        return(cid)
+
+    def intern(self, name):
+        '''
+        Returns the ID of the contig, adding it if it isn't in the table.
+        '''
+        cid = self.ids.get(name)
+        if cid is None:
+            if self.lengthFromName is None:
+                length = None
+            else:
+                length = self.lengthFromName(name)
+            cid = self.add(name, length)
+        return(cid)
+
+    def length(self, name):
+        return(self.lengths[self.intern(name)])
+
+    def addSamHeader(self, lines):
+        '''
+        Adds the contigs of the @SQ lines among the SAM header lines.
+        '''
+        for line in lines:
+            if not line.startswith('@SQ'):
+                continue
+            fields = dict([field.split(':', 1) for field in
+                    line.rstrip('\n').split('\t')[1:] if ':' in field])
+            self.add(fields['SN'], int(fields['LN']))
+
+    def addFai(self, faiPath):
+        '''
+        Adds the contigs of a samtools faidx index (name and length are
+        its first two columns).
+        '''
+        with open(faiPath, 'r') as fileh:
+            for line in fileh:
+                cols = line.rstrip('\n').split('\t')
+                if len(cols) >= 2:
+                    self.add(cols[0], int(cols[1]))
+
+    def addBam(self, bamPath):
+        '''
+        Adds the references of a BAM file, in the order of their IDs. Only
+        the header is read.
+        '''
+        with open(bamPath, 'rb') as fileh:
+            reader = bam_reader.bgzf_reader(fileh, background=False)
+            text, references = bam_reader.readBamHeader(reader)
+        for name, length in references:
+            self.add(name, length)
@@ -4,32 +4,166 @@
 # e-mail: pdbr@plen.ku.dk
 # Licensed under the terms of the GNU General Public License v3.0
 
+import functools
+import io
+import itertools
+import mmap
+import multiprocessing
+import operator
+import os
 import re
+import shutil
+import sys
+import tempfile
+import zlib
+
+import bam_reader
+import contig_table
+import instrument
+
 maxInsertSize = 500
+# Run the bridge tests in batches with scanReadGroupsBatch (--batch). Only
+# the functions of the batch tests import NumPy, so the script runs without
+# it otherwise.
+useBatch = False
+# Memory-map uncompressed SAM files on disk (see mapped_sam_per_read) rather
+# than reading them through a buffer (--mmap). It is no faster so far, so it
+# is off by default.
+useMmap = False
+
+def _samColumn(index, isInt=False):
+    '''
+    Builds a read-only property returning column 'index' of a sam_entry.
+    These columns are not cached; the line is split again each time one
+    of them is accessed, which is cheap for columns that are rarely
+    looked at.
+    '''
+    def fget(self):
+        col = self._split()[index]
+        if isInt:
+            return(int(col))
+        if col.__class__ is bytes:
+            return(col.decode())
+        return(col)
+    return(property(fget))
 
 class sam_entry:
+    '''
+    One SAM-format alignment. The line (str, or bytes which are decoded
+    on demand) is kept as it was read and nothing is split or converted
+    until a field is first accessed. The fields the bridge tests look at
+    (flag, rname, pos and cigar) are then cut out of the line in one
+    split and cached; all other fields are re-read from the line when
+    asked for. The parsed CIGAR and the contig ID (see parsedCigar and
+    rid) are cached as well.
+    Checking that the line has all eleven mandatory fields is
+    therefore also deferred to the first field access.
+    
+    For a 150 nt paired read (see benchmark_hts.py), building a record
+    takes about 1.0 us, reading its flag, pos and rname another 1.4 us,
+    and the record then holds about 0.65 kB including its line. The
+    previous class, which split every line up front and kept both the
+    columns and eleven attributes, took about 4.8 us and 0.97 kB.
+    '''
+    __slots__ = ('line', '_flag', '_rname', '_pos', '_cigar', '_cigarObj', '_rid')
+    
     def __init__(self, line):
-        if line.startswith('@'):
-            raise ValueError('Only headless SAM files are supported.')
-        line = line.rstrip('\n')
-        self.__cols = line.split('\t')
-        assert len(self.__cols) >= 11, "Line has too few fields for SAM format\n%s" % (line)
-        for i in [1, 3, 4, 7, 8]:
-            self.__cols[i] = int(self.__cols[i])
-        self.qname = self.__cols[0]
-        self.flag = self.__cols[1]
-        self.rname = self.__cols[2]
-        self.pos = self.__cols[3]
-        self.mapq = self.__cols[4]
-        self.cigar = self.__cols[5]
-        self.rnext = self.__cols[6]
-        self.pnext = self.__cols[7]
-        self.tlen = self.__cols[8]
-        self.seq = self.__cols[9]
-        self.qual = self.__cols[10]
+        if line.__class__ is bytes:
+            self.line = line.rstrip(b'\n')
+        else:
+            self.line = line.rstrip('\n')
+        self._flag = None
+        self._cigarObj = None
+        self._rid = None
+    
+    def _split(self):
+        if self.line.__class__ is bytes:
+            cols = self.line.split(b'\t')
+        else:
+            cols = self.line.split('\t')
+        assert len(cols) >= 11, "Line has too few fields for SAM format\n%s" % (self)
+        return(cols)
+    
+    def _parseCore(self):
+        if self.line.__class__ is bytes:
+            cols = self.line.split(b'\t', 6)
+            assert len(cols) == 7 and cols[6].count(b'\t') >= 4, \
+            "Line has too few fields for SAM format\n%s" % (self)
+            self._rname = cols[2].decode()
+            self._cigar = cols[5].decode()
+        else:
+            cols = self.line.split('\t', 6)
+            assert len(cols) == 7 and cols[6].count('\t') >= 4, \
+            "Line has too few fields for SAM format\n%s" % (self)
+            self._rname = cols[2]
+            self._cigar = cols[5]
+        self._pos = int(cols[3])
+        self._flag = int(cols[1])
+    
+    @property
+    def flag(self):
+        if self._flag is None:
+            self._parseCore()
+        return(self._flag)
+    
+    @property
+    def rname(self):
+        if self._flag is None:
+            self._parseCore()
+        return(self._rname)
+    
+    @property
+    def pos(self):
+        if self._flag is None:
+            self._parseCore()
+        return(self._pos)
+    
+    @property
+    def cigar(self):
+        if self._flag is None:
+            self._parseCore()
+        return(self._cigar)
+    
+    @property
+    def parsedCigar(self):
+        '''
+        The cigar object of this alignment. It is looked up once per
+        record, so every pair comparison within a read group reuses it.
+        '''
+        if self._cigarObj is None:
+            self._cigarObj = parseCigar(self.cigar)
+        return(self._cigarObj)
+    
+    @property
+    def rid(self):
+        '''
+        The integer ID of rname in the contig table (see contigs).
+        '''
+        if self._rid is None:
+            self._rid = contigs.intern(self.rname)
+        return(self._rid)
+    
+    qname = _samColumn(0)
+    mapq = _samColumn(4, isInt=True)
+    rnext = _samColumn(6)
+    pnext = _samColumn(7, isInt=True)
+    tlen = _samColumn(8, isInt=True)
+    seq = _samColumn(9)
+    qual = _samColumn(10)
+    
+    def readName(self):
+        '''
+        The read name as it is in the line (str or bytes), for grouping
+        the alignments of a read without parsing anything else.
+        '''
+        if self.line.__class__ is bytes:
+            return(self.line[:self.line.find(b'\t')])
+        return(self.line[:self.line.find('\t')])
     
     def __str__(self):
-        return('\t'.join([str(col) for col in self.__cols]))
+        if self.line.__class__ is bytes:
+            return(self.line.decode())
+        return(self.line)
 
 class cigar: # Cannot parse no CIGAR string represeted by '*'
     def __init__(self, cigarString):
@@ -38,320 +172,1317 @@ class cigar: # Cannot parse no CIGAR string represeted by '*'
         If no CIGAR string was calculated for the alignment it will be
         represented by a '*'. This class will not parse such a string
         correctly.
+        
+        The read length, the alignment length and the span of the read
+        that is aligned are all worked out in a single pass over the
+        operations, so the cost depends on the number of operations and
+        not on the length of the read. Instances are shared between
+        alignments by parseCigar and must not be modified.
         '''
         self.cigarString = cigarString
         if not self.cigarString == '*':
             self.subCigarStrings = re.findall(r'\d+[MINDSHPX=]', self.cigarString)
-            self.parts = [[a[-1:], int(a[:-1])] for a in self.subCigarStrings]
-            self.readLength = self.__readLength()
-            self.alnLength = self.__alnLength()
+            self.parts = [(a[-1:], int(a[:-1])) for a in self.subCigarStrings]
+            readLength = 0
+            alnLength = 0
+            matchStart = None
+            matchStop = None
+            for op, opLen in self.parts:
+                if op in 'MIX=':
+                    if matchStart is None and opLen > 0:
+                        matchStart = readLength + 1
+                    readLength += opLen
+                    if opLen > 0:
+                        matchStop = readLength
+                elif op == 'S':
+                    readLength += opLen
+                if op in 'MDN=X':
+                    alnLength += opLen
+            self.readLength = readLength
+            self.alnLength = alnLength
+            if matchStart is None:
+                self.__matchStartStop = None
+            else:
+                self.__matchStartStop = (matchStart, matchStop)
         else:
             self.subCigarStrings = None
             self.parts = None
             self.readLength = None
             self.alnLength = None
-    
-    def __readLength(self):
-        '''
-        Calculates the length of the read based on the CIGAR string
-        '''
-        l = 0
-        for part in self.parts:
-            if part[0] in ['M', 'I', 'S', 'X', '=']:
-                l += part[1]
-        return(l)
-    
-    def __alnLength(self):
-        '''
-        Calculates the length of the alignment based on the CIGAR string
-        '''
-        l = 0
-        for part in self.parts:
-            if part[0] in ['M', 'D', 'N', '=', 'X']:
-                l += part[1]
-        return(l)
+            self.__matchStartStop = None
     
     def readMatchStartStop(self):
         '''
         Returns the minimum and maximum coordinates along the read at
         which are aligned to the reference.
         '''
-        if self.readLength == None:
-            return(None)
-        poss = [i+1 for i in range(self.readLength)]
-        i = 0
-        subs = []
-        for part in self.parts:
-            if part[0] == 'S':
-                for j in range(part[1]):
-                    subs.append(i)
-                    i += 1
-            if part[0] in ['M', 'I', 'X', '=']:
-                for j in range(part[1]):
-                    i += 1
-        subs.reverse()
-        for i in subs:
-            _ = poss.pop(i)
-        if len(poss) == 0:
-            return(None)
-        return(min(poss), max(poss))
-        
-        
+        return(self.__matchStartStop)
 
-class sam_per_read:
-    """
-    Input:   A headless SAM file of namesorted reads. This could be made
-             with samtools' sort function with the '-n' flag enabled. If
-             any other filtering, e.g. based on bitwise flags or if you
-             want all entries of each read mapped to a single template,
-             the data needs to be preprocessed with samtools or another
-             suitable tool. Python will generally be much too slow for
-             this kind of task.
-    
-    Returns: An iterable yielding 2D lists of SAM-format alignments by
-             read-name. The number of lists in the returned list will be
-             the number of alignments for that read.
-    """
-    def __init__(self,filePath):
-        self.fileh = open(filePath,'r')
-        self.cursor_pos = self.fileh.tell()
+@functools.lru_cache(maxsize=4096)
+def parseCigar(cigarString):
+    '''
+    Returns the cigar object for cigarString. Most reads of a library
+    share a small number of CIGAR strings, so the objects are kept in an
+    LRU cache and shared.
+    '''
+    return(cigar(cigarString))
+
+readNameOf = operator.methodcaller('readName')
+
+def groupByRead(alignments):
+    '''
+    Groups consecutive sam_entry objects with the same read name (see
+    sam_entry.readName) into lists. itertools.groupby holds the first
+    alignment of the next read back as a one-record lookahead, so the
+    alignments are read once, in order.
+    '''
+    for qname, alns in itertools.groupby(alignments, readNameOf):
+        yield(list(alns))
+
+def groupInMemory(alignments):
+    '''
+    Groups sam_entry objects in any order by read name, in memory.
+    Returns the lists of the alignments of each read, in the order each
+    read was first seen.
+    '''
+    groups = {}
+    for aln in alignments:
+        groups.setdefault(aln.readName(), []).append(aln)
+    return(groups.values())
+
+class read_groups:
+    '''
+    The base of the readers below, which are iterables yielding lists of
+    sam_entry objects by read name. A reader supplies alignments(), a
+    generator of its sam_entry objects that closes the input once it is
+    exhausted, which are grouped by groupByRead, or overrides groups().
+    '''
+    _groups = None
     
     def __iter__(self):
         return(self)
     
-    def next(self):
-        currlines = [self.fileh.readline().rstrip('\n').split('\t')]
-        self.cursor_pos = self.fileh.tell()
-        if currlines == [['']]:
-            raise StopIteration
-        while self.fileh.readline().rstrip('\n').split('\t')[0] == currlines[0][0]:
-            self.fileh.seek(self.cursor_pos)
-            currlines.append(self.fileh.readline().rstrip('\n').split('\t'))
-            self.cursor_pos = self.fileh.tell()
-        self.fileh.seek(self.cursor_pos)
-        return(currlines)
-        
-        
+    def __next__(self):
+        if self._groups is None:
+            self._groups = self.groups()
+        return(next(self._groups))
+    
+    next = __next__
+    
+    def groups(self):
+        return(groupByRead(self.alignments()))
 
-if __name__ == "__main__":
-    import sys
-    usage = '''reads_overlap_point.py aln.sam
-    It only looks for reads overlapping the origin.
-    The SAM file must be in plain text (BAM not supported) and headless
-    (lines starting with '@' throw an exception).
-    '''
-    if '-h' in sys.argv or '--h' in sys.argv or '-help' in sys.argv or \
-    '--help' in sys.argv:
-        print(usage)
-        quit()
-    if len(sys.argv) > 2:
-        print(usage)
-        quit()
-    
-    def lenFromContigName(contigNameStr):
-        a = re.search(r'_length_(\d+)_', contigNameStr)
-        if a == None:
-            return(None)
-        else:
-            return(int(a.group(1)))
+class sam_per_read(read_groups):
+    """
+    Input:   A SAM file of namesorted reads, with or without a header.
+             This could be made with samtools' sort function with the
+             '-n' flag enabled. If any other filtering, e.g. based on
+             bitwise flags or if you want all entries of each read mapped
+             to a single template, the data needs to be preprocessed with
+             samtools or another suitable tool. Python will generally be
+             much too slow for this kind of task.
+             The file may be plain text or gzip compressed, and '-' reads
+             from stdin, so the output of samtools can be piped straight
+             in. If the file has a header, its @SQ lines are added to the
+             contig table.
     
-    def isR1(sam_entry_obj):
-        '''
-        If the "segment unmapped" (0x4) and the "SEQ being reverse
-        complemented" flags are NOT set, this returns True. Otherwise
-        this returns False.
-        '''
-        if sam_entry_obj.flag & 0x4 == 0 and \
-        sam_entry_obj.flag & 0x10 == 0:
-            return(True)
-        else:
-            return(False)
+    Returns: An iterable yielding lists of sam_entry objects by
+             read-name. The number of entries in the returned list will
+             be the number of alignments for that read.
     
-    def isR2(sam_entry_obj):
-        '''
-        If the "segment unmapped" (0x4) flas is NOT set and the "SEQ
-        being reverse complemented" flags are IS set, this returns True.
-        Otherwise this returns False.
-        '''
-        if sam_entry_obj.flag & 0x4 == 0 and \
-        sam_entry_obj.flag & 0x10 == 1:
-            return(True)
+    Each line is read exactly once and only the read name is cut out of
+    it here; the other fields are parsed lazily by sam_entry. The first
+    line of the next read is held back as a one-record lookahead, so the
+    input is never seeked and does not need to be a regular file.
+    """
+    def __init__(self,filePath):
+        self.fileh = bam_reader.openInput(filePath)
+        self.position, self.size = instrument.fileProgress(self.fileh)
+        self.header = []
+        lines = iter(self.fileh)
+        for line in lines:
+            if not line.startswith('@'):
+                lines = itertools.chain([line], lines)
+                break
+            self.header.append(line)
+        contigs.addSamHeader(self.header)
+        self.__lines = lines
+    
+    def alignments(self):
+        for line in self.__lines:
+            if line != '\n':
+                yield(sam_entry(line))
+        if self.fileh is not sys.stdin:
+            self.fileh.close()
+
+class mapped_sam_per_read(read_groups):
+    '''
+    The same as sam_per_read, but for an uncompressed SAM file on disk,
+    which is memory-mapped instead of being read as text. Line ends and
+    read names are found with bytes.find on the mapping and each line is
+    handed to sam_entry as bytes, so only the fields the bridge tests use
+    (flag, rname, pos and cigar, plus the read name for grouping) are ever
+    decoded; a whole line is only decoded when it is printed as a hit.
+    With start and end, only the alignments in that byte range are read
+    (see shardOffsets) and the header is skipped; otherwise its @SQ lines
+    are added to the contig table.
+    '''
+    def __init__(self, filePath, start=None, end=None):
+        if start is None:
+            self.header, start = readSamHeader(filePath)
+            contigs.addSamHeader(self.header)
         else:
-            return(False)
+            self.header = []
+        self.fileh = open(filePath, 'rb')
+        if os.fstat(self.fileh.fileno()).st_size == 0:
+            # An empty file can't be memory-mapped
+            self.data = b''
+        else:
+            self.data = mmap.mmap(self.fileh.fileno(), 0, access=mmap.ACCESS_READ)
+        if end is None:
+            end = len(self.data)
+        self.start = start
+        self.end = end
+        self.size = end - start
+        self.__offset = start
+    
+    def position(self):
+        return(self.__offset - self.start)
     
-    def sameReadForward(a, b):
+    def __lines(self, chunkSize=1 << 22):
         '''
-        a and b are both sam_entry objects.
-        It will be assessed if:
-            a and b are both mapped
-            a and b are both R1 or both R2
-            a and b both map in the forward orientation
+        Yields the lines of the byte range as bytes, without line ends.
+        The mapping is cut into chunks of about chunkSize bytes at line
+        ends, and each chunk is split into lines in one go.
         '''
-        if a.flag & 0x4 == 0 and b.flag & 0x4 == 0 and \
-        a.flag & 0x40 == b.flag & 0x40 and \
-        a.flag & 0x10 == 0 and b.flag & 0x10 == 0:
-            return(True)
+        data = self.data
+        offset = self.start
+        end = self.end
+        while offset < end:
+            chunkEnd = min(offset + chunkSize, end)
+            if chunkEnd < end:
+                chunkEnd = data.rfind(b'\n', offset, chunkEnd) + 1
+                if chunkEnd <= offset:
+                    chunkEnd = data.find(b'\n', offset + chunkSize, end) + 1 or end
+            lines = data[offset:chunkEnd].split(b'\n')
+            offset = chunkEnd
+            self.__offset = offset
+            if lines[-1] == b'':
+                lines.pop()
+            for line in lines:
+                yield(line)
+    
+    def alignments(self):
+        for line in self.__lines():
+            if line[-1:] == b'\r':
+                line = line[:-1]
+            if line:
+                yield(sam_entry(line))
+        if self.data:
+            self.data.close()
+        self.fileh.close()
+
+class bam_entry(sam_entry):
+    '''
+    A sam_entry decoded from a BAM record. The fields the bridge tests use
+    are unpacked directly from the binary record; the SAM-format line is
+    only built when the entry is printed or another field is asked for.
+    '''
+    __slots__ = ('_record', '_references')
+    
+    def __init__(self, record, references, refIds):
+        refID, pos, lReadName, mapq, bin_, nCigarOp, flag = \
+        bam_reader.recordCore(record)[:7]
+        self.line = None
+        self._record = record
+        self._references = references
+        self._flag = flag
+        self._pos = pos + 1
+        if refID < 0:
+            self._rname = '*'
+            self._rid = None
         else:
-            return(False)
+            self._rname = references[refID][0]
+            self._rid = refIds[refID]
+        self._cigar = bam_reader.cigarString(record, lReadName, nCigarOp)
+        self._cigarObj = None
     
-    def sameReadReverse(a, b):
-        '''
-        a and b are both sam_entry objects.
-        It will be assessed if:
-            a and b are both mapped
-            a and b are both R1 or both R2
-            a and b both map in the reverse orientation
-        '''
-        if a.flag & 0x4 == 0 and b.flag & 0x4 == 0 and \
-        a.flag & 0x40 == b.flag & 0x40 and \
-        a.flag & 0x10 != 0 and b.flag & 0x10 == 1:
-            return(True)
+    def _split(self):
+        if self.line is None:
+            self.line = bam_reader.recordToSam(self._record, self._references)
+        return(sam_entry._split(self))
+    
+    def readName(self):
+        return(self._record[32:31 + self._record[8]])
+    
+    def __str__(self):
+        if self.line is None:
+            self.line = bam_reader.recordToSam(self._record, self._references)
+        return(self.line)
+
+class bam_per_read(read_groups):
+    '''
+    The same as sam_per_read, but for a BAM file of namesorted reads,
+    which is read directly instead of being converted to SAM text first.
+    The BAM references are added to the contig table.
+    The BGZF blocks are decompressed in a background thread while the
+    read groups are being analysed. '-' reads from stdin.
+    
+    Returns: An iterable yielding lists of bam_entry objects by read-name.
+    '''
+    def __init__(self, filePath):
+        if filePath == '-':
+            fileh = sys.stdin.buffer
         else:
-            return(False)
+            fileh = open(filePath, 'rb')
+        self.position, self.size = instrument.fileProgress(fileh)
+        self.reader = bam_reader.bgzf_reader(fileh)
+        self.header, self.references = bam_reader.readBamHeader(self.reader)
+        self.refIds = [contigs.add(name, length) for name, length in self.references]
     
-    def pairedReads(a, b):
-        '''
-        a and b are both sam_entry objects.
-        It will be assessed if:
-            a and b are both mapped
-            a and b are both paired
-            (a is first segment and b is second segment) OR
-            (a is second segment and b is first segment)
-        It will return False if any of the above evaluate as False
-        It will return 'R1R2' if a is R1 and b is R2.
-        It will return 'R2R1' if a is R2 and b is R1.
-        '''
-        if a.flag & 0x1 != 0 and b.flag & 0x1 != 0 and \
-        a.flag & 0x4 != 0 and b.flat & 0x4 != 0:
-            pass
+    def alignments(self):
+        references = self.references
+        refIds = self.refIds
+        for record in self.reader.records():
+            yield(bam_entry(record, references, refIds))
+        if self.reader.fileh is not sys.stdin.buffer:
+            self.reader.close()
+
+def baiPath(bamPath):
+    '''
+    The .bai index of a BAM file (file.bam.bai or file.bai), or None.
+    '''
+    for path in [bamPath + '.bai', os.path.splitext(bamPath)[0] + '.bai']:
+        if os.path.exists(path):
+            return(path)
+    return(None)
+
+def endWindows(length, window):
+    '''
+    The 0-based, half-open ranges of start positions within window of
+    the start and of the end of a contig, as one range if they meet.
+    '''
+    if length - window <= window:
+        return([(0, length)])
+    return([(0, window), (length - window, length)])
+
+class window_bam_per_read(read_groups):
+    '''
+    Read groups of the alignments near the ends of the contigs of a
+    coordinate sorted, indexed BAM file. Only alignments starting within
+    window positions of either end of a contig can pass
+    singleReadSegmentBridges (if window is at least the read length) or
+    pairedReadBridge (if it is at least maxInsertSize), so only those are
+    read, by seeking to the chunks the .bai index gives for the two end
+    windows of each contig. They are grouped by read name in memory, and
+    the groups come in the order their first alignment was read.
+    The groups only hold the alignments in the windows, so the number of
+    read groups (Total) only counts reads with an alignment there; the
+    hits are those of a scan of the whole file, though the two alignments
+    of a hit are written in coordinate order.
+    '''
+    def __init__(self, filePath, window):
+        indexPath = baiPath(filePath)
+        if indexPath is None:
+            raise ValueError('%s has no .bai index (see samtools index)' % (filePath))
+        self.fileh = open(filePath, 'rb')
+        reader = bam_reader.bgzf_reader(self.fileh, background=False)
+        self.header, self.references = bam_reader.readBamHeader(reader)
+        if 'SO:queryname' in self.header.split('\n')[0]:
+            raise ValueError('%s is sorted by read name, not by coordinate' % (filePath))
+        self.refIds = [contigs.add(name, length) for name, length in self.references]
+        self.bam = bam_reader.indexed_bam(self.fileh, bam_reader.readBai(indexPath))
+        self.window = window
+    
+    def alignments(self):
+        references = self.references
+        refIds = self.refIds
+        for refID in range(len(references)):
+            for beg, end in endWindows(references[refID][1], self.window):
+                for record in self.bam.recordsStartingIn(refID, beg, end):
+                    yield(bam_entry(record, references, refIds))
+        self.fileh.close()
+    
+    def groups(self):
+        metrics = instrument.metrics
+        with metrics.stage('reading contig end windows'):
+            groups = groupInMemory(self.alignments())
+        metrics.count('read groups in the end windows', len(groups))
+        metrics.count('compressed BAM bytes read', self.bam.bytesRead)
+        return(iter(groups))
+
+def partitionLines(lines, prefix, numPartitions, bufferBytes, seed=0):
+    '''
+    Writes SAM lines (bytes) to numPartitions spill files, prefix_00000.sam
+    and on, by the crc32 (started from seed) of their read name, so that
+    all the alignments of a read end up in the same file, in input order.
+    Lines are buffered in memory and the buffers written out whenever
+    they hold more than bufferBytes. Returns the paths of the files.
+    '''
+    paths = ['%s_%05i.sam' % (prefix, k) for k in range(numPartitions)]
+    buffers = [[] for k in range(numPartitions)]
+    buffered = 0
+    handles = [open(path, 'wb', buffering=0) for path in paths]
+    try:
+        for line in lines:
+            if line[-1:] != b'\n':
+                line += b'\n'
+            k = zlib.crc32(line[:line.find(b'\t')], seed) % numPartitions
+            buffers[k].append(line)
+            buffered += len(line)
+            if buffered > bufferBytes:
+                for k in range(numPartitions):
+                    handles[k].write(b''.join(buffers[k]))
+                    buffers[k] = []
+                buffered = 0
+        for k in range(numPartitions):
+            handles[k].write(b''.join(buffers[k]))
+    finally:
+        for fileh in handles:
+            fileh.close()
+    return(paths)
+
+def spillFileCount(size, partitionBytes, maxFiles=256):
+    '''
+    The number of spill files to split size bytes of alignments into, so
+    that each can be grouped within partitionBytes (see partitionGroups),
+    but no more than maxFiles at once; files that are still too big are
+    split again by partitionGroups.
+    '''
+    return(max(1, min(maxFiles, size * 3 // partitionBytes + 1)))
+
+def partitionGroups(path, partitionBytes, seed=1):
+    '''
+    Yields the read groups (lists of sam_entry objects, in input order)
+    of one spill file, grouped in memory in the order each read was first
+    seen. The spill file is deleted once read. Grouping takes up to about
+    two and a half times the size of the file, so a file bigger than a
+    third of partitionBytes is first split again, with another seed; a
+    single read bigger than that is grouped anyway.
+    '''
+    size = os.path.getsize(path)
+    if size > partitionBytes // 3:
+        with open(path, 'rb') as fileh:
+            parts = partitionLines(fileh, os.path.splitext(path)[0],
+                    spillFileCount(size, partitionBytes), partitionBytes // 3, seed)
+        os.remove(path)
+        if max([os.path.getsize(part) for part in parts]) < size:
+            for part in parts:
+                for alns in partitionGroups(part, partitionBytes, seed + 1):
+                    yield(alns)
+            return
+        # All the alignments have the same read name
+        path = [part for part in parts if os.path.getsize(part)][0]
+        for part in parts:
+            if part != path:
+                os.remove(part)
+    with open(path, 'rb') as fileh:
+        lines = fileh.read().split(b'\n')
+    os.remove(path)
+    groups = groupInMemory(sam_entry(line) for line in lines if line)
+    del lines
+    for alns in groups:
+        yield(alns)
+
+class unsorted_sam_per_read(read_groups):
+    '''
+    Read groups of a SAM file in any order (e.g. sorted by coordinate),
+    plain or gzip compressed, or of a BAM file, whose records are
+    formatted as SAM lines, or '-' for stdin, grouped by read name with
+    external memory instead of needing samtools sort -n first. The
+    alignments are first hash-partitioned by read name into spill files
+    in a temporary directory under spillDir (see partitionLines), each
+    small enough to be grouped in memory within partitionBytes (see
+    spillFileCount and partitionGroups). The groups of each partition
+    then come in the order their first alignment was read, and partition
+    by partition. partitions holds the spill files, for scanPartitions;
+    iterating groups them in this process. The directory is removed once
+    all the partitions have been read, or by cleanup.
+    '''
+    def __init__(self, filePath, partitionBytes, spillDir=None):
+        self.partitionBytes = partitionBytes
+        size = None
+        if isBamPath(filePath):
+            if filePath == '-':
+                fileh = sys.stdin.buffer
+            else:
+                fileh = open(filePath, 'rb')
+            reader = bam_reader.bgzf_reader(fileh)
+            text, references = bam_reader.readBamHeader(reader)
+            self.header = text.splitlines(True)
+            for name, length in references:
+                contigs.add(name, length)
+            lines = (bam_reader.recordToSam(record, references).encode()
+                    for record in reader.records())
+            if filePath != '-':
+                # BAM is about a quarter of the size of the SAM text; spill
+                # files that still come out too big are split again
+                size = os.path.getsize(filePath) * 4
         else:
-            return(False)
-        if a.flag & 0x40 == 0 and b.flag & 0x80 == 0:
-            return('R1R2')
-        elif a.flag & 0x80 == 0 and b.flag & 0x40 == 0:
-            return('R2R1')
+            fileh = bam_reader.openInput(filePath, text=False)
+            self.header = []
+            lines = iter(fileh)
+            for line in lines:
+                if not line.startswith(b'@'):
+                    lines = itertools.chain([line], lines)
+                    break
+                self.header.append(line.decode())
+            contigs.addSamHeader(self.header)
+            if filePath != '-' and isShardable(filePath):
+                size = os.path.getsize(filePath)
+        if size is None:
+            numPartitions = 64
         else:
-            return(False)
+            numPartitions = spillFileCount(size, partitionBytes)
+        self.spillDir = tempfile.mkdtemp(prefix='bridging_', dir=spillDir)
+        try:
+            with instrument.metrics.stage('partitioning alignments by read name'):
+                self.partitions = partitionLines(lines, os.path.join(self.spillDir, 'part'),
+                        numPartitions, partitionBytes // 3)
+        except BaseException:
+            self.cleanup()
+            raise
+        if fileh is not sys.stdin.buffer:
+            fileh.close()
+        instrument.metrics.count('spill files', numPartitions)
     
-    def singleReadSegmentBridges(a,b):
-        '''
-        a and b are both sam_entry objects
-        '''
-        # See if a and b are validly mapped, either both R1s or R2s and
-        # mapped in the same orientat
-        if sameReadForward(a, b) == True:
-            strand = 'forward'
-        elif sameReadReverse(a, b) == True:
-            strand = 'reverse'
-        else:
-            return(False)
-        
-        # Make sure a and b are mapped to the same template
-        if a.rname != b.rname:
-            return(False)
-        template_length = lenFromContigName(a.rname)
-        
-        aCigar = cigar(a.cigar)
-        bCigar = cigar(b.cigar)
-        read_length = aCigar.readLength
-        
-        if aCigar.readMatchStartStop() == None \
-        or bCigar.readMatchStartStop() == None:
-            return(False)
-        
-        if aCigar.readMatchStartStop()[1] < bCigar.readMatchStartStop()[0] and \
-        a.pos > b.pos + bCigar.alnLength and strand == 'forward':
-            if template_length - a.pos + b.pos + bCigar.alnLength <= read_length:
-                return(True)
-        
-        if bCigar.readMatchStartStop()[1] < aCigar.readMatchStartStop()[0] and \
-        b.pos > a.pos + aCigar.alnLength and strand == 'forward':
-            if template_length - b.pos + a.pos + aCigar.alnLength <= read_length:
-                return(True)
-        
-        if aCigar.readMatchStartStop()[1] < bCigar.readMatchStartStop()[0] and \
-        a.pos + aCigar.alnLength < b.pos and strand == 'reverse':
-            if template_length - b.pos + a.pos + aCigar.alnLength <= read_length:
-                return(True)
-        
-        if bCigar.readMatchStartStop()[1] < aCigar.readMatchStartStop()[0] and \
-        b.pos + bCigar.alnLength < a.pos and strand == 'reverse':
-            if template_length - a.pos + b.pos + bCigar.alnLength <= read_length:
-                return(True)
-        
+    def groups(self):
+        try:
+            for path in self.partitions:
+                for alns in partitionGroups(path, self.partitionBytes):
+                    yield(alns)
+        finally:
+            self.cleanup()
+    
+    def cleanup(self):
+        shutil.rmtree(self.spillDir, ignore_errors=True)
+
+def isBamPath(filePath):
+    '''
+    Tells if filePath ('-' for stdin) holds BAM data, without consuming
+    any of stdin.
+    '''
+    if filePath == '-':
+        return(bam_reader.isBam(sys.stdin.buffer))
+    with open(filePath, 'rb') as fileh:
+        return(bam_reader.isBam(fileh))
+
+def openAlignments(filePath):
+    '''
+    Returns a sam_per_read or a bam_per_read iterator for filePath,
+    depending on whether it holds SAM text (plain or gzip compressed) or
+    BAM. '-' is stdin. With useMmap, an uncompressed SAM file on disk is
+    memory-mapped (see mapped_sam_per_read).
+    '''
+    if isBamPath(filePath):
+        return(bam_per_read(filePath))
+    if useMmap and isShardable(filePath) and os.path.getsize(filePath) > 0:
+        return(mapped_sam_per_read(filePath))
+    return(sam_per_read(filePath))
+
+def lenFromContigName(contigNameStr):
+    a = re.search(r'_length_(\d+)_', contigNameStr)
+    if a == None:
+        return(None)
+    else:
+        return(int(a.group(1)))
+
+# The lengths of the contigs, keyed by the integer IDs that the alignments
+# refer to (sam_entry.rid). It is filled from the SAM header, the BAM
+# references or a .fai index; contigs not listed there get their length
+# from their name.
+contigs = contig_table.contigTable(lenFromContigName)
+
+def setContigs(table):
+    global contigs
+    contigs = table
+
+def isR1(sam_entry_obj):
+    '''
+    If the "segment unmapped" (0x4) and the "SEQ being reverse
+    complemented" flags are NOT set, this returns True. Otherwise
+    this returns False.
+    '''
+    if sam_entry_obj.flag & 0x4 == 0 and \
+    sam_entry_obj.flag & 0x10 == 0:
+        return(True)
+    else:
+        return(False)
+
+def isR2(sam_entry_obj):
+    '''
+    If the "segment unmapped" (0x4) flas is NOT set and the "SEQ
+    being reverse complemented" flags are IS set, this returns True.
+    Otherwise this returns False.
+    '''
+    if sam_entry_obj.flag & 0x4 == 0 and \
+    sam_entry_obj.flag & 0x10 == 1:
+        return(True)
+    else:
         return(False)
+
+def sameReadForward(a, b):
+    '''
+    a and b are both sam_entry objects.
+    It will be assessed if:
+        a and b are both mapped
+        a and b are both R1 or both R2
+        a and b both map in the forward orientation
+    '''
+    if a.flag & 0x4 == 0 and b.flag & 0x4 == 0 and \
+    a.flag & 0x40 == b.flag & 0x40 and \
+    a.flag & 0x10 == 0 and b.flag & 0x10 == 0:
+        return(True)
+    else:
+        return(False)
+
+def sameReadReverse(a, b):
+    '''
+    a and b are both sam_entry objects.
+    It will be assessed if:
+        a and b are both mapped
+        a and b are both R1 or both R2
+        a and b both map in the reverse orientation
+    '''
+    if a.flag & 0x4 == 0 and b.flag & 0x4 == 0 and \
+    a.flag & 0x40 == b.flag & 0x40 and \
+    a.flag & 0x10 != 0 and b.flag & 0x10 == 1:
+        return(True)
+    else:
+        return(False)
+
+def pairedReads(a, b):
+    '''
+    a and b are both sam_entry objects.
+    It will be assessed if:
+        a and b are both mapped
+        a and b are both paired
+        (a is first segment and b is second segment) OR
+        (a is second segment and b is first segment)
+    It will return False if any of the above evaluate as False
+    It will return 'R1R2' if a is R1 and b is R2.
+    It will return 'R2R1' if a is R2 and b is R1.
+    '''
+    if a.flag & 0x1 != 0 and b.flag & 0x1 != 0 and \
+    a.flag & 0x4 != 0 and b.flat & 0x4 != 0:
+        pass
+    else:
+        return(False)
+    if a.flag & 0x40 == 0 and b.flag & 0x80 == 0:
+        return('R1R2')
+    elif a.flag & 0x80 == 0 and b.flag & 0x40 == 0:
+        return('R2R1')
+    else:
+        return(False)
+
+def singleReadSegmentBridges(a,b):
+    '''
+    a and b are both sam_entry objects
+    '''
+    # See if a and b are validly mapped, either both R1s or R2s and
+    # mapped in the same orientat
+    if sameReadForward(a, b) == True:
+        strand = 'forward'
+    elif sameReadReverse(a, b) == True:
+        strand = 'reverse'
+    else:
+        return(False)
+
+    # Make sure a and b are mapped to the same template
+    if a.rid != b.rid:
+        return(False)
+    template_length = contigs.lengths[a.rid]
+
+    aCigar = a.parsedCigar
+    bCigar = b.parsedCigar
+    read_length = aCigar.readLength
+
+    aStartStop = aCigar.readMatchStartStop()
+    bStartStop = bCigar.readMatchStartStop()
+    if aStartStop == None or bStartStop == None:
+        return(False)
+
+    if aStartStop[1] < bStartStop[0] and \
+    a.pos > b.pos + bCigar.alnLength and strand == 'forward':
+        if template_length - a.pos + b.pos + bCigar.alnLength <= read_length:
+            return(True)
+
+    if bStartStop[1] < aStartStop[0] and \
+    b.pos > a.pos + aCigar.alnLength and strand == 'forward':
+        if template_length - b.pos + a.pos + aCigar.alnLength <= read_length:
+            return(True)
+
+    if aStartStop[1] < bStartStop[0] and \
+    a.pos + aCigar.alnLength < b.pos and strand == 'reverse':
+        if template_length - b.pos + a.pos + aCigar.alnLength <= read_length:
+            return(True)
+
+    if bStartStop[1] < aStartStop[0] and \
+    b.pos + bCigar.alnLength < a.pos and strand == 'reverse':
+        if template_length - a.pos + b.pos + bCigar.alnLength <= read_length:
+            return(True)
+
+    return(False)
+
+def pairedReadBridge(a, b, maxInsertSize):
+    if a.rid != b.rid:
+        return(False)
+    template_length = contigs.lengths[a.rid]
+
+    aStartStop = a.parsedCigar.readMatchStartStop()
+    bStartStop = b.parsedCigar.readMatchStartStop()
+    aAlnLen = aStartStop[1] - aStartStop[0] + 1
+    bAlnLen = bStartStop[1] - bStartStop[0] + 1
+
+    if pairedReads(a, b) == 'R1R2':
+        if a.flag & 0x10 != 0 and b.flag & 0x10 == 0 and \
+        a.pos > b.pos + bAlnLen and \
+        template_length - a.pos + b.pos + bAlnLen <= maxInsertSize:
+            return(True)
+        if a.flag & 0x10 == 0 & b.flag & 0x10 != 0 and \
+        b.pos > a.pos + aAlnLen and \
+        template_length - b.pos + a.pos + aAlnLen <= maxInsertSize:
+            return(True)
+
+    elif pairedReads(a, b) == 'R2R1':
+        if b.flag & 0x10 != 0 and a.flag & 0x10 == 0 and \
+        b.pos > a.pos + aAlnLen and \
+        template_length - b.pos + a.pos + aAlnLen <= maxInsertSize:
+            return(True)
+        if b.flag & 0x10 == 0 & a.flag & 0x10 != 0 and \
+        a.pos > b.pos + bAlnLen and \
+        template_length - a.pos + b.pos + bAlnLen <= maxInsertSize:
+            return(True)
+
+    else:
+        return(False)
+
+class bridge_counts:
+    '''
+    Tallies of the bridge tests: the number of read groups, the number of
+    hits of each kind and the number of hits per contig. Tallies of
+    consecutive parts of the input can be combined with merge, which
+    gives the same numbers (and contig order) as a single pass would.
+    '''
+    def __init__(self):
+        self.total = 0
+        self.alignments = 0
+        self.singleReadHits = 0
+        self.pairedReadHits = 0
+        self.supportedBySingleRead = {}
+        self.supportedByPairedRead = {}
+        self.pairsConsidered = 0
+        self.pairsCompared = 0
     
-    def pairedReadBridge(a, b, maxInsertSize):
-        if a.rname != b.rname:
-            return(False)
-        template_length = lenFromContigName(a.rname)
-        
-        aCigar = cigar(a.cigar)
-        bCigar = cigar(b.cigar)
-        aAlnLen = aCigar.readMatchStartStop()[1] - aCigar.readMatchStartStop()[0] + 1
-        bAlnLen = bCigar.readMatchStartStop()[1] - bCigar.readMatchStartStop()[0] + 1
-        
-        if pairedReads(a, b) == 'R1R2':
-            if a.flag & 0x10 != 0 and b.flag & 0x10 == 0 and \
-            a.pos > b.pos + bAlnLen and \
-            template_length - a.pos + b.pos + bAlnLen <= maxInsertSize:
-                return(True)
-            if a.flag & 0x10 == 0 & b.flag & 0x10 != 0 and \
-            b.pos > a.pos + aAlnLen and \
-            template_length - b.pos + a.pos + aAlnLen <= maxInsertSize:
-                return(True)
-        
-        elif pairedReads(a, b) == 'R2R1':
-            if b.flag & 0x10 != 0 and a.flag & 0x10 == 0 and \
-            b.pos > a.pos + aAlnLen and \
-            template_length - b.pos + a.pos + aAlnLen <= maxInsertSize:
-                return(True)
-            if b.flag & 0x10 == 0 & a.flag & 0x10 != 0 and \
-            a.pos > b.pos + bAlnLen and \
-            template_length - a.pos + b.pos + bAlnLen <= maxInsertSize:
-                return(True)
-        
-        else:
-            return(False)
-        
+    def merge(self, other):
+        self.total += other.total
+        self.alignments += other.alignments
+        self.pairsConsidered += other.pairsConsidered
+        self.pairsCompared += other.pairsCompared
+        self.singleReadHits += other.singleReadHits
+        self.pairedReadHits += other.pairedReadHits
+        for k,v in other.supportedBySingleRead.items():
+            self.supportedBySingleRead[k] = self.supportedBySingleRead.get(k, 0) + v
+        for k,v in other.supportedByPairedRead.items():
+            self.supportedByPairedRead[k] = self.supportedByPairedRead.get(k, 0) + v
     
-    samf = sys.argv[1]
-    samh = sam_per_read(samf)
-    total = 0
-    singleReadHits = 0
-    pairedReadHits = 0
-    supportedBySingleRead = {}
-    supportedByPairedRead = {}
-    while samh:
-        try:
-            readaln = samh.next()
-            total += 1
-            alns = [sam_entry('\t'.join(line)) for line in readaln]
-            for i in range(len(alns)-1):
-                for j in range(i, len(alns)):
-                    if singleReadSegmentBridges(alns[i], alns[j]) == True:
-                        print(alns[i])
-                        print(alns[j])
-                        print("\n")
-                        supportedBySingleRead[alns[i].rname] = \
-                        supportedBySingleRead.get(alns[i].rname, 0) + 1
-                        singleReadHits += 1
-                    if pairedReadBridge(alns[i], alns[j], maxInsertSize) == True:
-                        print(alns[i])
-                        print(alns[j])
-                        print("\n")
-                        supportedByPairedRead[alns[i].rname] = \
-                        supportedByPairedRead.get(alns[i], 0) + 1
-                        pairedReadHits += 1
-        except StopIteration:
-            break
-    print("Supported by single reads")
-    for k,v in supportedBySingleRead.items():
-        print(k, v)
-    print("\nSupported by paired reads")
-    for k,v in supportedByPairedRead.items():
-        print(k, v)
-    print("\n")
-    print("Total: %i\nSingleHits: %i\nPairedHits: %i" % (total, singleReadHits, pairedReadHits))
-                    
+    def report(self, out):
+        out.write("Supported by single reads\n")
+        for k,v in self.supportedBySingleRead.items():
+            out.write("%s %s\n" % (k, v))
+        out.write("\nSupported by paired reads\n")
+        for k,v in self.supportedByPairedRead.items():
+            out.write("%s %s\n" % (k, v))
+        out.write("\n\n")
+        out.write("Total: %i\nSingleHits: %i\nPairedHits: %i\n" % (self.total, self.singleReadHits, self.pairedReadHits))
+    
+    def reportPruning(self, out):
+        out.write("Pairs of alignments: %i\nCompared: %i\nPruned: %i\n" % \
+        (self.pairsConsidered, self.pairsCompared, self.pairsConsidered - self.pairsCompared))
+
+def candidatePairs(alns, maxInsertSize):
+    '''
+    Returns the pairs of alignments of one read group that could pass
+    singleReadSegmentBridges or pairedReadBridge, as a sorted list of
+    (i, j, single, paired) tuples with i < j, where single and paired tell
+    which of the two tests is worth running.
+    
+    Mapped alignments are bucketed by contig, strand and R1/R2 flag. A
+    single read can only bridge the ends within one bucket, and a pair of
+    reads only between the buckets of opposite strand and segment on the
+    same contig. Both tests also need one alignment to start within the
+    window (the read length, or maxInsertSize for pairs) of the contig
+    start and the other within the window of the contig end, so all
+    other pairs are pruned. Comparing an alignment with itself can never
+    pass either test and is skipped.
+    '''
+    readLength = 0
+    for a in alns:
+        if a.flag & 0x4 == 0 and a.parsedCigar.readLength:
+            readLength = max(readLength, a.parsedCigar.readLength)
+    buckets = {}
+    for k in range(len(alns)):
+        a = alns[k]
+        if a.flag & 0x4 != 0:
+            continue
+        template_length = contigs.lengths[a.rid]
+        if template_length == None:
+            ends = (True, True, True, True)
+        else:
+            ends = (a.pos <= readLength, a.pos > template_length - readLength,
+                    a.pos <= maxInsertSize, a.pos > template_length - maxInsertSize)
+        key = (a.rid, a.flag & 0x10, a.flag & 0x40)
+        buckets.setdefault(key, []).append((k, ends))
+    pairs = {}
+    for members in buckets.values():
+        for x in range(len(members)):
+            i, iEnds = members[x]
+            for j, jEnds in members[x+1:]:
+                if (iEnds[0] and jEnds[1]) or (iEnds[1] and jEnds[0]):
+                    pairs[(i, j)] = [True, False]
+    for (rid, strand, segment), members in buckets.items():
+        if segment != 0:
+            continue
+        mates = buckets.get((rid, strand ^ 0x10, 0x40), [])
+        for i, iEnds in members:
+            for j, jEnds in mates:
+                if (iEnds[2] and jEnds[3]) or (iEnds[3] and jEnds[2]):
+                    pairs.setdefault((min(i, j), max(i, j)), [False, False])[1] = True
+    return(sorted([(i, j, single, paired) for (i, j), (single, paired) in pairs.items()]))
+
+def scanGroups(groups, out):
+    '''
+    scanReadGroups, or scanReadGroupsBatch if useBatch is set.
+    '''
+    if useBatch:
+        return(scanReadGroupsBatch(groups, out))
+    return(scanReadGroups(groups, out))
+
+def scanReadGroups(groups, out):
+    '''
+    Runs the bridge tests on the candidate pairs (see candidatePairs) of
+    alignments of each read group in 'groups' and writes the pairs that
+    bridge the contig ends to out. Returns a bridge_counts object.
+    With instrument.metrics on, the time spent reading and parsing the
+    read groups is timed separately from the whole scan.
+    '''
+    counts = bridge_counts()
+    metrics = instrument.metrics
+    groups = metrics.track(groups, 'read groups', 'reading and parsing alignments',
+            getattr(groups, 'size', None), getattr(groups, 'position', None))
+    with metrics.stage('scanning read groups (all)'):
+        for alns in groups:
+            counts.total += 1
+            counts.alignments += len(alns)
+            counts.pairsConsidered += len(alns) * (len(alns) - 1) // 2
+            if len(alns) < 2:
+                continue
+            scanGroup(alns, out, counts)
+    return(counts)
+
+def scanGroup(alns, out, counts):
+    '''
+    Runs the bridge tests on the candidate pairs of one read group.
+    '''
+    for i, j, single, paired in candidatePairs(alns, maxInsertSize):
+        counts.pairsCompared += 1
+        if single and singleReadSegmentBridges(alns[i], alns[j]) == True:
+            countHit(alns[i], alns[j], out, counts.supportedBySingleRead)
+            counts.singleReadHits += 1
+        if paired and pairedReadBridge(alns[i], alns[j], maxInsertSize) == True:
+            countHit(alns[i], alns[j], out, counts.supportedByPairedRead)
+            counts.pairedReadHits += 1
+
+def countHit(a, b, out, supported):
+    out.write("%s\n%s\n\n\n" % (a, b))
+    supported[a.rname] = supported.get(a.rname, 0) + 1
+
+class alignment_columns:
+    '''
+    The alignments of a batch of read groups as NumPy columns, for the
+    batch versions of the bridge tests. Alignment k has flag[k], rid[k],
+    pos[k], alnLength[k], readLength[k], matchStart[k] and matchStop[k]
+    (see cigar.readMatchStartStop) and the length of its contig,
+    length[k]. For unmapped alignments, and values that are None, they
+    are -1 (rid, matchStart, matchStop and length) or 0. The alignments
+    of group g are offsets[g] to offsets[g + 1]. scalarGroup[g] is True
+    for a group that the batch tests do not cover, where the scalar
+    functions would raise: a mapped alignment without aligned bases or
+    on a contig of unknown length.
+    '''
+    def __init__(self, groups):
+        import numpy as np
+        flags = []
+        rids = []
+        positions = []
+        alnLengths = []
+        readLengths = []
+        starts = []
+        stops = []
+        lengths = []
+        sizes = []
+        scalarGroup = []
+        lengthOf = contigs.lengths
+        for alns in groups:
+            sizes.append(len(alns))
+            scalar = False
+            for a in alns:
+                flag = a.flag
+                flags.append(flag)
+                if flag & 0x4:
+                    rids.append(-1)
+                    positions.append(0)
+                    alnLengths.append(0)
+                    readLengths.append(0)
+                    starts.append(-1)
+                    stops.append(-1)
+                    lengths.append(-1)
+                    continue
+                rid = a.rid
+                aCigar = a.parsedCigar
+                startStop = aCigar.readMatchStartStop()
+                length = lengthOf[rid]
+                if startStop is None:
+                    startStop = (-1, -1)
+                    scalar = True
+                if length is None:
+                    length = -1
+                    scalar = True
+                rids.append(rid)
+                positions.append(a.pos)
+                alnLengths.append(aCigar.alnLength or 0)
+                readLengths.append(aCigar.readLength or 0)
+                starts.append(startStop[0])
+                stops.append(startStop[1])
+                lengths.append(length)
+            scalarGroup.append(scalar)
+        self.flag = np.array(flags, dtype=np.int64)
+        self.rid = np.array(rids, dtype=np.int64)
+        self.pos = np.array(positions, dtype=np.int64)
+        self.alnLength = np.array(alnLengths, dtype=np.int64)
+        self.readLength = np.array(readLengths, dtype=np.int64)
+        self.matchStart = np.array(starts, dtype=np.int64)
+        self.matchStop = np.array(stops, dtype=np.int64)
+        self.length = np.array(lengths, dtype=np.int64)
+        self.offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.offsets[1:])
+        self.scalarGroup = np.array(scalarGroup, dtype=bool)
+        self.group = np.repeat(np.arange(len(sizes)), sizes)
+
+def batchSameReadForward(fa, fb):
+    '''
+    sameReadForward for arrays of flags of alignments a and b.
+    '''
+    return(((fa & 0x4) == 0) & ((fb & 0x4) == 0) & ((fa & 0x40) == (fb & 0x40)) &
+            ((fa & 0x10) == 0) & ((fb & 0x10) == 0))
+
+def batchSameReadReverse(fa, fb):
+    '''
+    sameReadReverse for arrays of flags of alignments a and b.
+    '''
+    return(((fa & 0x4) == 0) & ((fb & 0x4) == 0) & ((fa & 0x40) == (fb & 0x40)) &
+            ((fa & 0x10) != 0) & ((fb & 0x10) == 1))
+
+def batchPairedReads(fa, fb):
+    '''
+    pairedReads for arrays of flags of alignments a and b, as 0 (False),
+    1 ('R1R2') or 2 ('R2R1'). Where both are paired and unmapped,
+    pairedReads itself raises an AttributeError (b.flat); all the pairs
+    the bridge tests are run on are mapped, for which both return False.
+    '''
+    import numpy as np
+    both = ((fa & 0x1) != 0) & ((fb & 0x1) != 0) & ((fa & 0x4) != 0) & ((fb & 0x4) != 0)
+    r1r2 = both & ((fa & 0x40) == 0) & ((fb & 0x80) == 0)
+    r2r1 = both & ~r1r2 & ((fa & 0x80) == 0) & ((fb & 0x40) == 0)
+    return(np.where(r1r2, 1, np.where(r2r1, 2, 0)))
+
+def batchSingleReadSegmentBridges(cols, ia, ib):
+    '''
+    singleReadSegmentBridges(alignment ia[k], alignment ib[k]) for every
+    k, over alignment_columns cols.
+    '''
+    fa = cols.flag[ia]
+    fb = cols.flag[ib]
+    forward = batchSameReadForward(fa, fb)
+    reverse = ~forward & batchSameReadReverse(fa, fb)
+    ok = (forward | reverse) & (cols.rid[ia] == cols.rid[ib]) & \
+            (cols.matchStart[ia] >= 0) & (cols.matchStart[ib] >= 0)
+    templateLength = cols.length[ia]
+    readLength = cols.readLength[ia]
+    aPos = cols.pos[ia]
+    bPos = cols.pos[ib]
+    aAln = cols.alnLength[ia]
+    bAln = cols.alnLength[ib]
+    aBeforeB = cols.matchStop[ia] < cols.matchStart[ib]
+    bBeforeA = cols.matchStop[ib] < cols.matchStart[ia]
+    bridges = (aBeforeB & (aPos > bPos + bAln) & forward &
+            (templateLength - aPos + bPos + bAln <= readLength))
+    bridges |= (bBeforeA & (bPos > aPos + aAln) & forward &
+            (templateLength - bPos + aPos + aAln <= readLength))
+    bridges |= (aBeforeB & (aPos + aAln < bPos) & reverse &
+            (templateLength - bPos + aPos + aAln <= readLength))
+    bridges |= (bBeforeA & (bPos + bAln < aPos) & reverse &
+            (templateLength - aPos + bPos + bAln <= readLength))
+    return(ok & bridges)
+
+def batchPairedReadBridge(cols, ia, ib, maxInsertSize):
+    '''
+    pairedReadBridge(alignment ia[k], alignment ib[k], maxInsertSize)
+    for every k, over alignment_columns cols.
+    '''
+    fa = cols.flag[ia]
+    fb = cols.flag[ib]
+    templateLength = cols.length[ia]
+    aPos = cols.pos[ia]
+    bPos = cols.pos[ib]
+    aAlnLen = cols.matchStop[ia] - cols.matchStart[ia] + 1
+    bAlnLen = cols.matchStop[ib] - cols.matchStart[ib] + 1
+    kind = batchPairedReads(fa, fb)
+    # 'x.flag & 0x10 == 0 & y.flag & 0x10 != 0' is a chained comparison,
+    # (x.flag & 0x10) == (0 & y.flag & 0x10) != 0, which is never true
+    never = ((fa & 0x10) == (0 & fb & 0x10)) & ((0 & fb & 0x10) != 0)
+    r1r2 = ((fa & 0x10) != 0) & ((fb & 0x10) == 0) & (aPos > bPos + bAlnLen) & \
+            (templateLength - aPos + bPos + bAlnLen <= maxInsertSize)
+    r1r2 |= never & (bPos > aPos + aAlnLen) & \
+            (templateLength - bPos + aPos + aAlnLen <= maxInsertSize)
+    r2r1 = ((fb & 0x10) != 0) & ((fa & 0x10) == 0) & (bPos > aPos + aAlnLen) & \
+            (templateLength - bPos + aPos + aAlnLen <= maxInsertSize)
+    r2r1 |= never & (aPos > bPos + bAlnLen) & \
+            (templateLength - aPos + bPos + bAlnLen <= maxInsertSize)
+    return((cols.rid[ia] == cols.rid[ib]) & (((kind == 1) & r1r2) | ((kind == 2) & r2r1)))
+
+def batchCandidatePairs(cols, maxInsertSize):
+    '''
+    candidatePairs for every group of alignment_columns cols that the
+    batch tests cover, with array operations. Returns the arrays i and j
+    of the candidate pairs (indexes into cols, i < j within a group, in
+    group order and then sorted by i and j, as candidatePairs sorts them)
+    and whether each is a single and a paired candidate.
+    '''
+    import numpy as np
+    mapped = (cols.flag & 0x4) == 0
+    readLength = np.where(mapped, cols.readLength, 0)
+    groupReadLength = np.zeros(len(cols.offsets) - 1, dtype=np.int64)
+    nonEmpty = cols.offsets[:-1] < cols.offsets[1:]
+    if nonEmpty.any():
+        groupReadLength[nonEmpty] = np.maximum.reduceat(readLength,
+                cols.offsets[:-1][nonEmpty])
+    windowLength = groupReadLength[cols.group]
+    pos = cols.pos
+    length = cols.length
+    ends = np.stack([pos <= windowLength, pos > length - windowLength,
+            pos <= maxInsertSize, pos > length - maxInsertSize])
+    # Only alignments near an end of their contig can be in a candidate
+    # pair, so the pairs are only formed between those
+    keep = np.nonzero(mapped & ends.any(axis=0) & ~cols.scalarGroup[cols.group])[0]
+    # Every kept alignment x is paired with the later ones y of its group
+    keptGroup = cols.group[keep]
+    later = np.searchsorted(keptGroup, keptGroup, side='right') - np.arange(len(keep)) - 1
+    x = np.repeat(np.arange(len(keep)), later)
+    firstOfRun = np.cumsum(later) - later
+    y = x + 1 + (np.arange(len(x)) - np.repeat(firstOfRun, later))
+    i = keep[x]
+    j = keep[y]
+    fi = cols.flag[i]
+    fj = cols.flag[j]
+    sameContig = cols.rid[i] == cols.rid[j]
+    ei = ends[:, i]
+    ej = ends[:, j]
+    single = sameContig & ((fi & 0x10) == (fj & 0x10)) & ((fi & 0x40) == (fj & 0x40)) & \
+            ((ei[0] & ej[1]) | (ei[1] & ej[0]))
+    paired = sameContig & ((fi & 0x10) != (fj & 0x10)) & ((fi & 0x40) != (fj & 0x40)) & \
+            ((ei[2] & ej[3]) | (ei[3] & ej[2]))
+    candidate = single | paired
+    return(i[candidate], j[candidate], single[candidate], paired[candidate])
+
+def scanReadGroupsBatch(groups, out, batchSize=4096):
+    '''
+    The same as scanReadGroups, with the same output, but with the
+    candidate pairs and the bridge tests of batchSize read groups at a
+    time worked out with array operations over their alignment_columns.
+    Groups that the batch tests don't cover are run through the scalar
+    functions.
+    '''
+    counts = bridge_counts()
+    metrics = instrument.metrics
+    groups = metrics.track(groups, 'read groups', 'reading and parsing alignments',
+            getattr(groups, 'size', None), getattr(groups, 'position', None))
+    with metrics.stage('scanning read groups (all)'):
+        batch = []
+        for alns in groups:
+            batch.append(alns)
+            if len(batch) == batchSize:
+                scanBatch(batch, out, counts)
+                batch = []
+        scanBatch(batch, out, counts)
+    return(counts)
+
+def scanBatch(batch, out, counts):
+    '''
+    Runs the batch bridge tests on one batch of read groups, writing the
+    hits and counting them in the order scanReadGroups would.
+    '''
+    import numpy as np
+    cols = alignment_columns(batch)
+    i, j, single, paired = batchCandidatePairs(cols, maxInsertSize)
+    singleHits = single & batchSingleReadSegmentBridges(cols, i, j)
+    pairedHits = paired & batchPairedReadBridge(cols, i, j, maxInsertSize)
+    pairGroups = cols.group[i]
+    compared = np.bincount(pairGroups, minlength=len(batch))
+    hits = np.nonzero(singleHits | pairedHits)[0]
+    h = 0
+    for g in range(len(batch)):
+        alns = batch[g]
+        counts.total += 1
+        counts.alignments += len(alns)
+        counts.pairsConsidered += len(alns) * (len(alns) - 1) // 2
+        if cols.scalarGroup[g]:
+            if len(alns) > 1:
+                scanGroup(alns, out, counts)
+            continue
+        counts.pairsCompared += int(compared[g])
+        while h < len(hits) and pairGroups[hits[h]] == g:
+            k = hits[h]
+            a = alns[i[k] - cols.offsets[g]]
+            b = alns[j[k] - cols.offsets[g]]
+            if singleHits[k]:
+                countHit(a, b, out, counts.supportedBySingleRead)
+                counts.singleReadHits += 1
+            if pairedHits[k]:
+                countHit(a, b, out, counts.supportedByPairedRead)
+                counts.pairedReadHits += 1
+            h += 1
+
+def isShardable(filePath):
+    '''
+    Only uncompressed SAM files on disk can be split at byte offsets.
+    '''
+    if filePath == '-' or not os.path.isfile(filePath):
+        return(False)
+    with open(filePath, 'rb') as fileh:
+        return(fileh.read(2) != bam_reader.GZIP_MAGIC)
+
+def readSamHeader(filePath):
+    '''
+    Returns the header lines of an uncompressed SAM file and the byte
+    offset of its first alignment.
+    '''
+    header = []
+    offset = 0
+    with open(filePath, 'rb') as fileh:
+        for line in fileh:
+            if not line.startswith(b'@'):
+                break
+            header.append(line.decode())
+            offset += len(line)
+    return(header, offset)
+
+def shardOffsets(filePath, numShards, start=0):
+    '''
+    Splits a name sorted, uncompressed SAM file, from byte offset start
+    (i.e. after the header) on, into up to numShards byte ranges of about
+    equal size. Each boundary is moved forward to the next change of read
+    name so that no read group is split between two shards. Returns a
+    list of (start, end) byte offsets.
+    '''
+    size = os.path.getsize(filePath)
+    bounds = [start]
+    with open(filePath, 'rb') as fileh:
+        for k in range(1, numShards):
+            guess = max(start + (size - start) * k // numShards, bounds[-1])
+            if guess >= size:
+                break
+            fileh.seek(guess)
+            if guess > start:
+                fileh.readline()
+            offset = fileh.tell()
+            line = fileh.readline()
+            qname = line[:line.find(b'\t')]
+            offset += len(line)
+            while line:
+                line = fileh.readline()
+                if line[:line.find(b'\t')] != qname:
+                    break
+                offset += len(line)
+            if offset >= size:
+                break
+            if offset > bounds[-1]:
+                bounds.append(offset)
+    bounds.append(size)
+    return([(bounds[i], bounds[i+1]) for i in range(len(bounds)-1)])
+
+def initWorker(table, batch=False, mapped=False):
+    '''
+    Sets up a worker process of scanParallel: it is given the contig
+    table, useBatch and useMmap, and doesn't time itself or write
+    progress lines.
+    '''
+    global useBatch, useMmap
+    setContigs(table)
+    useBatch = batch
+    useMmap = mapped
+    instrument.metrics.disable()
+
+def shardAlignments(filePath, start, end):
+    '''
+    Yields a sam_entry for every line of the (start, end) byte range of
+    filePath, read through a buffer, with the lines as bytes.
+    '''
+    with open(filePath, 'rb') as fileh:
+        fileh.seek(start)
+        offset = start
+        for line in fileh:
+            if offset >= end:
+                break
+            offset += len(line)
+            if line != b'\n':
+                yield(sam_entry(line))
+
+def scanShard(shard):
+    '''
+    Runs scanGroups on one (filePath, start, end) shard in a worker
+    process. Returns the text of the hits and the bridge_counts.
+    '''
+    filePath, start, end = shard
+    out = io.StringIO()
+    if useMmap:
+        groups = mapped_sam_per_read(filePath, start, end)
+    else:
+        groups = groupByRead(shardAlignments(filePath, start, end))
+    counts = scanGroups(groups, out)
+    return(out.getvalue(), counts)
+
+def scanPartition(partition):
+    '''
+    Runs scanGroups on one (spill file, partitionBytes) partition of an
+    unsorted_sam_per_read in a worker process. Returns the text of the
+    hits and the bridge_counts.
+    '''
+    path, partitionBytes = partition
+    out = io.StringIO()
+    counts = scanGroups(partitionGroups(path, partitionBytes), out)
+    return(out.getvalue(), counts)
+
+def scanPartitions(groups, jobs, out):
+    '''
+    Scans the partitions of an unsorted_sam_per_read in a pool of jobs
+    worker processes. Hits are written, and counts merged, in partition
+    order, so the output is identical to a serial run.
+    '''
+    counts = bridge_counts()
+    metrics = instrument.metrics
+    try:
+        with multiprocessing.Pool(jobs, initializer=initWorker,
+                initargs=(contigs, useBatch, useMmap)) as pool:
+            partitions = [(path, groups.partitionBytes) for path in groups.partitions]
+            for hits, partCounts in metrics.track(pool.imap(scanPartition, partitions),
+                    'partitions', 'waiting for worker processes', len(partitions)):
+                out.write(hits)
+                counts.merge(partCounts)
+    finally:
+        groups.cleanup()
+    return(counts)
+
+def scanParallel(filePath, jobs, out, shardsPerJob=4):
+    '''
+    Splits filePath into shards and scans them in a pool of jobs worker
+    processes, which are given the contig table. Hits are written, and
+    counts merged, in shard order, so the output is identical to a serial
+    run.
+    '''
+    counts = bridge_counts()
+    header, headerEnd = readSamHeader(filePath)
+    contigs.addSamHeader(header)
+    shards = [(filePath, start, end) for start, end in
+            shardOffsets(filePath, jobs * shardsPerJob, headerEnd)]
+    metrics = instrument.metrics
+    with multiprocessing.Pool(jobs, initializer=initWorker,
+            initargs=(contigs, useBatch, useMmap)) as pool:
+        for hits, shardCounts in metrics.track(pool.imap(scanShard, shards), 'shards',
+                'waiting for worker processes', len(shards)):
+            out.write(hits)
+            counts.merge(shardCounts)
+    return(counts)
+
+if __name__ == "__main__":
+    import argparse
+    usage = '''reads_overlap_point.py aln.sam
+    It only looks for reads overlapping the origin.
+    The alignments must be sorted by read name. They can be in BAM format,
+    or in SAM format, plain text or gzip compressed, with or without a
+    header. Use '-' as the file name to read from stdin.
+    Contig lengths are taken from the SAM or BAM header, or from a
+    samtools faidx index given with --fai, and otherwise from SPAdes-style
+    contig names (e.g. NODE_1_length_1000_cov_5.2).
+    With --jobs, a plain text SAM file is split into parts that are
+    analysed in parallel; other input is analysed serially.
+    With --windows, the alignments must instead be in a BAM file sorted
+    by coordinate and indexed (samtools index), and only those starting
+    within --window-size of either end of a contig are read; this is
+    always done serially, so it can't be combined with --jobs.
+    With --unsorted, SAM or BAM input in any order is grouped by read name with
+    temporary spill files, in about --memory MB (with --jobs, the
+    partitions are analysed in parallel within that memory).
+    '''
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument('samf', metavar='aln.sam')
+    parser.add_argument('--jobs', type=int, default=1,
+            help='Number of worker processes (default: 1)')
+    parser.add_argument('--windows', action='store_true',
+            help='Only read the alignments near the contig ends of a coordinate '
+            'sorted BAM file, using its .bai index')
+    parser.add_argument('--window-size', type=int, default=maxInsertSize,
+            help='Size of the contig end windows read with --windows; at least '
+            'the read length and maxInsertSize (default: %(default)s)')
+    parser.add_argument('--unsorted', action='store_true',
+            help='The SAM input is not sorted by read name (e.g. sorted by '
+            'coordinate); group it by read name through spill files')
+    parser.add_argument('--memory', type=int, default=1000, metavar='MB',
+            help='Memory to group unsorted input in, over all jobs (default: %(default)s)')
+    parser.add_argument('--spill-dir', metavar='DIR', default=None,
+            help='Where to put the spill files of --unsorted (default: the '
+            'system temporary directory)')
+    parser.add_argument('--batch', action='store_true',
+            help='Run the bridge tests on batches of read groups with NumPy '
+            'array operations (same output)')
+    parser.add_argument('--mmap', action='store_true',
+            help='Memory-map uncompressed SAM files instead of reading them '
+            'through a buffer (same output)')
+    parser.add_argument('--fai', metavar='contigs.fasta.fai',
+            help='samtools faidx index of the contigs, for their lengths')
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    if args.windows and args.jobs > 1:
+        parser.error('--windows reads the contig end windows serially; it can\'t '
+                'be combined with --jobs')
     
+    useBatch = args.batch
+    useMmap = args.mmap
+    with instrument.session(args) as metrics:
+        if args.fai:
+            contigs.addFai(args.fai)
+        if args.windows:
+            counts = scanGroups(window_bam_per_read(args.samf, args.window_size),
+                    sys.stdout)
+        elif args.unsorted:
+            groups = unsorted_sam_per_read(args.samf, args.memory * 1000000 // args.jobs,
+                    args.spill_dir)
+            if args.jobs > 1:
+                counts = scanPartitions(groups, args.jobs, sys.stdout)
+            else:
+                counts = scanGroups(groups, sys.stdout)
+        elif args.jobs > 1 and isShardable(args.samf):
+            counts = scanParallel(args.samf, args.jobs, sys.stdout)
+        else:
+            if args.jobs > 1:
+                sys.stderr.write("--jobs needs an uncompressed SAM file; running serially\n")
+            counts = scanGroups(openAlignments(args.samf), sys.stdout)
+        with metrics.stage('writing the summary'):
+            counts.report(sys.stdout)
+            counts.reportPruning(sys.stderr)
+        metrics.count('alignments', counts.alignments)
+        metrics.count('pairs of alignments considered', counts.pairsConsidered)
+        metrics.count('pairs compared', counts.pairsCompared)
+        metrics.count('single read hits', counts.singleReadHits)
+        metrics.count('paired read hits', counts.pairedReadHits)
+        metrics.count('CIGARs parsed (cache misses)', parseCigar.cache_info().misses)
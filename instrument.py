@@ -0,0 +1,240 @@
+#! /usr/bin/python3
+
+# Author: Patrick Denis Browne
+# e-mail: pdbr@plen.ku.dk
+# Licensed under the terms of the GNU General Public License v3.0
+
+# Lightweight instrumentation shared by the scripts in this repository:
+# stage timers, counters, periodic progress lines on stderr with the rate
+# and an ETA, and a cProfile mode. Everything is off unless a script is
+# run with --stats, --progress or --profile (see addArguments). When off,
+# stage() returns one shared do-nothing context manager and track()
+# returns its iterable untouched, so instrumented code runs as it would
+# without them; the hot loops are only instrumented through track().
+
+import contextlib
+import gzip
+import os
+import stat
+import sys
+import threading
+import time
+
+class _noStage:
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, excType, excValue, traceback):
+        return(False)
+
+_NO_STAGE = _noStage()
+
+class _stage:
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return(self)
+
+    def __exit__(self, excType, excValue, traceback):
+        self.owner.addTime(self.name, time.perf_counter() - self.start)
+        return(False)
+
+class instruments:
+    '''
+    The stage timers and counters of one process. seconds[stage] is the
+    time spent in a stage, summed over threads, and counts[name] a count
+    of something. Stages can nest (the time of an inner stage is also part
+    of the outer one). progressInterval is the number of seconds between
+    progress lines, or None for no progress lines.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.progressInterval = None
+        self.seconds = {}
+        self.counts = {}
+        self.started = time.perf_counter()
+        self.__lock = threading.Lock()
+
+    def configure(self, enabled, progressInterval=None):
+        self.enabled = enabled
+        self.progressInterval = progressInterval
+        self.started = time.perf_counter()
+
+    def disable(self):
+        '''
+        Turns everything off, e.g. in worker processes, which would
+        otherwise inherit the settings of the process that started them.
+        '''
+        self.enabled = False
+        self.progressInterval = None
+
+    def stage(self, name):
+        '''
+        A context manager that adds the time spent in it to stage name.
+        '''
+        if not self.enabled:
+            return(_NO_STAGE)
+        return(_stage(self, name))
+
+    def addTime(self, name, seconds):
+        with self.__lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.__lock:
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def track(self, iterable, unit, stage=None, total=None, position=None):
+        '''
+        Iterates over iterable, counting the items as unit, adding the time
+        spent producing them (e.g. reading and parsing) to stage, and
+        writing progress lines. The fraction done is position() / total if
+        position is given (e.g. the offset in a file and its size),
+        otherwise the number of items / total. Returns iterable itself when
+        neither the timers nor progress lines are on.
+        '''
+        if not self.enabled and self.progressInterval is None:
+            return(iterable)
+        return(self.__track(iterable, unit, stage, total, position))
+
+    def __track(self, iterable, unit, stage, total, position):
+        iterator = iter(iterable)
+        n = 0
+        seconds = 0.0
+        start = time.perf_counter()
+        nextProgress = None
+        if self.progressInterval is not None:
+            nextProgress = start + self.progressInterval
+        try:
+            while True:
+                before = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                now = time.perf_counter()
+                seconds += now - before
+                n += 1
+                if nextProgress is not None and now >= nextProgress:
+                    self.progressLine(unit, n, now - start, total, position)
+                    nextProgress = now + self.progressInterval
+                yield(item)
+        finally:
+            if self.enabled:
+                if stage is not None:
+                    self.addTime(stage, seconds)
+                self.count(unit, n)
+
+    def progressLine(self, unit, n, elapsed, total=None, position=None):
+        line = '%s %s in %s (%.0f/s)' % (formatCount(n), unit,
+                formatSeconds(elapsed), n / max(elapsed, 1e-9))
+        fraction = None
+        if total and position is not None:
+            done = position()
+            fraction = float(done) / total
+            line += ', %s of %s' % (formatBytes(done), formatBytes(total))
+        elif total:
+            fraction = float(n) / total
+            line += ' of %s' % (formatCount(total))
+        if fraction:
+            line += ' (%.1f%%), ETA %s' % (100 * fraction,
+                    formatSeconds(elapsed * (1 - fraction) / fraction))
+        sys.stderr.write('[%s] %s\n' % (os.path.basename(sys.argv[0]), line))
+        sys.stderr.flush()
+
+    def report(self, out):
+        '''
+        Writes the stage times and counts.
+        '''
+        wall = time.perf_counter() - self.started
+        out.write('%-40s %12s %7s\n' % ('Stage', 'Seconds', '%'))
+        for name, seconds in self.seconds.items():
+            out.write('%-40s %12.3f %7.1f\n' % (name, seconds, 100 * seconds / wall))
+        out.write('%-40s %12.3f %7.1f\n' % ('(wall time)', wall, 100.0))
+        if self.counts:
+            out.write('%-40s %12s\n' % ('Counter', 'Count'))
+            for name, n in self.counts.items():
+                out.write('%-40s %12i\n' % (name, n))
+
+# The instruments of this process
+metrics = instruments()
+
+def formatCount(n):
+    return('{:,}'.format(n))
+
+def formatBytes(n):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if n < 1000:
+            return('%.1f %s' % (n, unit))
+        n /= 1000.0
+    return('%.1f TB' % (n))
+
+def formatSeconds(seconds):
+    seconds = int(seconds)
+    return('%i:%02i:%02i' % (seconds // 3600, seconds // 60 % 60, seconds % 60))
+
+def fileProgress(fileh):
+    '''
+    Returns a function giving the number of bytes of the file behind
+    fileh (a text, binary or gzip file handle) read so far, and the size
+    of that file, for track(). Both are None if the size isn't known (e.g.
+    stdin). For gzip input the compressed bytes are counted.
+    '''
+    raw = fileh
+    if hasattr(raw, 'buffer'):
+        raw = raw.buffer
+    if isinstance(raw, gzip.GzipFile):
+        raw = raw.fileobj
+    try:
+        info = os.fstat(raw.fileno())
+    except (AttributeError, OSError, ValueError):
+        return(None, None)
+    if not stat.S_ISREG(info.st_mode) or info.st_size == 0:
+        return(None, None)
+    return(raw.tell, info.st_size)
+
+def addArguments(parser):
+    '''
+    Adds the --stats, --progress and --profile options to an
+    argparse.ArgumentParser.
+    '''
+    parser.add_argument('--stats', action='store_true',
+            help='Write the time spent in each stage and counts of what was '
+            'processed to stderr at the end')
+    parser.add_argument('--progress', type=float, nargs='?', const=10.0, default=None,
+            metavar='SECONDS', help='Write a progress line, with the rate and an '
+            'ETA, to stderr every SECONDS seconds (default: 10)')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='FILE',
+            help='Run under cProfile and write the functions taking the most time '
+            'to stderr; with FILE, also save the profile for pstats. Only the '
+            'main process is profiled')
+
+@contextlib.contextmanager
+def session(args, out=sys.stderr):
+    '''
+    Turns on what the options added by addArguments ask for while the
+    body runs, and writes the reports at the end.
+    '''
+    metrics.configure(args.stats, args.progress)
+    profiler = None
+    if args.profile is not None:
+        # Imported here, as pstats alone takes longer to import than
+        # everything else in this module
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield(metrics)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            if args.profile:
+                profiler.dump_stats(args.profile)
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(30)
+        if args.stats:
+            metrics.report(out)
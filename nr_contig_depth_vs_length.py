@@ -1,4 +1,4 @@
-#! /usr/bin/python
+#! /usr/bin/python3
 
 # This assess how deeply sequencing reads from a direct mobilome library
 # and an MDA amplified mobilome library map to a mobilome assembly.
@@ -25,53 +25,136 @@
 # achieved with `samtools view -F 0x804' and convert to BAM format.
 # The relevant files are assigned to the 'DIRBAM' and 'AMPBAM' variables
 # below. 
+# All four files can also be given on the command line (see --help).
+# Any number of BAM files (e.g. many libraries mapped to one assembly) can
+# be given instead with --bam, repeated, which gives a region x sample
+# table with the same columns for each sample; --npz also saves that
+# matrix for NumPy (see saveMatrix).
+# By default each BAM file is read once, in a single pass answering every
+# region (see bam_coverage.py); --samtools instead runs samtools
+# pipelines for every region as this script originally did.
+# The results of every region are cached on disk (see resultCache), in at
+# most --cache-size MB, so a rerun only queries the regions, BAM files and
+# options that changed.
+# With --depth-store the depths come from a per-base depth store of each
+# BAM file (bam_coverage.buildDepthStore), built on first use next to the
+# BAM file, or in --depth-store-dir (by default the cache directory, if
+# the BAM file's directory is not writable), and only the reads are
+# counted from the BAM file itself. The
+# depths are then those of the positions of each trimmed region only,
+# not also of the flanking positions covered by reads overlapping it
+# that `samtools depth` reports, so they can differ slightly.
 
+import concurrent.futures
+import contextlib
+import json
+import os
 import re
+import sqlite3
 import subprocess
+import sys
+import threading
+import time
 import numpy as np
 
+import bam_coverage
+import contig_table
+import instrument
+
 CONTIGS = 'contigs.fasta'
 NR_REGIONS = 'nrRegions_min_1kb.txt'
 DIRBAM = 'dir.sorted.aln.bam'
 AMPBAM = 'amp.sorted.aln.bam'
+# Bump this whenever a change to the queries changes their results, so
+# that results cached by older versions are not used
+CACHE_VERSION = 2
+# The number of samtools processes in the widest pipeline run
+# (samtools view | samtools depth)
+PIPELINE_PROCESSES = 2
+
+class processLimiter:
+    """
+    Caps the number of samtools processes running at once, over all the
+    threads querying regions. A pipeline takes one slot for every samtools
+    process it starts, and takes them all at once so that two pipelines
+    can never each hold part of what they need, so maxProcesses must be
+    at least PIPELINE_PROCESSES. maxProcesses=None means no cap.
+    """
+    def __init__(self, maxProcesses=None):
+        self.maxProcesses = maxProcesses
+        self.running = 0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slots(self, n):
+        if self.maxProcesses is not None:
+            with self.condition:
+                self.condition.wait_for(lambda: self.running + n <= self.maxProcesses)
+                self.running += n
+        try:
+            yield
+        finally:
+            if self.maxProcesses is not None:
+                with self.condition:
+                    self.running -= n
+                    self.condition.notify_all()
+
+samtoolsLimiter = processLimiter()
 
-def countReads(line, bamF):
+def countReads(line, bamF, approximate=False):
+    """
+    The number of distinct read names among the alignments that samtools
+    view reports for the regions of line. The names are counted as they
+    are read (see bam_coverage.nameCounter) rather than sorted, and
+    approximately, in bounded memory, if approximate is True. Raises
+    subprocess.CalledProcessError if samtools fails.
+    """
     line = line.strip()
     a = line.split(' ')
     b = tuple(['samtools', 'view', bamF] + a)
-    ps1 = subprocess.Popen(b, stdout=subprocess.PIPE)
-    ps2 = subprocess.Popen(('cut', '-f', '1'), stdin=ps1.stdout, stdout=subprocess.PIPE)
-    ps3 = subprocess.Popen(('sort'), stdin=ps2.stdout, stdout=subprocess.PIPE)
-    ps4 = subprocess.Popen(('uniq'), stdin=ps3.stdout, stdout=subprocess.PIPE)
-    try:
-        strOutput = subprocess.check_output(('grep', '-c', '', '-'), stdin=ps4.stdout)
+    names = bam_coverage.nameCounter(approximate)
+    instrument.metrics.count('samtools processes started')
+    with samtoolsLimiter.slots(1), instrument.metrics.stage('samtools view (read counts)'):
+        ps1 = subprocess.Popen(b, stdout=subprocess.PIPE)
+        for alnLine in ps1.stdout:
+            names.add(alnLine[:alnLine.find(b'\t')])
+        ps1.stdout.close()
         ps1.wait()
-        ps2.wait()
-        ps3.wait()
-        ps4.wait()
-        output = int(strOutput.rstrip('\n'))
-        return output
-    except:
-        return int(0)
+    if ps1.returncode:
+        raise subprocess.CalledProcessError(ps1.returncode, ps1.args)
+    return names.count()
 
-def bamDepth(line, bamF, trim=0):
+def streamDepths(fileh, depths, batchSize=65536):
     """
-    line: A Region recognized by samtools. It must specify start and stop
-          positions, regardless of whether or not the whole region should
-          be matched
-    bamF: A bam file. It must be sorted and indexed
-    trim: To avoid edge effects in mapping, it is probably a good idea to
-          trim 50 to 100 nucleotides off the edge of the regions to only
-          look at positions with more robust coverage values.
+    Adds the depths (third column) of `samtools depth` output read from
+    fileh to the depthAccumulator depths, batchSize lines at a time, and
+    returns the number of depths read.
+    """
+    numDepths = 0
+    batch = []
+    for outline in fileh:
+        batch.append(int(outline.split('\t')[2]))
+        if len(batch) == batchSize:
+            depths.add(batch)
+            numDepths += len(batch)
+            batch = []
+    depths.add(batch)
+    return numDepths + len(batch)
 
-    Returns:
-    length:The number of positions for which coverage is being reported
-    average: The average coverage depth
-    median: The median coverage depth
+def bamDepthStats(line, bamF, trim=0, thresholds=(), percentiles=()):
+    """
+    As bamDepth, but the depths are streamed from samtools into a
+    histogram (see bam_coverage.depthAccumulator) instead of being held in
+    lists, so memory doesn't grow with the length or depth of the regions.
+
+    Returns the length, average and median as bamDepth does, followed by
+    the breadth of coverage (the fraction of depths at least as high) at
+    each of thresholds and the depth at each of percentiles (0 to 100).
+    Raises subprocess.CalledProcessError if either samtools fails.
     """
     line = line.rstrip('\n')
     regions = line.split(' ')
-    depths = []
+    depths = bam_coverage.depthAccumulator()
     numPositions = 0
     for region in regions:
         cName, dStart, dStop = re.search(r'^([^:]+):(\d+)-(\d+)$', region).groups()
@@ -82,38 +165,436 @@ def bamDepth(line, bamF, trim=0):
         newRegion = cName + ':' + dStart + '-' + dStop
         matchLen = 1 + int(dStop) - int(dStart)
         numPositions += matchLen
-        ps1 = subprocess.Popen(('samtools', 'view', '-h', bamF, newRegion), stdout=subprocess.PIPE)
-        output = subprocess.check_output(('samtools', 'depth', '-'), stdin=ps1.stdout)
-        ps1.wait()
-        output = output.rstrip('\n')
-        outlines = output.split('\n')
-        if outlines == ['']:
-            outdepths = [0]
-        else:
-            outdepths = [int(outline.split('\t')[2]) for outline in outlines]
-        depths = depths + outdepths
+        instrument.metrics.count('samtools processes started', 2)
+        with samtoolsLimiter.slots(PIPELINE_PROCESSES), instrument.metrics.stage('samtools view | depth (depths)'):
+            ps1 = subprocess.Popen(('samtools', 'view', '-h', bamF, newRegion), stdout=subprocess.PIPE)
+            ps2 = subprocess.Popen(('samtools', 'depth', '-'), stdin=ps1.stdout, stdout=subprocess.PIPE, universal_newlines=True)
+            ps1.stdout.close()
+            numDepths = streamDepths(ps2.stdout, depths)
+            ps2.stdout.close()
+            ps2.wait()
+            ps1.wait()
+        if ps1.returncode:
+            raise subprocess.CalledProcessError(ps1.returncode, ps1.args)
+        if ps2.returncode:
+            raise subprocess.CalledProcessError(ps2.returncode, ps2.args)
+        if numDepths == 0:
+            depths.add([0])
     assert numPositions > 0, "Depth cannot be calculated for this region (zero or negative length)\n%s" % (line)
-    rMean = float(sum(depths)) / numPositions
-    rMedian = np.median(depths + [0]*(numPositions - len(depths)))
-    return numPositions, rMean, rMedian
+    return bam_coverage.depthSummary(depths, numPositions, thresholds, percentiles)
 
-def lenFromRecName(recname):
+def bamDepth(line, bamF, trim=0):
+    """
+    line: A Region recognized by samtools. It must specify start and stop
+          positions, regardless of whether or not the whole region should
+          be matched
+    bamF: A bam file. It must be sorted and indexed
+    trim: To avoid edge effects in mapping, it is probably a good idea to
+          trim 50 to 100 nucleotides off the edge of the regions to only
+          look at positions with more robust coverage values.
+
+    Returns:
+    length:The number of positions for which coverage is being reported
+    average: The average coverage depth
+    median: The median coverage depth
+    """
+    return bamDepthStats(line, bamF, trim=trim)[:3]
+
+def lenFromName(recname):
     rlen = int(re.search(r'.*_length_(\d+)', recname).group(1))
     return rlen
 
+def lenFromRecName(recname, contigLengths):
+    return contigLengths.length(recname)
+
+def storeDepthStats(line, bamF, trim=0, thresholds=(), percentiles=(), storeDir=None):
+    """
+    As bamDepthStats, but answered from the depth store of bamF, kept in
+    storeDir (see bam_coverage.openDepthStore), over the positions of the
+    trimmed regions only.
+    """
+    with instrument.metrics.stage('depth store queries'):
+        query = bam_coverage.regionQuery(line, trim, collectDepths=False)
+        return bam_coverage.openDepthStore(bamF, storeDir).depthStats(query, thresholds,
+                percentiles)
+
+def regionJob(line, bamF, trim, thresholds=(), percentiles=(), approximate=False,
+        depthStore=False, storeDir=None):
+    """
+    Queries one region line in one BAM file with samtools, or with
+    depthStore only its reads, and its depths from the depth store kept
+    in storeDir.
+    Returns the number of reads, the number of positions, the average and
+    median depths, the breadths at thresholds, the depths at percentiles
+    and the time taken in seconds.
+    """
+    start = time.perf_counter()
+    numReads = countReads(line, bamF, approximate)
+    if depthStore:
+        stats = storeDepthStats(line, bamF, trim, thresholds, percentiles, storeDir)
+    else:
+        stats = bamDepthStats(line, bamF, trim, thresholds, percentiles)
+    return (numReads,) + stats + (time.perf_counter() - start,)
+
+def scanJob(bamF, lines, trim, thresholds=(), percentiles=(), approximate=False,
+        depthStore=False, storeDir=None):
+    """
+    Answers all the region lines for one BAM file with a single pass (see
+    bam_coverage.py), which with depthStore only counts the reads, the
+    depths coming from the depth store kept in storeDir. Returns a list with, for each
+    line, the number of reads, the number of positions, the average and
+    median depths, the breadths at thresholds and the depths at
+    percentiles, and the time taken in seconds.
+    """
+    start = time.perf_counter()
+    queries = bam_coverage.scanBam(bamF, [bam_coverage.regionQuery(line, trim, approximate,
+            collectDepths=not depthStore) for line in lines])
+    if depthStore:
+        with instrument.metrics.stage('opening or building depth stores'):
+            store = bam_coverage.openDepthStore(bamF, storeDir)
+        with instrument.metrics.stage('depth store queries'):
+            results = [(query.numReads(),) + store.depthStats(query, thresholds, percentiles)
+                    for query in queries]
+    else:
+        results = [(query.numReads(),) + bam_coverage.depthStats(query, thresholds, percentiles)
+                for query in queries]
+    return results, time.perf_counter() - start
+
+def prepareDepthStore(bamF, storeDir=None):
+    """
+    Builds the depth store of bamF in storeDir if it isn't there or is
+    out of date, without returning it (see bam_coverage.openDepthStore).
+    """
+    bam_coverage.openDepthStore(bamF, storeDir)
+
+def runJobs(bams, lines, trim, workers=1, useSamtools=False, thresholds=(), percentiles=(),
+        approximate=False, cache=None, depthStore=False, storeDir=None):
+    """
+    Runs the queries of every region line against every BAM file and
+    returns results[bamIndex][lineIndex] = (numReads, numPositions, mean
+    depth, median depth, breadths..., percentile depths...), in input
+    order whatever order the jobs finish in, along with a list of (region
+    line, BAM file, seconds) timings of the individual jobs. With
+    approximate the numbers of reads are HyperLogLog estimates.
+
+    With useSamtools every (region, BAM) pair is a job run with samtools
+    pipelines. These jobs mostly wait on subprocesses, so they are spread
+    over a pool of threads; samtoolsLimiter caps the processes. Otherwise
+    every BAM file is one single-pass scan, and the scans, which are CPU
+    bound, are spread over a pool of processes.
+
+    With a resultCache, cached results are used as they are and only the
+    other queries are run (a BAM file is not scanned at all if all its
+    results are cached); their results are then added to the cache.
+
+    With depthStore the depths are taken from the depth store of each BAM
+    file, kept in storeDir (see bam_coverage.depthStorePath), which is
+    built if it isn't there or is out of date: by the scan of the BAM
+    file, or with useSamtools before the region jobs, which share it, in
+    a pool of processes.
+    """
+    results = [[None] * len(lines) for bamF in bams]
+    timings = []
+    metrics = instrument.metrics
+    if cache is not None:
+        options = [list(thresholds), list(percentiles), approximate]
+        if depthStore:
+            options.append('depth store')
+        keys = [[cache.key(signature, line, trim, options) for line in lines]
+                for signature in [bamSignature(bamF) for bamF in bams]]
+        for b in range(len(bams)):
+            for i in range(len(lines)):
+                results[b][i] = cache.get(keys[b][i])
+    todo = [[i for i in range(len(lines)) if results[b][i] is None] for b in range(len(bams))]
+    metrics.count('cached results used', sum([len(lines) - len(t) for t in todo]))
+    if depthStore and useSamtools:
+        built = [bams[b] for b in range(len(bams)) if todo[b]]
+        with metrics.stage('opening or building depth stores'):
+            if workers > 1 and len(built) > 1:
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=min(workers, len(built))) as pool:
+                    list(pool.map(prepareDepthStore, built, [storeDir] * len(built)))
+            else:
+                for bamF in built:
+                    prepareDepthStore(bamF, storeDir)
+    if useSamtools:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = dict([((b, i), pool.submit(regionJob, lines[i], bams[b], trim,
+                    thresholds, percentiles, approximate, depthStore, storeDir))
+                    for b in range(len(bams)) for i in todo[b]])
+            jobs = [(b, i) for b in range(len(bams)) for i in todo[b]]
+            for b, i in metrics.track(jobs, 'region queries', total=len(jobs)):
+                result = futures[(b, i)].result()
+                results[b][i] = result[:-1]
+                timings.append((lines[i], bams[b], result[-1]))
+    else:
+        scanned = [b for b in range(len(bams)) if todo[b]]
+        scanLines = [[lines[i] for i in todo[b]] for b in scanned]
+        if workers > 1 and len(scanned) > 1:
+            # The worker processes write progress lines for their own BAM
+            # file, but their timers and counts are lost
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(scanned)))
+            n = len(scanned)
+            scans = list(pool.map(scanJob, [bams[b] for b in scanned], scanLines,
+                    [trim] * n, [thresholds] * n, [percentiles] * n, [approximate] * n,
+                    [depthStore] * n, [storeDir] * n))
+            pool.shutdown()
+        else:
+            scans = [scanJob(bams[b], scanLines[k], trim, thresholds, percentiles, approximate,
+                    depthStore, storeDir) for k, b in enumerate(scanned)]
+        for k, b in enumerate(scanned):
+            scanResults, seconds = scans[k]
+            for i, result in zip(todo[b], scanResults):
+                results[b][i] = result
+            timings.append(('*', bams[b], seconds))
+    if cache is not None:
+        for b in range(len(bams)):
+            for i in todo[b]:
+                cache.put(keys[b][i], results[b][i])
+    return results, timings
+
+def defaultCachePath():
+    cacheDir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cacheDir, 'hts', 'nr_contig_depth_vs_length.sqlite')
+
+def bamSignature(bamF):
+    """
+    The real path, size and modification time of a BAM file, and the
+    modification time of its index (None if there is none). Any of them
+    changes when the file is rewritten or reindexed.
+    """
+    bamPath = os.path.realpath(bamF)
+    info = os.stat(bamPath)
+    indexMtime = None
+    for indexPath in [bamPath + '.bai', bamPath + '.csi', os.path.splitext(bamPath)[0] + '.bai']:
+        if os.path.exists(indexPath):
+            indexMtime = os.stat(indexPath).st_mtime_ns
+            break
+    return [bamPath, info.st_size, info.st_mtime_ns, indexMtime]
+
+class resultCache:
+    """
+    An on-disk (SQLite) cache of the results of region queries, keyed by
+    the BAM file (see bamSignature), the region line, the trim and any
+    other options that change the results. Every lookup marks the entry
+    as used; when the cache is closed, the least recently used entries
+    are evicted until the database file (page_count * page_size) is no
+    bigger than maxBytes. The database is auto-vacuumed, so that the
+    pages of evicted entries are given back and the file shrinks.
+    """
+    def __init__(self, path, maxBytes=100000000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.maxBytes = maxBytes
+        self.db = sqlite3.connect(path)
+        if self.db.execute('PRAGMA auto_vacuum').fetchone()[0] != 1:
+            # Only takes effect on an existing database once it is vacuumed
+            self.db.execute('PRAGMA auto_vacuum = FULL')
+            self.db.execute('VACUUM')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results '
+                '(key TEXT PRIMARY KEY, result TEXT NOT NULL, used INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS resultsUsed ON results (used)')
+        self.clock = self.db.execute('SELECT MAX(used) FROM results').fetchone()[0] or 0
+
+    def key(self, signature, line, trim, options):
+        return json.dumps([CACHE_VERSION, signature, line, trim, options])
+
+    def get(self, key):
+        row = self.db.execute('SELECT result FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.clock += 1
+        self.db.execute('UPDATE results SET used = ? WHERE key = ?', (self.clock, key))
+        return tuple(json.loads(row[0]))
+
+    def put(self, key, result):
+        self.clock += 1
+        self.db.execute('INSERT OR REPLACE INTO results (key, result, used) VALUES (?, ?, ?)',
+                (key, json.dumps(list(result)), self.clock))
+
+    def size(self):
+        pageCount = self.db.execute('PRAGMA page_count').fetchone()[0]
+        return pageCount * self.db.execute('PRAGMA page_size').fetchone()[0]
+
+    def close(self):
+        self.db.commit()
+        size = self.size()
+        while size > self.maxBytes:
+            entries = self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            if not entries:
+                break
+            # Evict the share of the entries that the excess is of the file,
+            # and check again, as the pages don't shrink in proportion
+            excess = max(1, entries * (size - self.maxBytes) // size)
+            self.db.execute('DELETE FROM results WHERE key IN '
+                    '(SELECT key FROM results ORDER BY used LIMIT ?)', (excess,))
+            self.db.commit()
+            size = self.size()
+        self.db.close()
+
+def parseSample(arg):
+    """
+    A --bam argument, FILE or NAME=FILE, as (name, file). Without a name,
+    the file name without its .bam extension is the name.
+    """
+    name, sep, bamF = arg.partition('=')
+    if not sep or os.path.exists(arg):
+        bamF = arg
+        name = os.path.basename(arg)
+        if name.endswith('.bam'):
+            name = name[:-len('.bam')]
+    return name, bamF
+
+def writeMatrix(out, names, lines, results, contigLengths, extraNames):
+    """
+    Writes the region x sample table: for each region line, the contig,
+    its length, the number of reads, average depth and median depth in
+    each sample (in turn), the number of positions and then each extra
+    statistic (breadths and percentiles) in each sample. With the samples
+    Dir and Amp this is the table this script has always written.
+    """
+    header = ['Name', 'Length'] + [name + ' Num Reads' for name in names] + \
+            [name + ' Avg depth' for name in names] + \
+            [name + ' Median depth' for name in names] + ['NR length']
+    for extraName in extraNames:
+        header.extend([name + ' ' + extraName for name in names])
+    out.write('\t'.join(header) + '\n')
+    for i, line in enumerate(lines):
+        recName = line.split(':')[0]
+        recLen = lenFromRecName(recName, contigLengths)
+        row = [recName, '%i' % (recLen)]
+        row.extend(['%i' % (sampleResults[i][0]) for sampleResults in results])
+        row.extend([str(sampleResults[i][2]) for sampleResults in results])
+        row.extend([str(sampleResults[i][3]) for sampleResults in results])
+        row.append('%i' % (results[-1][i][1]))
+        for j in range(len(extraNames)):
+            row.extend([str(sampleResults[i][4 + j]) for sampleResults in results])
+        out.write('\t'.join(row) + '\n')
+
+def saveMatrix(path, names, bams, lines, results, thresholds=(), percentiles=()):
+    """
+    Saves the results as a NumPy .npz file of region x sample matrices:
+    reads, mean and median, breadth (region x sample x threshold) and
+    percentile (region x sample x percentile), along with the regions
+    (the region lines), positions (their numbers of positions), samples,
+    bams, thresholds and percentiles.
+    """
+    table = np.array([[result for result in sampleResults] for sampleResults in results],
+            dtype=np.float64).reshape(len(results), len(lines), -1).transpose(1, 0, 2)
+    nThresholds = len(thresholds)
+    np.savez_compressed(path, regions=np.array(lines, dtype=str),
+            samples=np.array(names, dtype=str), bams=np.array(bams, dtype=str),
+            positions=table[:, 0, 1].astype(np.int64),
+            reads=table[:, :, 0].astype(np.int64), mean=table[:, :, 2],
+            median=table[:, :, 3], breadth=table[:, :, 4:4 + nThresholds],
+            percentile=table[:, :, 4 + nThresholds:],
+            thresholds=np.array(thresholds, dtype=np.int64),
+            percentiles=np.array(percentiles, dtype=np.float64))
+
 # rlens = {str(rec.id) : len(rec) for rec in SeqIO.parse(CONTIGS, 'fasta')}
 
-print('\t'.join(['Name', 'Length', 'Dir Num Reads', 'Amp Num Reads', 'Dir Avg depth', 'Amp Avg depth', 'Dir Median depth', 'Amp Median depth', 'NR length']))
-for line in open(NR_REGIONS, 'r').readlines():
-    line = line.rstrip('\n')
-    if line.endswith('None'):
-        continue
-    recName = line.split(':')[0]
-    recLen = lenFromRecName(recName)
-    dirnumReads = countReads(line, DIRBAM)
-    matchLen, dirmeanDepth, dirmedianDepth = bamDepth(line, DIRBAM, trim=50)
-    ampnumReads = countReads(line, AMPBAM)
-    matchLen, ampmeanDepth, ampmedianDepth = bamDepth(line, AMPBAM, trim=50)
-    print("%s\t%i\t%i\t%i\t%s\t%s\t%s\t%s\t%i" % (recName, recLen, dirnumReads, ampnumReads, str(dirmeanDepth), str(ampmeanDepth), str(dirmedianDepth), str(ampmedianDepth), matchLen))
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Read counts and depths of '
+            'the unique regions of contigs in two BAM files')
+    parser.add_argument('--contigs', default=CONTIGS,
+            help='The assembly; its .fai index is used for contig lengths if it exists')
+    parser.add_argument('--regions', default=NR_REGIONS, help='The unique regions file')
+    parser.add_argument('--dir-bam', default=DIRBAM, help='BAM of the direct library')
+    parser.add_argument('--amp-bam', default=AMPBAM, help='BAM of the amplified library')
+    parser.add_argument('--bam', action='append', metavar='[NAME=]FILE',
+            help='A BAM file to report on, named NAME in the column headers '
+            '(default: its file name); repeat for every sample. Replaces '
+            '--dir-bam and --amp-bam')
+    parser.add_argument('--npz', metavar='FILE',
+            help='Also save the region x sample matrices to FILE with numpy.savez')
+    parser.add_argument('--trim', type=int, default=50,
+            help='Positions trimmed off both ends of each region for the depths')
+    parser.add_argument('--samtools', action='store_true',
+            help='Query every region with samtools pipelines instead of '
+            'scanning each BAM file once')
+    parser.add_argument('--workers', type=int, default=None,
+            help='Number of region queries (with --samtools; default 1) or BAM '
+            'scans (default: one per BAM file) to run at once')
+    parser.add_argument('--max-samtools', type=int, default=None,
+            help='Maximum number of samtools processes running at once, at least '
+            '%i (with --samtools)' % (PIPELINE_PROCESSES))
+    parser.add_argument('--timings', metavar='FILE',
+            help='Write the time taken by every job to FILE (tab-separated)')
+    parser.add_argument('--breadth', default='',
+            help='Comma-separated depths, e.g. 1,10; adds columns with the '
+            'fraction of depths at least as high')
+    parser.add_argument('--percentiles', default='',
+            help='Comma-separated percentiles, e.g. 10,90; adds columns with '
+            'the depth at each percentile')
+    parser.add_argument('--approximate-reads', action='store_true',
+            help='Estimate the numbers of distinct reads with HyperLogLog, '
+            'in bounded memory (relative standard error 0.8%%)')
+    parser.add_argument('--depth-store', action='store_true',
+            help='Take the depths from a per-base depth store of each BAM file '
+            '(BAM file + .depth), built on first use, over the positions of '
+            'the trimmed regions only')
+    parser.add_argument('--depth-store-dir', metavar='DIR', default=None,
+            help='Where to keep the depth stores of --depth-store (default: next '
+            'to each BAM file, or %s if its directory is not writable)'
+            % (bam_coverage.defaultDepthStoreDir().replace('%', '%%')))
+    parser.add_argument('--cache', metavar='FILE', default=defaultCachePath(),
+            help='The cache of region results (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=100, metavar='MB',
+            help='Size of the cache file; the least recently used results are '
+            'evicted beyond it (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+            help='Neither use nor update the cache')
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    thresholds = [int(t) for t in args.breadth.split(',') if t]
+    percentileNames = [q for q in args.percentiles.split(',') if q]
+    percentiles = [float(q) for q in percentileNames]
+    if args.max_samtools is not None and args.max_samtools < PIPELINE_PROCESSES:
+        parser.error('--max-samtools must be at least %i, the number of samtools '
+                'processes in a depth pipeline' % (PIPELINE_PROCESSES))
+    samtoolsLimiter.maxProcesses = args.max_samtools
+    if args.bam:
+        samples = [parseSample(arg) for arg in args.bam]
+    else:
+        samples = [('Dir', args.dir_bam), ('Amp', args.amp_bam)]
+    names = [name for name, bamF in samples]
+    bams = [bamF for name, bamF in samples]
+    workers = args.workers
+    if workers is None:
+        workers = 1 if args.samtools else len(bams)
+
+    with instrument.session(args) as metrics:
+        # Contig lengths are read once, from the header of the first BAM and
+        # from the samtools faidx index of the contigs if there is one. Contigs
+        # missing from both get their length from their (SPAdes-style) name.
+        contigLengths = contig_table.contigTable(lenFromName)
+        contigLengths.addBam(bams[0])
+        if os.path.exists(args.contigs + '.fai'):
+            contigLengths.addFai(args.contigs + '.fai')
 
+        lines = [line.rstrip('\n') for line in open(args.regions, 'r').readlines()]
+        lines = [line for line in lines if not line.endswith('None')]
+        metrics.count('region lines', len(lines))
+        cache = None
+        if not args.no_cache:
+            cache = resultCache(args.cache, args.cache_size * 1000000)
+        results, timings = runJobs(bams,
+                lines, args.trim, workers=workers, useSamtools=args.samtools,
+                thresholds=thresholds, percentiles=percentiles,
+                approximate=args.approximate_reads, cache=cache,
+                depthStore=args.depth_store, storeDir=args.depth_store_dir)
+        if cache is not None:
+            cache.close()
+        if args.timings:
+            with open(args.timings, 'w') as timingh:
+                timingh.write('Region\tBAM\tSeconds\n')
+                for line, bamF, seconds in timings:
+                    timingh.write('%s\t%s\t%.3f\n' % (line, bamF, seconds))
 
+        extraNames = ['breadth >=%ix' % (t) for t in thresholds] + \
+                ['P%s depth' % (q) for q in percentileNames]
+        with metrics.stage('writing the table'):
+            writeMatrix(sys.stdout, names, lines, results, contigLengths, extraNames)
+            if args.npz:
+                saveMatrix(args.npz, names, bams, lines, results, thresholds, percentiles)
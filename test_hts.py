@@ -0,0 +1,373 @@
+#! /usr/bin/python3
+
+# Author: Patrick Denis Browne
+# e-mail: pdbr@plen.ku.dk
+# Licensed under the terms of the GNU General Public License v3.0
+
+# Regression tests for the scripts in this repository, run with pytest:
+# $ python3 -m pytest test_hts.py
+# The scripts are run as they would be from the command line, on small
+# inputs written to a temporary directory.
+
+import hashlib
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def runScript(script, args, timeout=120, env=None):
+    '''
+    Runs one of the scripts with this Python, with the environment
+    variables in env added, and returns the finished process, with its
+    output and error text.
+    '''
+    if env is not None:
+        env = dict(os.environ, **env)
+    return(subprocess.run([sys.executable, os.path.join(REPO_DIR, script)] + args,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+            timeout=timeout, env=env))
+
+def test_sharded_blast_report_with_bad_input_exits(tmp_path):
+    path = tmp_path / 'AVAblastn.txt'
+    path.write_bytes(b'NODE_1_length_2000\tNODE_1_length_2000\t100\t2000\t0\t0\t1\t2000'
+            b'\t1\t2000\t0.0\t3600\t2000\t2000\t0\n' * 100 + b'\xff\xfe\tbad\n')
+    proc = runScript('unique_regions_from_blastn.py', [str(path), '--jobs', '2'])
+    assert proc.returncode != 0
+    assert 'UnicodeDecodeError' in proc.stderr
+
+def tracedPeak(func):
+    '''
+    Runs func() and returns the peak of the memory allocated by
+    Python while it ran, as traced by tracemalloc.
+    '''
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return(peak)
+
+def test_unsorted_grouping_stays_within_memory(tmp_path):
+    import benchmark_hts
+    import count_reads_bridging_ends as crbe
+    samPath = str(tmp_path / 'aln.sam')
+    benchmark_hts.writeBridgingSam(samPath, 20000)
+    partitionBytes = 1000000
+    assert os.path.getsize(samPath) > 15 * partitionBytes
+    numGroups = [0]
+    def group(groups):
+        for alns in groups:
+            numGroups[0] += 1
+    assert tracedPeak(lambda: group(crbe.unsorted_sam_per_read(samPath, partitionBytes,
+            str(tmp_path)))) < partitionBytes
+    assert numGroups == [20000]
+    # A spill file just under partitionBytes is split again before it is
+    # grouped, as grouping takes about two and a half times its size
+    spillPath = str(tmp_path / 'part_00000.sam')
+    with open(samPath, 'rb') as fileh, open(spillPath, 'wb') as outh:
+        for line in fileh:
+            if not line.startswith(b'@'):
+                if outh.tell() + len(line) > 0.9 * partitionBytes:
+                    break
+                outh.write(line)
+    assert tracedPeak(lambda: group(crbe.partitionGroups(spillPath,
+            partitionBytes))) < partitionBytes
+
+def test_region_reads_are_counted_once_past_their_contigs(tmp_path, monkeypatch):
+    import bam_coverage
+    import benchmark_hts
+    benchmark_hts.writeRegionInputs(str(tmp_path), 5)
+    with open(str(tmp_path / 'nrRegions_min_1kb.txt')) as fileh:
+        lines = [line for line in fileh if not line.rstrip('\n').endswith('None')]
+    queries = [bam_coverage.regionQuery(line, 50) for line in lines]
+    released = []
+    finishTargets = bam_coverage.finishTargets
+    def checkedFinishTargets(contigTargets):
+        finishTargets(contigTargets)
+        released.extend([query.names.__class__ is int for tStart, tEnd, query, k
+                in contigTargets])
+    monkeypatch.setattr(bam_coverage, 'finishTargets', checkedFinishTargets)
+    bam_coverage.scanBam(str(tmp_path / 'dir.sorted.aln.bam'), queries)
+    assert released and all(released)
+    assert all([query.numReads() > 0 for query in queries])
+
+def test_hyperloglog_is_exact_until_it_allocates_registers():
+    import bam_coverage
+    names = bam_coverage.hyperLogLog()
+    for i in range(100):
+        names.add(b'read%i' % (i))
+        names.add(b'read%i' % (i))
+    assert names.registers is None
+    assert names.count() == 100
+    for i in range(100, 100000):
+        names.add(b'read%i' % (i))
+    assert len(names.registers) == 1 << 14
+    assert abs(names.count() - 100000) < 5000
+
+def test_failed_samtools_view_raises(tmp_path, monkeypatch):
+    import pytest
+    import nr_contig_depth_vs_length as nr
+    samtools = tmp_path / 'samtools'
+    samtools.write_text('#! /bin/sh\nif [ "$1" = view ]; then exit 1; fi\ncat > /dev/null\n')
+    samtools.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ.get('PATH', ''))
+    with pytest.raises(subprocess.CalledProcessError):
+        nr.bamDepthStats('NODE_1_length_2000:1-2000', str(tmp_path / 'missing.bam'))
+
+def test_empty_sam_file_with_jobs(tmp_path):
+    path = tmp_path / 'empty.sam'
+    path.write_bytes(b'')
+    proc = runScript('count_reads_bridging_ends.py', [str(path), '--jobs', '2'])
+    assert proc.returncode == 0, proc.stderr
+    assert 'Total: 0\n' in proc.stdout
+
+def test_bridging_ends_runs_without_numpy(tmp_path):
+    import benchmark_hts
+    samPath = str(tmp_path / 'aln.sam')
+    benchmark_hts.writeBridgingSam(samPath, 200)
+    # numpy can't be imported: a None entry in sys.modules raises an
+    # ImportError on import
+    proc = subprocess.run([sys.executable, '-c', 'import runpy, sys; '
+            'sys.modules["numpy"] = None; sys.argv = sys.argv[1:]; '
+            'runpy.run_path(sys.argv[0], run_name="__main__")',
+            os.path.join(REPO_DIR, 'count_reads_bridging_ends.py'), samPath],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+            timeout=120)
+    assert proc.returncode == 0, proc.stderr
+    assert 'Total: 200\n' in proc.stdout
+
+def test_windows_with_jobs_is_rejected(tmp_path):
+    path = tmp_path / 'aln.bam'
+    path.write_bytes(b'')
+    proc = runScript('count_reads_bridging_ends.py', [str(path), '--windows', '--jobs', '2'])
+    assert proc.returncode == 2
+    assert '--windows' in proc.stderr and '--jobs' in proc.stderr
+
+def test_depth_store_outside_a_read_only_bam_directory(tmp_path, monkeypatch):
+    import bam_coverage
+    import benchmark_hts
+    bamDir = tmp_path / 'bams'
+    bamDir.mkdir()
+    benchmark_hts.writeRegionInputs(str(bamDir), 5)
+    bamPath = str(bamDir / 'dir.sorted.aln.bam')
+    storeDir = tmp_path / 'stores'
+    store = bam_coverage.openDepthStore(bamPath, str(storeDir))
+    assert len(os.listdir(str(storeDir))) == 1
+    # The BAM file's directory is not writable, so the store goes to the
+    # cache directory
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setattr(os, 'access', lambda path, mode: False)
+    cachedStore = bam_coverage.openDepthStore(bamPath)
+    assert os.listdir(str(tmp_path / 'cache' / 'hts' / 'depth')) == os.listdir(str(storeDir))
+    assert cachedStore.contigs == store.contigs
+    assert not [name for name in os.listdir(str(bamDir)) if name.endswith('.depth')]
+
+def writeBams(samPath, namesPath, coordPath):
+    '''
+    Writes the alignments of a SAM file made by writeBridgingSam to a BAM
+    file in the same (read name) order and to one sorted by coordinate.
+    '''
+    import re
+    import benchmark_hts
+    with open(samPath) as fileh:
+        lines = fileh.read().splitlines()
+    references = [(line.split('\t')[1][3:], int(line.split('\t')[2][3:])) for line in lines
+            if line.startswith('@SQ')]
+    refIds = dict([(name, i) for i, (name, length) in enumerate(references)])
+    records = []
+    for line in lines:
+        if not line.startswith('@'):
+            fields = line.split('\t')
+            records.append((fields[0], int(fields[1]), refIds.get(fields[2], -1),
+                    int(fields[3]), [(op, int(n)) for n, op in
+                    re.findall(r'(\d+)([MIDNSHP=X])', fields[5])]))
+    benchmark_hts.writeSortedBam(namesPath, references, records)
+    records.sort(key=lambda record: (record[2] < 0, record[2], record[3]))
+    benchmark_hts.writeSortedBam(coordPath, references, records)
+
+def test_unsorted_coordinate_sorted_bam(tmp_path):
+    import benchmark_hts
+    samPath = str(tmp_path / 'aln.sam')
+    benchmark_hts.writeBridgingSam(samPath, 1000, numContigs=20)
+    namesPath = str(tmp_path / 'names.bam')
+    coordPath = str(tmp_path / 'coord.bam')
+    writeBams(samPath, namesPath, coordPath)
+    expected = runScript('count_reads_bridging_ends.py', [namesPath])
+    assert expected.returncode == 0, expected.stderr
+    assert 'Total: 1000\n' in expected.stdout
+    for args in [[], ['--jobs', '2', '--memory', '1']]:
+        proc = runScript('count_reads_bridging_ends.py', [coordPath, '--unsorted'] + args)
+        assert proc.returncode == 0, proc.stderr
+        assert sorted(proc.stdout.splitlines()) == sorted(expected.stdout.splitlines())
+
+def test_samtools_process_cap(tmp_path):
+    import threading
+    import time
+    import nr_contig_depth_vs_length as nr
+    proc = runScript('nr_contig_depth_vs_length.py', ['--max-samtools', '1'])
+    assert proc.returncode == 2
+    assert '--max-samtools' in proc.stderr
+    limiter = nr.processLimiter(2)
+    running = [0]
+    peak = [0]
+    lock = threading.Lock()
+    def job(n):
+        with limiter.slots(n):
+            with lock:
+                running[0] += n
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= n
+    threads = [threading.Thread(target=job, args=(1 + k % 2,)) for k in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak == [2]
+
+def test_batch_bridge_tests_match_the_scalar_ones(tmp_path):
+    import itertools
+    import benchmark_hts
+    import count_reads_bridging_ends as crbe
+    samPath = str(tmp_path / 'aln.sam')
+    benchmark_hts.writeBridgingSam(samPath, 2000, numContigs=20)
+    # Pairs of alignments at the very start and end of a contig, on both
+    # strands, as R1 or R2 and with unmapped, secondary and supplementary
+    # alignments, all in the same order after the generated reads
+    name = 'NODE_1_length_5000_cov_10.0'
+    length = 5000
+    flags = [0x1 | 0x40, 0x1 | 0x40 | 0x10, 0x1 | 0x80 | 0x10, 0x1 | 0x40 | 0x4,
+            0x1 | 0x80 | 0x100, 0x1 | 0x40 | 0x800]
+    positions = [1, 2, length - 29, length - 149, length - 399]
+    cigars = ['150M', '30M120S', '31M119S', '30S120M']
+    alns = list(itertools.product(flags, positions, cigars))
+    with open(samPath, 'a') as outh:
+        for k, (a, b) in enumerate(itertools.product(alns, repeat=2)):
+            for flag, pos, cigar in [a, b]:
+                outh.write('\t'.join(['zedge%06i' % (k), str(flag), name, str(pos), '60',
+                        cigar, '*', '0', '0', 'A' * 150, 'I' * 150]) + '\n')
+    scalarSeconds, scalarOut = benchmark_hts.scanOutput(crbe.scanReadGroups, samPath)
+    batchSeconds, batchOut = benchmark_hts.scanOutput(crbe.scanReadGroupsBatch, samPath)
+    assert 'Total: %i\n' % (2000 + len(alns) ** 2) in scalarOut
+    assert '\nzedge' in scalarOut
+    assert batchOut == scalarOut
+
+def test_sharded_scan_matches_the_serial_scan(tmp_path):
+    import io
+    import benchmark_hts
+    import count_reads_bridging_ends as crbe
+    samPath = str(tmp_path / 'aln.sam')
+    benchmark_hts.writeBridgingSam(samPath, 1500, numContigs=20)
+    header, headerEnd = crbe.readSamHeader(samPath)
+    size = os.path.getsize(samPath)
+    groupStarts = set()
+    qname = None
+    with open(samPath, 'rb') as fileh:
+        fileh.seek(headerEnd)
+        offset = headerEnd
+        for line in fileh:
+            if line[:line.find(b'\t')] != qname:
+                qname = line[:line.find(b'\t')]
+                groupStarts.add(offset)
+            offset += len(line)
+    seconds, expected = benchmark_hts.scanOutput(crbe.scanGroups, samPath)
+    # Many shard counts, so that the split points land on, just before and
+    # just after the first line of a read group
+    nearestStarts = set()
+    for numShards in range(2, 150):
+        shards = crbe.shardOffsets(samPath, numShards, headerEnd)
+        assert shards[0][0] == headerEnd and shards[-1][1] == size
+        for k in range(1, len(shards)):
+            assert shards[k][0] == shards[k - 1][1]
+            assert shards[k][0] in groupStarts
+        for k in range(1, numShards):
+            guess = headerEnd + (size - headerEnd) * k // numShards
+            nearestStarts.update([guess - start for start in [guess - 1, guess, guess + 1]
+                    if start in groupStarts])
+        if numShards % 10 == 7:
+            # The shards are read both through a buffer and memory-mapped
+            for crbe.useMmap in [False, True]:
+                out = io.StringIO()
+                counts = crbe.bridge_counts()
+                for start, end in shards:
+                    hits, shardCounts = crbe.scanShard((samPath, start, end))
+                    out.write(hits)
+                    counts.merge(shardCounts)
+                counts.report(out)
+                counts.reportPruning(out)
+                assert out.getvalue() == expected
+            crbe.useMmap = False
+    assert nearestStarts == set([-1, 0, 1])
+    serial = runScript('count_reads_bridging_ends.py', [samPath, '--jobs', '1'])
+    assert serial.returncode == 0, serial.stderr
+    assert 'Total: 1500\n' in serial.stdout
+    for args in [['--jobs', '3'], ['--mmap'], ['--jobs', '3', '--mmap']]:
+        sharded = runScript('count_reads_bridging_ends.py', [samPath] + args)
+        assert sharded.returncode == 0, sharded.stderr
+        assert sharded.stdout == serial.stdout
+
+def test_blast_report_regions_are_unchanged(tmp_path):
+    import benchmark_hts
+    path = str(tmp_path / 'AVAblastn.txt')
+    benchmark_hts.writeBlastTable(path, 60)
+    # The SHA-1 of the output of the script as it was before the hit
+    # intervals were merged (per-base lists of positions). The contigs are
+    # listed in the order of a set, so string hashing is fixed.
+    expected = '79b41ff8d2be26ec2ca555f61101cd23ff55f93b'
+    for args in [[], ['--jobs', '2']]:
+        proc = runScript('unique_regions_from_blastn.py', [path] + args,
+                env={'PYTHONHASHSEED': '0'})
+        assert proc.returncode == 0, proc.stderr
+        assert hashlib.sha1(proc.stdout.encode()).hexdigest() == expected
+
+def test_result_cache_is_bounded_by_bytes(tmp_path):
+    import nr_contig_depth_vs_length as nr
+    path = str(tmp_path / 'cache.sqlite')
+    maxBytes = 200000
+    for run in range(3):
+        cache = nr.resultCache(path, maxBytes)
+        if run:
+            assert cache.get(cache.key(['bam'], 'region0', 50, [])) is not None
+        for i in range(run * 500, run * 500 + 500):
+            cache.put(cache.key(['bam'], 'region%i' % (i), 50, []), [i, 1.5] + [0.25] * 20)
+        cache.close()
+        assert os.path.getsize(path) <= maxBytes
+    cache = nr.resultCache(path, maxBytes)
+    # The oldest entries are evicted, except the one that was looked up
+    assert cache.get(cache.key(['bam'], 'region0', 50, [])) is not None
+    assert cache.get(cache.key(['bam'], 'region1', 50, [])) is None
+    assert cache.get(cache.key(['bam'], 'region1499', 50, [])) is not None
+    cache.close()
+
+def test_depth_accumulator_takes_store_views_in_chunks():
+    import numpy as np
+    import bam_coverage
+    depths = np.arange(4000000, dtype=np.uint32) % 70000
+    expected = bam_coverage.depthAccumulator()
+    expected.add(depths.astype(np.int64), chunkSize=len(depths))
+    accumulated = bam_coverage.depthAccumulator()
+    # Well under the 32 MB of the depths widened to int64
+    assert tracedPeak(lambda: accumulated.add(depths)) < 16000000
+    assert accumulated.total == expected.total and accumulated.n == expected.n
+    assert (accumulated.counts == expected.counts).all()
+    assert accumulated.overflow == expected.overflow
+    assert accumulated.percentile(90) == expected.percentile(90)
+
+def test_depth_stores_built_in_parallel_give_the_same_results(tmp_path):
+    import benchmark_hts
+    import nr_contig_depth_vs_length as nr
+    benchmark_hts.writeRegionInputs(str(tmp_path), 5)
+    with open(str(tmp_path / 'nrRegions_min_1kb.txt')) as fileh:
+        lines = [line.rstrip('\n') for line in fileh if not line.rstrip('\n').endswith('None')]
+    bams = [str(tmp_path / 'dir.sorted.aln.bam'), str(tmp_path / 'amp.sorted.aln.bam')]
+    results = []
+    for workers in [1, 2]:
+        storeDir = tmp_path / ('stores%i' % (workers))
+        results.append(nr.runJobs(bams, lines, 50, workers=workers, percentiles=[90],
+                depthStore=True, storeDir=str(storeDir))[0])
+        assert len(os.listdir(str(storeDir))) == 2
+    assert results[0] == results[1]
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 # This script is intended to identify unique regions of a specified
 # minimum size from an all versus all blastn report. It wasn't written
@@ -21,36 +21,160 @@
 #   -out AVAblastn.txt -outfmt "6 qseqid sseqid pident length mismatch \
 #   gapopen qstart qend sstart send evalue bitscore qlen slen gaps"
 # 
-# Then this script can be run on that output (hardcoded as AVAblastn.txt
-# below)
+# Then this script can be run on that output (AVAblastn.txt unless
+# another file is given on the command line; it may be gzip compressed,
+# or '-' for stdin). The report is read in a single streaming pass. With
+# --jobs the hits are partitioned by query across worker processes, each
+# of which keeps the hits of its own share of the contigs.
+#
+# Without blastn, --fasta finds the unique regions from the assembly
+# itself, with an index of its k-mers (see kmerRegionLines): a position is
+# covered if a k-mer over it also occurs, in either orientation, in
+# another contig. Only exact matches of at least k nt are found, so this
+# approximates the blastn route, which also finds diverged homology, but
+# takes time linear in the size of the assembly.
 
+import itertools
+import multiprocessing
+import re
 import sys
+import zlib
+
+import numpy as np
+
+import bam_reader
+import contig_table
+import instrument
+
+MIN_LENGTH = 1000
+KMER_LENGTH = 31
+# 2-bit codes of the bases; anything else (e.g. N) is 4 and no k-mer over
+# it is used
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = i
+    BASE_CODES[ord(chr(base).lower())] = i
+# The columns of the report and their types in the arrays of hits made by
+# blastArray; qseqid and sseqid are stored as the integer IDs of the names
+# in a contig_table.contigTable.
+BLAST_COLUMNS = [('qseqid', np.int32), ('sseqid', np.int32),
+        ('pident', np.float64), ('length', np.int64), ('mismatch', np.int64),
+        ('gapopen', np.int64), ('qstart', np.int64), ('qend', np.int64),
+        ('sstart', np.int64), ('send', np.int64), ('evalue', np.float64),
+        ('bitscore', np.float64), ('qlen', np.int64), ('slen', np.int64),
+        ('gaps', np.int64)]
+BLAST_FIELDS = [field for field, dtype in BLAST_COLUMNS]
+# All that finding the unique regions needs
+REGION_FIELDS = ['qseqid', 'sseqid', 'qstart', 'qend']
+
+def blastArray(lines, contigs, fields=BLAST_FIELDS, SEP='\t'):
+    """Parses lines of the blastn report into a NumPy structured array
+
+    Only the given fields (see BLAST_COLUMNS) are parsed and kept, one
+    column at a time. Query and subject names are interned in contigs, a
+    contig_table.contigTable, and stored as its integer IDs.
+    """
+    dtype = np.dtype([column for column in BLAST_COLUMNS if column[0] in fields])
+    rows = [line.rstrip('\n').split(SEP) for line in lines]
+    hits = np.empty(len(rows), dtype=dtype)
+    if len(rows) == 0:
+        return hits
+    for i, (field, fieldType) in enumerate(BLAST_COLUMNS):
+        if field not in dtype.names:
+            continue
+        column = [row[i] for row in rows]
+        if i < 2:
+            hits[field] = [contigs.intern(name) for name in column]
+        else:
+            hits[field] = np.array(column).astype(fieldType)
+    return hits
+
+def readChunks(lines, chunkSize=100000):
+    """Yields lists of up to chunkSize lines"""
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, chunkSize))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+# Vectorized versions of the blastHit tests, which return a boolean mask
+# over an array of hits from blastArray.
+
+def selfHitMask(hits):
+    return hits['qseqid'] == hits['sseqid']
+
+def fullSelfHitMask(hits):
+    return selfHitMask(hits) & \
+            (hits['qstart'] == 1) & \
+            (hits['qend'] == hits['qlen']) & \
+            (hits['sstart'] == 1) & \
+            (hits['send'] == hits['slen']) & \
+            (hits['qlen'] == hits['slen']) & \
+            (hits['mismatch'] == 0)
+
+def fullReverseMask(hits):
+    return (hits['qlen'] == hits['slen']) & \
+            (hits['qstart'] == 1) & \
+            (hits['qend'] == hits['qlen']) & \
+            (hits['sstart'] == hits['slen']) & \
+            (hits['send'] == 1) & \
+            (hits['mismatch'] == 0)
+
+def sameLengthMask(hits):
+    return hits['qlen'] == hits['slen']
+
+def _blastColumn(field):
+    def get(self):
+        return self.hits[field][self.i].item()
+    return property(get)
+
+def _blastName(field):
+    def get(self):
+        return self.contigs.names[self.hits[field][self.i]]
+    return property(get)
 
 class blastHit:
+    __slots__ = ('hits', 'i', 'contigs')
+
     def __init__(self, line, SEP='\t'):
         """Parses a custom output from NCBI's blast+ tool kit
 
         The output parsed is produced by running a blast search with the
         following output parameter:
         -outfmt '6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore qlen slen gaps'
+
+        The hit is a view over one row of an array of hits made by
+        blastArray (see fromRow), so its columns are read from there.
         """
-        line = line.rstrip('\n')
-        cols = line.split(SEP)
-        self.qseqid = cols[0]
-        self.sseqid = cols[1]
-        self.pident = float(cols[2])
-        self.length = int(cols[3])
-        self.mismatch = int(cols[4])
-        self.gapopen = int(cols[5])
-        self.qstart = int(cols[6])
-        self.qend = int(cols[7])
-        self.sstart = int(cols[8])
-        self.send = int(cols[9])
-        self.evalue = float(cols[10])
-        self.bitscore = float(cols[11])
-        self.qlen = int(cols[12])
-        self.slen = int(cols[13])
-        self.gaps = int(cols[14])
+        self.contigs = contig_table.contigTable()
+        self.hits = blastArray([line], self.contigs, SEP=SEP)
+        self.i = 0
+
+    @classmethod
+    def fromRow(cls, hits, i, contigs):
+        """The hit in row i of hits, whose names are interned in contigs"""
+        bh = cls.__new__(cls)
+        bh.hits = hits
+        bh.i = i
+        bh.contigs = contigs
+        return bh
+
+    qseqid = _blastName('qseqid')
+    sseqid = _blastName('sseqid')
+    pident = _blastColumn('pident')
+    length = _blastColumn('length')
+    mismatch = _blastColumn('mismatch')
+    gapopen = _blastColumn('gapopen')
+    qstart = _blastColumn('qstart')
+    qend = _blastColumn('qend')
+    sstart = _blastColumn('sstart')
+    send = _blastColumn('send')
+    evalue = _blastColumn('evalue')
+    bitscore = _blastColumn('bitscore')
+    qlen = _blastColumn('qlen')
+    slen = _blastColumn('slen')
+    gaps = _blastColumn('gaps')
 
     def isSelfHit(self):
         return self.qseqid == self.sseqid
@@ -86,60 +210,359 @@ class blastHit:
         """
         return self.qlen == self.slen
 
-if __name__ == '__main__':
-    import re
-
-    def sizeOfContig(contigName):
-        return int(re.search(r'_length_(\d+)', contigName).group(1))
-    
-    def findContiguous(trueFalseList, minLen):
-        """Returns 1-based coordinates of contiguous regions
-        
-        The trueFalseList is a list instance where each element is either True
-        or False. The indices of the list correspond to positions on a
-        continuous linear sequence. When a series of consecutive True values
-        occur in a length greater than the minimum length, then the whole
-        series will be returned in one-based coordinates. Separate contiguous
-        regions will be comma-delimited
-        """
-        regions = []
-        trueFalseList = [False] + trueFalseList
-        i = 0
-        while i < len(trueFalseList):
-            if trueFalseList[i] == False:
-                i += 1
-            else:
-                j = i
-                while trueFalseList[j] == True:
-                    j += 1
-                    if j == len(trueFalseList):
-                        break
-                if j - i >= minLen:
-                    regions.append([str(i), str(j-1)])
-                i = j + 1
-        return(regions)
-
-    infile = 'AVAblastn.txt'
-    lines = list(open(infile,'r').readlines())
-    contigNames = list(set([line.split('\t')[0] for line in lines]))
-    nrPositions = {contigName : [True for i in range(sizeOfContig(contigName))]
-            for contigName in contigNames}
-    for line in lines:
-        bh = blastHit(line)
-        if bh.isSelfHit():
+def sizeOfContig(contigName):
+    return int(re.search(r'_length_(\d+)', contigName).group(1))
+
+def mergeIntervals(intervals):
+    """Sorts and merges 0-based, half-open intervals
+
+    Overlapping and abutting intervals are merged into one. Empty intervals
+    are dropped.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if start >= end:
             continue
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+def findUncovered(length, merged, minLen):
+    """Returns 1-based coordinates of the gaps between merged intervals
+
+    merged is a sorted list of non-overlapping 0-based, half-open intervals
+    (see mergeIntervals) covering parts of a sequence of the given length.
+    Every stretch of at least minLen positions not covered by any of them
+    is returned as a list of its first and last position, as strings. The
+    time taken depends on the number of intervals, not on the length.
+    """
+    regions = []
+    pos = 0
+    for start, end in merged:
+        if start - pos >= max(minLen, 1):
+            regions.append([str(pos + 1), str(start)])
+        pos = end
+    if length - pos >= max(minLen, 1):
+        regions.append([str(pos + 1), str(length)])
+    return regions
+
+def addHits(lines, covered, contigs, chunkSize=100000):
+    """Adds the query intervals covered by hits to other contigs
+
+    covered maps every query seen to a list of the 0-based, half-open
+    intervals of it covered by hits to other contigs, in the order in
+    which the queries are first seen. Queries with only self hits get an
+    empty list. The lines are parsed chunkSize at a time into arrays (see
+    blastArray), with the names interned in contigs.
+    """
+    metrics = instrument.metrics
+    position, size = instrument.fileProgress(lines)
+    for chunk in metrics.track(readChunks(lines, chunkSize), 'chunks of lines',
+            'reading lines', size, position):
+        metrics.count('lines', len(chunk))
+        with metrics.stage('parsing hits'):
+            hits = blastArray(chunk, contigs, fields=REGION_FIELDS)
+        codes, first = np.unique(hits['qseqid'], return_index=True)
+        for code in codes[np.argsort(first)].tolist():
+            covered.setdefault(contigs.names[code], [])
+        hits = hits[~selfHitMask(hits)]
+        codes, index = np.unique(hits['qseqid'], return_inverse=True)
+        sizes = np.array([sizeOfContig(contigs.names[code]) for code in codes.tolist()],
+                dtype=np.int64)
+        beyond = hits['qend'] > sizes[index]
+        assert not beyond.any(), "Hit beyond the end of the query\n%s" % (
+                contigs.names[hits['qseqid'][beyond][0]])
+        metrics.count('hits to other contigs', len(hits))
+        for code, qstart, qend in zip(hits['qseqid'].tolist(),
+                hits['qstart'].tolist(), hits['qend'].tolist()):
+            covered[contigs.names[code]].append((qstart - 1, qend))
+    return covered
+
+def regionLine(contig, intervals, minLen):
+    """Formats the unique regions of a contig as a line of output"""
+    nrpos = findUncovered(sizeOfContig(contig), mergeIntervals(intervals), minLen)
+    return formatRegions(contig, nrpos)
+
+def formatRegions(contig, nrpos):
+    """Formats the regions from findUncovered as a line of output"""
+    if len(nrpos) == 0:
+        return "%s None" % contig
+    else:
+        return "%s" % (' '.join([contig + ':' + '-'.join(nr) for nr in nrpos]))
+
+def regionWorker(inQueue, outQueue, minLen):
+    """Collects the hits of one shard and returns its output lines
+
+    Batches of lines are read from inQueue until None. A dictionary of the
+    output line of every contig of the shard, or the exception that was
+    raised, is put on outQueue.
+    """
+    instrument.metrics.disable()
+    covered = {}
+    contigs = contig_table.contigTable()
+    error = None
+    while True:
+        lines = inQueue.get()
+        if lines is None:
+            break
+        if error is None:
+            try:
+                addHits(lines, covered, contigs)
+            except Exception as e:
+                error = e
+    if error is None:
+        try:
+            outQueue.put(dict([(contig, regionLine(contig, covered[contig], minLen))
+                    for contig in covered]))
+        except Exception as e:
+            error = e
+    if error is not None:
+        outQueue.put(error)
+
+def shardedRegionLines(fileh, jobs, minLen, batchSize=10000):
+    """Finds the unique regions with jobs worker processes
+
+    The lines of fileh are sent, in batches, to the worker that owns their
+    query (by a hash of its name), so that each worker only holds the hits
+    of its own contigs. Returns the query names, in the order in which
+    they were first seen, and a dictionary of the output line of each.
+    If reading fails (e.g. the report isn't valid UTF-8), the workers are
+    terminated before the exception is raised, as they would otherwise
+    wait for more lines forever.
+    """
+    inQueues = [multiprocessing.Queue(maxsize=4) for i in range(jobs)]
+    outQueue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=regionWorker,
+            args=(inQueues[i], outQueue, minLen)) for i in range(jobs)]
+    for worker in workers:
+        worker.start()
+    names = {}
+    batches = [[] for i in range(jobs)]
+    position, size = instrument.fileProgress(fileh)
+    try:
+        for line in instrument.metrics.track(fileh, 'lines', 'reading lines', size, position):
+            qseqid = line.split('\t', 1)[0]
+            names[qseqid] = None
+            shard = zlib.crc32(qseqid.encode()) % jobs
+            batches[shard].append(line)
+            if len(batches[shard]) == batchSize:
+                inQueues[shard].put(batches[shard])
+                batches[shard] = []
+        for shard in range(jobs):
+            if batches[shard]:
+                inQueues[shard].put(batches[shard])
+            inQueues[shard].put(None)
+    except BaseException:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        raise
+    lines = {}
+    error = None
+    for worker in workers:
+        result = outQueue.get()
+        if isinstance(result, Exception):
+            error = result
         else:
-            i1 = bh.qstart - 1
-            i2 = bh.qend
-            nrpos = nrPositions[bh.qseqid]
-            for i in range(i1, i2):
-                nrpos[i] = False
-            nrPositions[bh.qseqid] = nrpos
-    for contig in contigNames:
-        nrpos = findContiguous(nrPositions[contig], 1000)
-        if len(nrpos) == 0:
-            print("%s None" % contig)
+            lines.update(result)
+    for worker in workers:
+        worker.join()
+    if error is not None:
+        raise error
+    return list(names), lines
+
+def readFasta(fileh):
+    """Yields the name (up to the first space) and sequence of each record"""
+    name = None
+    seq = []
+    for line in fileh:
+        if line.startswith('>'):
+            if name is not None:
+                yield name, ''.join(seq).encode()
+            name = (line[1:].split() or [''])[0]
+            seq = []
+        else:
+            seq.append(line.strip())
+    if name is not None:
+        yield name, ''.join(seq).encode()
+
+def packedWindows(codes, k):
+    """The windows of k 2-bit codes (uint64) at each position of codes,
+    packed into a uint64 with the first code in the highest bits
+
+    Windows of twice the length are built from pairs of shorter ones, so
+    it takes about log2(k) passes over the sequence rather than k.
+    """
+    packed = None
+    length = 0
+    power = codes
+    span = 1
+    while True:
+        if k & span:
+            if packed is None:
+                packed = power
+            else:
+                n = len(power) - length
+                packed = (packed[:n] << np.uint64(2 * span)) | power[length:]
+            length += span
+        if length == k:
+            return packed
+        n = len(power) - span
+        power = (power[:n] << np.uint64(2 * span)) | power[span:]
+        span *= 2
+
+def canonicalKmers(seq, k):
+    """The canonical k-mers of a sequence, 2-bit packed
+
+    Returns an array with, for every position i up to len(seq) - k, the
+    smaller of the k-mer starting there and its reverse complement, as a
+    uint64 (so k is at most 32), and a mask of the k-mers that only hold
+    A, C, G and T.
+    """
+    codes = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    bad = np.concatenate([[0], np.cumsum(codes == 4)])
+    valid = bad[k:] - bad[:n] == 0
+    codes = np.where(codes == 4, 0, codes).astype(np.uint64)
+    forward = packedWindows(codes, k)
+    # The reverse complement of the k-mer at i is the k-mer at n - 1 - i of
+    # the reverse complement of the sequence
+    reverse = packedWindows(np.uint64(3) - codes[::-1], k)[::-1]
+    return np.minimum(forward, reverse), valid
+
+def distinctSorted(values):
+    """The distinct values of a sorted array
+
+    Much faster than np.unique, which doesn't know the values are sorted.
+    """
+    if len(values) == 0:
+        return values
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+def contigKmers(task):
+    """The sorted, distinct canonical k-mers of one (sequence, k)"""
+    seq, k = task
+    kmers, valid = canonicalKmers(seq, k)
+    return distinctSorted(np.sort(kmers[valid]))
+
+def sharedKmers(kmerSets):
+    """The sorted k-mers that are in more than one of the sets of k-mers"""
+    if len(kmerSets) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    kmers = np.sort(np.concatenate(kmerSets))
+    # Every set is distinct, so a k-mer in several sets is repeated
+    return distinctSorted(kmers[1:][kmers[1:] == kmers[:-1]])
+
+def coveredIntervals(seq, k, shared):
+    """The 0-based, half-open, merged intervals of a sequence covered by
+    k-mers in shared (sorted)"""
+    kmers, valid = canonicalKmers(seq, k)
+    starts = np.nonzero(valid & np.isin(kmers, shared))[0]
+    depth = np.cumsum(np.bincount(starts, minlength=len(seq) + 1) -
+            np.bincount(starts + k, minlength=len(seq) + 1))[:len(seq)]
+    edges = np.diff(np.concatenate([[0], (depth > 0).astype(np.int8), [0]]))
+    return [[start, end] for start, end in zip(np.nonzero(edges == 1)[0].tolist(),
+            np.nonzero(edges == -1)[0].tolist())]
+
+_shared = None
+
+def initKmerWorker(shared):
+    global _shared
+    _shared = shared
+    instrument.metrics.disable()
+
+def kmerRegionLine(task):
+    """The output line of one (name, sequence, k, minLen) in a worker"""
+    name, seq, k, minLen = task
+    return formatRegions(name, findUncovered(len(seq),
+            coveredIntervals(seq, k, _shared), minLen))
+
+def kmerRegionLines(fileh, k, minLen, jobs=1):
+    """Finds the unique regions of the contigs of a FASTA file by k-mers
+
+    Every contig is hashed into its distinct canonical k-mers (see
+    canonicalKmers), which are pooled to find the k-mers that occur in
+    more than one contig; a k-mer repeated within one contig, like a
+    self hit, doesn't count. The positions of each contig covered by such
+    shared k-mers are then merged into intervals, and the uncovered
+    stretches of at least minLen found as with the blastn report (see
+    findUncovered). Contig lengths are those of the sequences. Both
+    passes are spread over jobs worker processes, contig by contig.
+    Returns the output lines in the order of the FASTA file.
+    """
+    metrics = instrument.metrics
+    with metrics.stage('reading contigs'):
+        contigs = list(readFasta(fileh))
+    metrics.count('contigs', len(contigs))
+    metrics.count('bases', sum([len(seq) for name, seq in contigs]))
+    tasks = [(seq, k) for name, seq in contigs]
+    with metrics.stage('hashing k-mers'):
+        if jobs > 1:
+            with multiprocessing.Pool(jobs, initializer=instrument.metrics.disable) as pool:
+                kmerSets = pool.map(contigKmers, tasks, chunksize=1)
         else:
-            print("%s" % (' '.join([contig + ':' + '-'.join(nr) for nr in nrpos])))
+            kmerSets = [contigKmers(task) for task in tasks]
+        shared = sharedKmers(kmerSets)
+        del kmerSets
+    metrics.count('k-mers in more than one contig', len(shared))
+    tasks = [(name, seq, k, minLen) for name, seq in contigs]
+    with metrics.stage('marking shared k-mers'):
+        if jobs > 1:
+            with multiprocessing.Pool(jobs, initializer=initKmerWorker,
+                    initargs=(shared,)) as pool:
+                return pool.map(kmerRegionLine, tasks, chunksize=1)
+        initKmerWorker(shared)
+        return [kmerRegionLine(task) for task in tasks]
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Unique regions of contigs '
+            'from an all versus all blastn report')
+    parser.add_argument('blastn', nargs='?', default='AVAblastn.txt',
+            help="The blastn report; it may be gzip compressed, or '-' for stdin")
+    parser.add_argument('--jobs', type=int, default=1,
+            help='Number of worker processes to partition the contigs over')
+    parser.add_argument('--fasta', metavar='CONTIGS',
+            help='Find the unique regions from the k-mers shared between the '
+            'contigs of this FASTA file (may be gzip compressed) instead of '
+            'from a blastn report; the contigs are listed in its order')
+    parser.add_argument('-k', type=int, default=KMER_LENGTH,
+            help='k-mer length for --fasta, at most 32 (default: %(default)s)')
+    instrument.addArguments(parser)
+    args = parser.parse_args()
+    if not 0 < args.k <= 32:
+        parser.error('-k must be between 1 and 32')
+
+    with instrument.session(args) as metrics:
+        if args.fasta:
+            with bam_reader.openInput(args.fasta) as fileh:
+                for line in kmerRegionLines(fileh, args.k, MIN_LENGTH, args.jobs):
+                    print(line)
+            sys.exit(0)
+        with bam_reader.openInput(args.blastn) as fileh:
+            if args.jobs > 1:
+                queryNames, lines = shardedRegionLines(fileh, args.jobs, MIN_LENGTH)
+            else:
+                # The query intervals covered by hits to other contigs,
+                # 0-based and half-open, for every contig
+                covered = addHits(fileh, {}, contig_table.contigTable())
+                queryNames = list(covered)
+                lines = None
+        # The queries are listed in the (arbitrary) order of a set, as they
+        # always have been
+        contigNames = list(set(queryNames))
+        metrics.count('contigs', len(contigNames))
+        with metrics.stage('merging intervals and writing regions'):
+            for contig in contigNames:
+                if lines is None:
+                    print(regionLine(contig, covered[contig], MIN_LENGTH))
+                else:
+                    print(lines[contig])
 
 